@@ -14,6 +14,7 @@ import sys
 import subprocess
 import json
 import shutil
+import py_compile
 from pathlib import Path
 
 # Bot code (from bot.py)
@@ -26,36 +27,76 @@ Features:
 - Admin login via /adminlogin <PIN> (creates temporary admin session)
 - Admin panel: upload files, list files, broadcast text/media, stats
 - Upload stores files under files/<category>/ with metadata (expiry support)
-- Users auto-register on /start and saved in users.json
+- STORAGE_MODE=file_id keeps only Telegram file_ids (optional local mirror)
+- Users auto-register on /start and are saved in users.db (imported once from users.json)
 - Cleanup loop deletes expired files hourly
 - catch-all message handler: sends main menu on any user message (private chat)
+- Optional diagnostics mode (BOT_DIAGNOSTICS=1): event-loop lag and slow handler sampling
+- Optional sharding (WORKERS=N): updates split across worker processes by chat_id,
+  per-user state kept in a shared SQLite store
+- Admin sessions and half-finished upload/broadcast flows survive restarts
 - Uses python-telegram-bot v20+ async API
+
+Cold start: `python -X importtime -m bot` puts imports at ~0.2-0.3s (PTB 20.8),
+mostly telegram/httpx and asyncio, all needed before the first update;
+sharding's multiprocessing is imported on demand. The installer
+precompiles this file and systemd starts it with `-m`, so the bot's own code
+loads from cached bytecode. "Ready" and "First update" log lines give the
+time since process start after each restart.
 """
+from __future__ import annotations
 
 import os
+import re
+import sys
+import copy
 import json
 import time
+import zlib
+import queue
+import atexit
 import asyncio
 import logging
+import logging.handlers
 import base64
+import bisect
+import fcntl
+import hashlib
+import sqlite3
+import functools
+import threading
+import traceback
+from collections.abc import MutableMapping
+from contextlib import asynccontextmanager, contextmanager
+from collections import Counter, OrderedDict, defaultdict, deque
 from pathlib import Path
 from typing import Dict, Optional
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 
 from telegram import (
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     InputFile,
+    InputMediaDocument,
+    InlineQueryResultArticle,
+    InlineQueryResultCachedDocument,
+    InputTextMessageContent,
+    Message,
+    MessageEntity,
 )
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
     ContextTypes,
     CallbackQueryHandler,
+    InlineQueryHandler,
     MessageHandler,
+    TypeHandler,
+    ApplicationHandlerStop,
     filters,
 )
+from telegram.error import BadRequest, Forbidden, RetryAfter
 
 # ---------------------------
 # CONFIG / ENV
@@ -75,21 +116,62 @@ TRUEMONEY_NUMBER = os.environ.get("TRUEMONEY_NUMBER", "0953244179")
 TRUEMONEY_QR_PATH = Path("assets/true_qr.png")
 
 BASE_DIR = Path("files")
-BASE_DIR.mkdir(exist_ok=True)
-
-USERS_JSON = Path("users.json")
-if not USERS_JSON.exists():
-    USERS_JSON.write_text(json.dumps({}))
+# "disk": uploads are downloaded into BASE_DIR and listed from there.
+# "file_id": nothing is downloaded; metadata.json keeps the file_id, size and
+# file_unique_id, and files are sent by file_id. MIRROR_FILES=1 adds a
+# background local copy.
+STORAGE_MODE = os.environ.get("STORAGE_MODE", "disk")
+MIRROR_FILES = os.environ.get("MIRROR_FILES", "0") == "1"
+MIRROR_INTERVAL = 600  # seconds between mirror passes
+MIRROR_MAX_BYTES = 20 * 1024 * 1024  # getFile limit for bots
+USERS_JSON = Path("users.json")  # legacy registry, migrated into USERS_DB
 
 # Rate limit safety (seconds)
 DELAY_BETWEEN = float(os.environ.get("DELAY_BETWEEN", "0.05"))
-
-# Broadcast & upload states
-broadcast_state: Dict[int, dict] = {}  # admin_id -> state
-upload_state: Dict[int, str] = {}  # admin_id -> category key
-
-# Admin sessions (after PIN login): map user_id -> expiry_ts
-admin_sessions: Dict[int, float] = {}
+BROADCAST_ALBUM_WAIT = 1.5  # seconds to collect every part of an album before copying it
+
+# Diagnostics mode: loop lag monitor + slow handler sampling
+DIAGNOSTICS = os.environ.get("BOT_DIAGNOSTICS", "0") == "1"
+DIAG_LAG_INTERVAL = float(os.environ.get("DIAG_LAG_INTERVAL", "0.5"))  # seconds between loop heartbeats
+DIAG_SLOW_SECONDS = float(os.environ.get("DIAG_SLOW_SECONDS", "1.0"))  # handler/stall threshold
+
+# Sharding: with WORKERS > 1 a front process receives updates (polling, or the
+# webhook when WEBHOOK_URL is set) and routes each one to a worker by chat_id.
+WORKERS = max(1, int(os.environ.get("WORKERS", "1")))
+STATE_DB = Path(os.environ.get("STATE_DB", "state.db"))  # sessions / flows, persisted across restarts
+USERS_DB = Path(os.environ.get("USERS_DB", "users.db"))  # user registry (imported once from users.json)
+USER_BUCKETS = 10000  # sample:N% selects users whose hash bucket < N% of this
+ACTIVITY_DB = Path(os.environ.get("ACTIVITY_DB", "activity.db"))  # hourly/daily usage rollups
+ACTIVITY_HOURLY_KEEP = 14 * 24  # hours of hourly rollups kept (daily rows are kept forever)
+TOP_FILES = 10  # entries in the admin "Top Files" leaderboard
+MENU_RATE = float(os.environ.get("MENU_RATE", "0.2"))  # menus per second per user after the burst
+MENU_BURST = float(os.environ.get("MENU_BURST", "3"))
+CALLBACK_RATE = float(os.environ.get("CALLBACK_RATE", "2"))  # button taps per second per user
+CALLBACK_BURST = float(os.environ.get("CALLBACK_BURST", "10"))
+MENU_DEBOUNCE = float(os.environ.get("MENU_DEBOUNCE", "10"))  # messages this soon after a menu get no reply
+ALBUM_SIZE = 10  # files per send_media_group (Telegram's maximum)
+SEND_RATE = float(os.environ.get("SEND_RATE", "25"))  # outbound messages/second for bulk deliveries
+SEND_CONCURRENCY = 4
+CHAT_SEND_INTERVAL = float(os.environ.get("CHAT_SEND_INTERVAL", "1.0"))  # seconds between sends to one chat
+UPLOAD_WORKERS = int(os.environ.get("UPLOAD_WORKERS", "3"))  # concurrent admin upload downloads
+UPLOAD_PROGRESS_INTERVAL = 1.5  # seconds between progress message edits
+MENU_ANCHOR_GAP = 4  # reuse the last menu if at most this many messages were sent after it
+BROADCAST_RETRIES = 3  # RetryAfter retries per recipient before counting it failed
+STATE_FLUSH_INTERVAL = float(os.environ.get("STATE_FLUSH_INTERVAL", "2"))  # seconds between coalesced writes
+STATE_TTL = float(os.environ.get("STATE_TTL", "1800"))  # abandoned upload/broadcast flows expire after 30 min
+STATE_MAX_ENTRIES = int(os.environ.get("STATE_MAX_ENTRIES", "10000"))  # in-memory entries per state dict
+STATE_SWEEP_INTERVAL = 60.0  # seconds between expiry sweeps
+RENDER_CACHE_SIZE = int(os.environ.get("RENDER_CACHE_SIZE", "10000"))  # messages whose last render is remembered
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")  # e.g. https://bot.example.com
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram")
+
+# Category browsing
+PAGE_SIZE = int(os.environ.get("PAGE_SIZE", "10"))  # file buttons per page
+
+# Inline mode (@bot dtac); enable it for the bot with /setinline in @BotFather
+INLINE_CACHE_TIME = int(os.environ.get("INLINE_CACHE_TIME", "300"))  # seconds Telegram may reuse an answer
+INLINE_MAX_RESULTS = 50  # Telegram's limit per answer
 
 # Categories
 CATEGORIES = {
@@ -101,11 +183,772 @@ CATEGORIES = {
     "ais_v2ray_64": "V2RAY 64KBPS",
 }
 
-# Logging
-logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+# Logging: handlers only enqueue; a listener thread writes stderr + rotating JSON file
+LOG_DIR = Path(os.environ.get("LOG_DIR", "logs"))
+LOG_MAX_BYTES = int(os.environ.get("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.environ.get("LOG_BACKUP_COUNT", "14"))
+ERROR_SAMPLE_WINDOW = 60.0  # seconds
+ERROR_SAMPLE_BURST = 5  # identical warnings/errors logged per window
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        ctx = getattr(record, "ctx", None)
+        if ctx:
+            entry["ctx"] = ctx
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            entry["suppressed"] = suppressed
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DailyRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """Size-based rotation that also rolls the file over at midnight."""
+
+    def __init__(self, filename, max_bytes: int, backup_count: int):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+        self.rollover_at = self._next_midnight()
+
+    @staticmethod
+    def _next_midnight() -> float:
+        tomorrow = datetime.now().date() + timedelta(days=1)
+        return datetime.combine(tomorrow, datetime.min.time()).timestamp()
+
+    def shouldRollover(self, record):
+        if record.created >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.rollover_at = self._next_midnight()
+
+
+class ErrorSampler(logging.Filter):
+    """Pass the first `burst` identical WARNING+ records per window, drop the rest.
+
+    The first record let through after a noisy window carries the number of
+    dropped duplicates as `suppressed`.
+    """
+
+    def __init__(self, window: float, burst: int):
+        super().__init__()
+        self.window = window
+        self.burst = burst
+        self._seen: Dict[tuple, list] = {}
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING:
+            return True
+        exc_type = record.exc_info[0] if record.exc_info else None
+        key = (record.name, record.levelno, str(record.msg), exc_type)
+        slot = self._seen.get(key)
+        if slot is None or record.created - slot[0] >= self.window:
+            if slot and slot[1] > self.burst:
+                record.suppressed = slot[1] - self.burst
+            if len(self._seen) > 1000:
+                self._seen.clear()
+            self._seen[key] = [record.created, 1]
+            return True
+        slot[1] += 1
+        return slot[1] <= self.burst
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Enqueue a shallow copy of the record; tracebacks are formatted by the listener."""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def setup_logging(name: str = "bot"):
+    LOG_DIR.mkdir(parents=True, exist_ok=True)
+    file_handler = DailyRotatingFileHandler(LOG_DIR / f"{name}.log", LOG_MAX_BYTES, LOG_BACKUP_COUNT)
+    file_handler.setFormatter(JsonFormatter())
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(ErrorSampler(ERROR_SAMPLE_WINDOW, ERROR_SAMPLE_BURST))
+    listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    # force: worker processes re-run this after fork (the parent's listener thread is gone)
+    logging.basicConfig(level=logging.INFO, handlers=[queue_handler], force=True)
+    return logging.getLogger(__name__)
+
+
+def describe_update(update) -> dict:
+    """Compact summary of an update for log records (never the full repr)."""
+    if not isinstance(update, Update):
+        return {"update": type(update).__name__}
+    info = {"update_id": update.update_id}
+    if update.effective_user:
+        info["user_id"] = update.effective_user.id
+    if update.effective_chat:
+        info["chat_id"] = update.effective_chat.id
+    if update.callback_query:
+        info["callback"] = (update.callback_query.data or "")[:64]
+    return info
+
+
+def process_uptime() -> float:
+    """Seconds since this process started, interpreter startup and imports included."""
+    try:
+        with open("/proc/self/stat") as fh:
+            start_ticks = int(fh.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as fh:
+            uptime = float(fh.read().split()[0])
+        return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return time.monotonic() - MODULE_LOADED_AT
+
+
+MODULE_LOADED_AT = time.monotonic()
+
+# handlers are attached by setup_logging(), called from main() / run_worker()
 logger = logging.getLogger(__name__)
 
 
+def init_runtime(log_name: str = "bot"):
+    """Side effects deferred from import time: logging, storage folders."""
+    setup_logging(log_name)
+    BASE_DIR.mkdir(exist_ok=True)
+
+
+# ---------------------------
+# Persistent per-user state
+# ---------------------------
+_MISSING = object()
+
+
+class StateStore:
+    """JSON key/value rows with optional expiry in SQLite, safe to use from several processes.
+
+    The connection is opened lazily and re-opened after fork, so worker
+    processes never share a handle with their parent.
+    """
+
+    def __init__(self, path: Path):
+        self.path = str(path)
+        self._db = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._reader = None
+        self._reader_pid = None
+        self._read_lock = threading.Lock()
+        self._dicts = []
+
+    def _conn(self) -> sqlite3.Connection:
+        if self._db is None or self._pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS state ("
+                " namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,"
+                " PRIMARY KEY (namespace, key))"
+            )
+            columns = {row[1] for row in db.execute("PRAGMA table_info(state)")}
+            if "expires_at" not in columns:
+                db.execute("ALTER TABLE state ADD COLUMN expires_at REAL")
+            db.execute("CREATE INDEX IF NOT EXISTS idx_state_expires ON state (expires_at)")
+            self._db, self._pid = db, os.getpid()
+        return self._db
+
+    def _read_conn(self) -> sqlite3.Connection:
+        """Separate connection for lookups: under WAL they never wait for a flush in progress."""
+        if self._reader is None or self._reader_pid != os.getpid():
+            with self._lock:
+                self._conn()  # creates the table on first use
+            self._reader = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            self._reader_pid = os.getpid()
+        return self._reader
+
+    def get(self, namespace: str, key: str):
+        """(value, expires_at) of a live row, or (_MISSING, None)."""
+        with self._read_lock:
+            row = self._read_conn().execute(
+                "SELECT value, expires_at FROM state WHERE namespace = ? AND key = ?"
+                " AND (expires_at IS NULL OR expires_at > ?)", (namespace, key, time.time())).fetchone()
+        return (json.loads(row[0]), row[1]) if row else (_MISSING, None)
+
+    def items(self, namespace: str) -> list:
+        with self._read_lock:
+            rows = self._read_conn().execute(
+                "SELECT key, value, expires_at FROM state WHERE namespace = ?"
+                " AND (expires_at IS NULL OR expires_at > ?)", (namespace, time.time())).fetchall()
+        return [(k, json.loads(v), exp) for k, v, exp in rows]
+
+    def register(self, pdict: "PersistentDict"):
+        self._dicts.append(pdict)
+
+    def evict_expired(self):
+        """Drop expired entries from every registered dict (call on the event loop)."""
+        for pdict in self._dicts:
+            pdict.evict_expired()
+
+    def collect(self):
+        """Snapshot pending writes of all registered dicts (call on the event loop)."""
+        upserts, deletes = [], []
+        for pdict in self._dicts:
+            ups, dels = pdict.take_dirty()
+            upserts.extend((pdict.namespace, k, v, exp) for k, v, exp in ups)
+            deletes.extend((pdict.namespace, k) for k in dels)
+        return upserts, deletes
+
+    def write(self, pending, sweep: bool = False):
+        """Apply a collect() snapshot in one transaction (safe to run in a thread).
+
+        With sweep=True expired rows of every namespace are deleted as well.
+        """
+        upserts, deletes = pending
+        if not upserts and not deletes and not sweep:
+            return
+        with self._lock:
+            db = self._conn()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.executemany(
+                    "INSERT OR REPLACE INTO state (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)", upserts)
+                db.executemany("DELETE FROM state WHERE namespace = ? AND key = ?", deletes)
+                if sweep:
+                    db.execute("DELETE FROM state WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),))
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+
+    def flush(self):
+        self.write(self.collect())
+
+
+class PersistentDict(MutableMapping):
+    """Bounded, TTL-aware write-behind dict over one StateStore namespace, keyed by user id.
+
+    Keys are read from SQLite on first access (nothing is loaded at startup)
+    and misses are cached as well, so looking up a user without state costs
+    one query per process; writes stay in memory until the next flush, so a burst of updates to the
+    same key costs one row write. With WORKERS > 1 every chat is pinned to one
+    worker, so each key has a single writer and the per-process cache is safe.
+    Values must be replaced, not mutated in place, to be persisted.
+
+    Entries expire `ttl` seconds after they were set (per-entry override via
+    set()); expired entries are dropped when read and by the periodic sweep.
+    At most `max_entries` are kept in memory: least recently used clean
+    entries are dropped from the cache and re-read from SQLite on demand.
+    """
+
+    def __init__(self, store: StateStore, namespace: str, ttl: Optional[float] = None,
+                 max_entries: int = 10000):
+        self.store = store
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # key -> (value, expires_at); value is _MISSING for a known-absent key or a pending delete
+        self._cache: "OrderedDict[int, tuple]" = OrderedDict()
+        self._dirty = set()
+        store.register(self)
+
+    def _load(self, key):
+        entry = self._cache.get(key)
+        if entry is None:
+            entry = self.store.get(self.namespace, str(key))
+            self._cache[key] = entry
+            self._trim()
+        else:
+            self._cache.move_to_end(key)
+        value, expires_at = entry
+        if value is not _MISSING and expires_at and expires_at <= time.time():
+            self._cache[key] = (_MISSING, None)
+            self._dirty.add(key)
+            return _MISSING
+        return value
+
+    def _trim(self):
+        if len(self._cache) <= self.max_entries:
+            return
+        for key in list(self._cache):
+            if len(self._cache) <= self.max_entries:
+                break
+            if key not in self._dirty:
+                del self._cache[key]
+
+    def set(self, key, value, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else ttl
+        self._cache[key] = (value, time.time() + ttl if ttl else None)
+        self._cache.move_to_end(key)
+        self._dirty.add(key)
+        self._trim()
+
+    def __getitem__(self, key):
+        value = self._load(key)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        if self._load(key) is _MISSING:
+            raise KeyError(key)
+        self._cache[key] = (_MISSING, None)
+        self._dirty.add(key)
+
+    def __contains__(self, key):
+        return self._load(key) is not _MISSING
+
+    def evict_expired(self):
+        now = time.time()
+        for key, (value, expires_at) in list(self._cache.items()):
+            if value is not _MISSING and expires_at and expires_at <= now:
+                self._cache[key] = (_MISSING, None)
+                self._dirty.add(key)
+
+    def _snapshot(self) -> dict:
+        merged = {int(k): (v, exp) for k, v, exp in self.store.items(self.namespace)}
+        merged.update(self._cache)
+        now = time.time()
+        return {k: v for k, (v, exp) in merged.items() if v is not _MISSING and not (exp and exp <= now)}
+
+    def __iter__(self):
+        return iter(self._snapshot())
+
+    def __len__(self):
+        return len(self._snapshot())
+
+    def take_dirty(self):
+        upserts, deletes = [], []
+        for key in self._dirty:
+            value, expires_at = self._cache[key]
+            if value is _MISSING:
+                deletes.append(str(key))
+            else:
+                upserts.append((str(key), json.dumps(value), expires_at))
+        self._dirty.clear()
+        return upserts, deletes
+
+
+state_store = StateStore(STATE_DB)
+
+
+def per_user_state(namespace: str, ttl: Optional[float] = STATE_TTL) -> PersistentDict:
+    """Per-user state that survives restarts, expires and is shared by all workers."""
+    return PersistentDict(state_store, namespace, ttl=ttl, max_entries=STATE_MAX_ENTRIES)
+
+
+async def flush_state_loop():
+    """Coalesced write-behind: one transaction per STATE_FLUSH_INTERVAL, expiry sweep every minute."""
+    loop = asyncio.get_running_loop()
+    next_sweep = time.monotonic() + STATE_SWEEP_INTERVAL
+    while True:
+        await asyncio.sleep(STATE_FLUSH_INTERVAL)
+        sweep = time.monotonic() >= next_sweep
+        if sweep:
+            state_store.evict_expired()
+            next_sweep = time.monotonic() + STATE_SWEEP_INTERVAL
+        try:
+            await loop.run_in_executor(None, state_store.write, state_store.collect(), sweep)
+            await loop.run_in_executor(None, user_store.write, user_store.take_pending())
+            await loop.run_in_executor(None, activity.rollup, activity.drain())
+            await loop.run_in_executor(None, download_stats.write, download_stats.take_pending())
+        except Exception:
+            logger.exception("state flush failed")
+
+
+# Broadcast & upload states
+broadcast_state: Dict[int, dict] = per_user_state("broadcast")  # admin_id -> state
+upload_state: Dict[int, str] = per_user_state("upload")  # admin_id -> category key (open until /done)
+
+# Admin sessions (after PIN login): map user_id -> expiry_ts (entry TTL set per session)
+admin_sessions: Dict[int, float] = per_user_state("admin_sessions", ttl=None)
+
+
+# ---------------------------
+# Users (indexed attributes for audience segments)
+# ---------------------------
+class Segment:
+    """Broadcast audience filter; every field narrows the audience (None = no filter).
+
+    Parsed from leading key:value tokens of a broadcast text or caption:
+      since:2024-01-01 / until:2024-02-01   first seen in a date range (UTC)
+      active:7d / idle:30d                  last seen within / not within N days
+      cat:dtac_zivpn                        downloaded from a category (repeat for any of)
+      sample:5                              a stable 5% of users (by user_id hash bucket)
+    """
+
+    KEYS = ("since", "until", "active", "idle", "cat", "sample")
+
+    def __init__(self):
+        self.first_from: Optional[int] = None
+        self.first_to: Optional[int] = None
+        self.active_days: Optional[float] = None
+        self.idle_days: Optional[float] = None
+        self.categories = []
+        self.sample: Optional[float] = None
+
+    @classmethod
+    def parse(cls, text: str, seg: Optional["Segment"] = None):
+        """Split leading filter tokens off `text` (adding to `seg`); returns (segment, remaining text)."""
+        seg = seg or cls()
+        rest = text.lstrip()
+        while rest:
+            token, *tail = rest.split(None, 1)
+            key, sep, value = token.partition(":")
+            if not sep or key not in cls.KEYS or not value:
+                break
+            if key in ("since", "until"):
+                ts = int(datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp())
+                if key == "since":
+                    seg.first_from = ts
+                else:
+                    seg.first_to = ts + 86400
+            elif key in ("active", "idle"):
+                days = float(value.rstrip("d"))
+                if key == "active":
+                    seg.active_days = days
+                else:
+                    seg.idle_days = days
+            elif key == "cat":
+                if value not in CATEGORIES:
+                    raise ValueError(f"unknown category {value}")
+                seg.categories.append(value)
+            else:
+                seg.sample = max(0.0, min(100.0, float(value.rstrip("%"))))
+            rest = tail[0] if tail else ""
+        return seg, rest
+
+    def where(self):
+        now = time.time()
+        clauses, params = ["active = 1"], []
+        if self.first_from is not None:
+            clauses.append("first_seen >= ?")
+            params.append(self.first_from)
+        if self.first_to is not None:
+            clauses.append("first_seen < ?")
+            params.append(self.first_to)
+        if self.active_days is not None:
+            clauses.append("last_seen >= ?")
+            params.append(now - self.active_days * 86400)
+        if self.idle_days is not None:
+            clauses.append("last_seen < ?")
+            params.append(now - self.idle_days * 86400)
+        if self.categories:
+            marks = ",".join("?" * len(self.categories))
+            clauses.append(f"user_id IN (SELECT user_id FROM user_categories WHERE category IN ({marks}))")
+            params.extend(self.categories)
+        if self.sample is not None:
+            clauses.append("bucket < ?")
+            params.append(self.sample * USER_BUCKETS / 100)
+        return " AND ".join(clauses), params
+
+    def describe(self) -> str:
+        parts = []
+        if self.first_from is not None or self.first_to is not None:
+            parts.append("first seen in range")
+        if self.active_days is not None:
+            parts.append(f"active in last {self.active_days:g}d")
+        if self.idle_days is not None:
+            parts.append(f"idle for {self.idle_days:g}d+")
+        if self.categories:
+            parts.append("downloaded " + "/".join(self.categories))
+        if self.sample is not None:
+            parts.append(f"{self.sample:g}% sample")
+        return ", ".join(parts) or "all users"
+
+
+class UserStore:
+    """Users and their per-category downloads in SQLite, indexed for segment queries.
+
+    Activity (last_seen) and download counts are buffered in memory and
+    written in one transaction by flush_state_loop, not per update.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._db = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._seen: Dict[int, tuple] = {}  # user_id -> (username, ts)
+        self._downloads = Counter()  # (user_id, category) -> count
+
+    def _conn(self) -> sqlite3.Connection:
+        if self._db is None or self._pid != os.getpid():
+            db = sqlite3.connect(str(self.path), timeout=10, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS users (
+                    user_id INTEGER PRIMARY KEY,
+                    username TEXT NOT NULL DEFAULT '',
+                    first_seen INTEGER NOT NULL,
+                    last_seen INTEGER NOT NULL,
+                    bucket INTEGER NOT NULL,
+                    active INTEGER NOT NULL DEFAULT 1
+                );
+                CREATE INDEX IF NOT EXISTS idx_users_first_seen ON users (first_seen);
+                CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users (last_seen);
+                CREATE INDEX IF NOT EXISTS idx_users_bucket ON users (bucket, user_id);
+                CREATE TABLE IF NOT EXISTS user_categories (
+                    category TEXT NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    downloads INTEGER NOT NULL DEFAULT 0,
+                    last_at INTEGER NOT NULL,
+                    PRIMARY KEY (category, user_id)
+                );
+            """)
+            self._db, self._pid = db, os.getpid()
+            self._migrate_json(db)
+        return self._db
+
+    def _migrate_json(self, db: sqlite3.Connection):
+        # One-time import of the old users.json registry
+        if not USERS_JSON.exists() or db.execute("SELECT 1 FROM users LIMIT 1").fetchone():
+            return
+        try:
+            data = json.loads(USERS_JSON.read_text())
+        except Exception:
+            logger.exception("users.json migration: unreadable file")
+            return
+        rows = []
+        for sid, info in data.items():
+            if not sid.isdigit():
+                continue
+            first = int(info.get("first_seen") or time.time())
+            rows.append((int(sid), info.get("username") or "", first, first, self.bucket(int(sid))))
+        db.execute("BEGIN")
+        db.executemany("INSERT OR IGNORE INTO users (user_id, username, first_seen, last_seen, bucket) VALUES (?, ?, ?, ?, ?)", rows)
+        db.execute("COMMIT")
+        logger.info("Migrated %d users from %s", len(rows), USERS_JSON)
+
+    @staticmethod
+    def bucket(user_id: int) -> int:
+        return zlib.crc32(str(user_id).encode("ascii")) % USER_BUCKETS
+
+    def register(self, user_id: int, username: Optional[str]):
+        now = int(time.time())
+        with self._lock:
+            self._conn().execute("""
+                INSERT INTO users (user_id, username, first_seen, last_seen, bucket) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (user_id) DO UPDATE SET username = excluded.username, last_seen = excluded.last_seen, active = 1
+            """, (user_id, username or "", now, now, self.bucket(user_id)))
+
+    def touch(self, user_id: int, username: Optional[str]):
+        self._seen[user_id] = (username or "", int(time.time()))
+
+    def record_download(self, user_id: int, category: str):
+        self._downloads[(user_id, category)] += 1
+
+    def take_pending(self):
+        seen, downloads = self._seen, self._downloads
+        self._seen, self._downloads = {}, Counter()
+        return seen, downloads
+
+    def write(self, pending):
+        seen, downloads = pending
+        if not seen and not downloads:
+            return
+        now = int(time.time())
+        with self._lock:
+            db = self._conn()
+            db.execute("BEGIN")
+            try:
+                db.executemany("""
+                    INSERT INTO users (user_id, username, first_seen, last_seen, bucket) VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (user_id) DO UPDATE SET
+                        username = CASE WHEN excluded.username != '' THEN excluded.username ELSE users.username END,
+                        last_seen = MAX(users.last_seen, excluded.last_seen), active = 1
+                """, [(uid, name, ts, ts, self.bucket(uid)) for uid, (name, ts) in seen.items()])
+                db.executemany("""
+                    INSERT INTO user_categories (category, user_id, downloads, last_at) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (category, user_id) DO UPDATE SET
+                        downloads = downloads + excluded.downloads, last_at = excluded.last_at
+                """, [(cat, uid, n, now) for (uid, cat), n in downloads.items()])
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+
+    def flush(self):
+        self.write(self.take_pending())
+
+    def deactivate(self, user_ids):
+        """Drop unreachable users from every audience until they talk to the bot again."""
+        with self._lock:
+            db = self._conn()
+            db.execute("BEGIN")
+            try:
+                db.executemany("UPDATE users SET active = 0 WHERE user_id = ?", [(uid,) for uid in user_ids])
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+
+    def get(self, user_id: int) -> dict:
+        with self._lock:
+            row = self._conn().execute(
+                "SELECT username, first_seen, last_seen FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        return {"username": row[0], "first_seen": row[1], "last_seen": row[2]} if row else {}
+
+    def count(self, segment: Optional[Segment] = None) -> int:
+        where, params = (segment or Segment()).where()
+        with self._lock:
+            return self._conn().execute(f"SELECT COUNT(*) FROM users WHERE {where}", params).fetchone()[0]
+
+    def audience(self, segment: Optional[Segment] = None, batch: int = 500):
+        """Stream matching user ids in keyset batches.
+
+        A sample pages through idx_users_bucket in (bucket, user_id) order, so
+        only the sampled buckets are read; other segments page by user_id.
+        """
+        segment = segment or Segment()
+        where, params = segment.where()
+        if segment.sample is None:
+            sql = f"SELECT user_id, user_id FROM users WHERE {where} AND user_id > ? ORDER BY user_id LIMIT ?"
+            after = [0]
+        else:
+            sql = (f"SELECT user_id, bucket FROM users WHERE {where} AND (bucket, user_id) > (?, ?) "
+                   f"ORDER BY bucket, user_id LIMIT ?")
+            after = [-1, 0]
+        while True:
+            with self._lock:
+                rows = self._conn().execute(sql, params + after + [batch]).fetchall()
+            for user_id, _ in rows:
+                yield user_id
+            if len(rows) < batch:
+                return
+            last_id, last_key = rows[-1]
+            after = [last_id] if segment.sample is None else [last_key, last_id]
+
+
+user_store = UserStore(USERS_DB)
+
+
+# ---------------------------
+# Activity (ring buffer -> hourly/daily rollups)
+# ---------------------------
+class ActivityLog:
+    """Handler events go into an in-memory ring buffer; flush_state_loop rolls them up.
+
+    deque.append/popleft are atomic, so emitting never takes a lock. The
+    rollup keeps per-hour and per-day counters plus each user's last active
+    day, so DAU/MAU and top categories are read from a few small rows.
+    """
+
+    def __init__(self, path: Path, size: int = 100_000):
+        self.path = path
+        self.events = deque(maxlen=size)
+        self._db = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _conn(self) -> sqlite3.Connection:
+        if self._db is None or self._pid != os.getpid():
+            db = sqlite3.connect(str(self.path), timeout=10, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS activity_hourly (
+                    hour INTEGER NOT NULL, kind TEXT NOT NULL, category TEXT NOT NULL, events INTEGER NOT NULL,
+                    PRIMARY KEY (hour, kind, category)
+                );
+                CREATE TABLE IF NOT EXISTS activity_daily (
+                    day INTEGER NOT NULL, kind TEXT NOT NULL, category TEXT NOT NULL, events INTEGER NOT NULL,
+                    PRIMARY KEY (day, kind, category)
+                );
+                CREATE TABLE IF NOT EXISTS activity_users (user_id INTEGER PRIMARY KEY, last_day INTEGER NOT NULL);
+                CREATE TABLE IF NOT EXISTS daily_active (day INTEGER PRIMARY KEY, users INTEGER NOT NULL);
+                CREATE TABLE IF NOT EXISTS last_active (day INTEGER PRIMARY KEY, users INTEGER NOT NULL);
+            """)
+            self._db, self._pid = db, os.getpid()
+        return self._db
+
+    def emit(self, kind: str, user_id: int = 0, category: str = ""):
+        self.events.append((time.time(), kind, user_id, category))
+
+    def drain(self):
+        events = []
+        while True:
+            try:
+                events.append(self.events.popleft())
+            except IndexError:
+                return events
+
+    def rollup(self, events):
+        if not events:
+            return
+        hourly, daily, seen = Counter(), Counter(), {}
+        for ts, kind, user_id, category in events:
+            hourly[(int(ts) // 3600, kind, category)] += 1
+            day = int(ts) // 86400
+            daily[(day, kind, category)] += 1
+            if user_id:
+                seen[user_id] = max(seen.get(user_id, 0), day)
+        with self._lock:
+            db = self._conn()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                for table, key, counts in (("activity_hourly", "hour", hourly), ("activity_daily", "day", daily)):
+                    db.executemany(f"""
+                        INSERT INTO {table} ({key}, kind, category, events) VALUES (?, ?, ?, ?)
+                        ON CONFLICT ({key}, kind, category) DO UPDATE SET events = events + excluded.events
+                    """, [k + (n,) for k, n in counts.items()])
+                for user_id, day in seen.items():
+                    row = db.execute("SELECT last_day FROM activity_users WHERE user_id = ?", (user_id,)).fetchone()
+                    if row and row[0] >= day:
+                        continue
+                    # first event of the day for this user: one more DAU, and move them in the MAU window
+                    db.execute("INSERT OR REPLACE INTO activity_users (user_id, last_day) VALUES (?, ?)", (user_id, day))
+                    if row:
+                        db.execute("UPDATE last_active SET users = users - 1 WHERE day = ?", (row[0],))
+                    for table in ("daily_active", "last_active"):
+                        db.execute(f"""
+                            INSERT INTO {table} (day, users) VALUES (?, 1)
+                            ON CONFLICT (day) DO UPDATE SET users = users + 1
+                        """, (day,))
+                db.execute("DELETE FROM activity_hourly WHERE hour < ?", (int(time.time()) // 3600 - ACTIVITY_HOURLY_KEEP,))
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+
+    def flush(self):
+        self.rollup(self.drain())
+
+    def summary(self, top: int = 5) -> dict:
+        now = int(time.time())
+        today, hour = now // 86400, now // 3600
+        with self._lock:
+            db = self._conn()
+            dau = db.execute("SELECT users FROM daily_active WHERE day = ?", (today,)).fetchone()
+            mau = db.execute("SELECT SUM(users) FROM last_active WHERE day > ?", (today - 30,)).fetchone()
+            last_24h = db.execute(
+                "SELECT kind, SUM(events) FROM activity_hourly WHERE hour > ? GROUP BY kind ORDER BY kind",
+                (hour - 24,)).fetchall()
+            categories = db.execute("""
+                SELECT category, SUM(events) FROM activity_daily
+                WHERE day > ? AND kind = 'download' AND category != ''
+                GROUP BY category ORDER BY SUM(events) DESC LIMIT ?
+            """, (today - 30, top)).fetchall()
+        return {"dau": dau[0] if dau else 0, "mau": (mau[0] or 0) if mau else 0,
+                "last_24h": last_24h, "top_categories": categories}
+
+
+activity = ActivityLog(ACTIVITY_DB)
+
+
 # ---------------------------
 # Utilities
 # ---------------------------
@@ -137,34 +980,224 @@ def load_metadata(cat_key: str) -> dict:
         return {}
 
 
+def write_json_atomic(path: Path, data):
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(data))
+    os.replace(tmp, path)
+
+
+@contextmanager
+def file_lock(path: Path):
+    """Exclusive lock between worker processes for read-modify-write of `path`."""
+    with open(path.with_name(f".{path.name}.lock"), "w") as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
 def save_metadata(cat_key: str, data: dict):
     p = category_folder(cat_key) / "metadata.json"
-    p.write_text(json.dumps(data))
+    write_json_atomic(p, data)
+
+
+class CategoryIndex:
+    """Per-category file listing sorted newest first, paged by keyset cursor.
+
+    Entries are keyed by (-mtime_us, crc32(name)); a cursor is that key as
+    "<mtime_us>.<crc hex>", so a page is a bisect into the sorted keys rather
+    than a slice of a freshly sorted directory listing. A category is only
+    rescanned when its folder mtime changes (a file was added or removed, or
+    metadata.json was rewritten). In STORAGE_MODE=file_id, metadata entries
+    with a file_id are listed too, dated by uploaded_at.
+    """
+
+    def __init__(self):
+        self._entries = {}  # cat_key -> (folder mtime_ns, keys, names, file_ids)
+
+    def _load(self, cat_key: str):
+        folder = category_folder(cat_key)
+        stamp = folder.stat().st_mtime_ns
+        cached = self._entries.get(cat_key)
+        if cached and cached[0] == stamp:
+            return cached
+        meta = load_metadata(cat_key)
+        dated = {}
+        if STORAGE_MODE == "file_id":
+            for name, info in meta.items():
+                if info.get("file_id"):
+                    dated[name] = info.get("uploaded_at", 0) * 1_000_000
+        with os.scandir(folder) as it:
+            for e in it:
+                if e.name == "metadata.json" or e.name.startswith(".") or not e.is_file():
+                    continue
+                dated.setdefault(e.name, e.stat().st_mtime_ns // 1000)
+        rows = sorted(((-mtime_us, zlib.crc32(name.encode("utf-8"))), name) for name, mtime_us in dated.items())
+        file_ids = {name: meta[name]["file_id"] for name in dated if meta.get(name, {}).get("file_id")}
+        cached = (stamp, [k for k, _ in rows], [n for _, n in rows], file_ids)
+        self._entries[cat_key] = cached
+        return cached
+
+    def invalidate(self, cat_key: str):
+        self._entries.pop(cat_key, None)
+
+    def count(self, cat_key: str) -> int:
+        return len(self._load(cat_key)[1])
+
+    def names(self, cat_key: str):
+        return list(self._load(cat_key)[2])
+
+    def source(self, cat_key: str, name: str):
+        """What to pass to send_document: the cached file_id, else the local path, else None."""
+        file_id = self._load(cat_key)[3].get(name)
+        if file_id:
+            return file_id
+        path = category_folder(cat_key) / name
+        return InputFile(str(path)) if path.is_file() else None
+
+    @staticmethod
+    def _encode(key) -> str:
+        return f"{-key[0]}.{key[1]:x}"
+
+    @staticmethod
+    def _decode(cursor: str):
+        mtime_us, crc = cursor.split(".", 1)
+        return (-int(mtime_us), int(crc, 16))
+
+    def page(self, cat_key: str, cursor: Optional[str] = None, backwards: bool = False, size: int = PAGE_SIZE):
+        """Return (names, prev_cursor, next_cursor); cursors are None at either end.
+
+        With backwards=False the page starts just after `cursor`; with
+        backwards=True it ends just before it.
+        """
+        _, keys, names, _ = self._load(cat_key)
+        try:
+            key = self._decode(cursor) if cursor else None
+        except ValueError:
+            key = None
+        if key is None:
+            start = 0
+        elif backwards:
+            start = max(0, bisect.bisect_left(keys, key) - size)
+        else:
+            start = bisect.bisect_right(keys, key)
+        end = min(len(keys), start + size)
+        prev_cursor = self._encode(keys[start]) if start > 0 else None
+        next_cursor = self._encode(keys[end - 1]) if end < len(keys) else None
+        return names[start:end], prev_cursor, next_cursor
+
+
+category_index = CategoryIndex()
 
 
 def list_category_files(cat_key: str):
     folder = category_folder(cat_key)
-    files = [f for f in folder.iterdir() if f.is_file() and f.name != "metadata.json"]
-    return sorted(files, key=lambda x: x.stat().st_mtime, reverse=True)
+    return [folder / name for name in category_index.names(cat_key)]
+
+
+class DownloadStats:
+    """Per-file download counters in ACTIVITY_DB, bumped in memory and written in batches.
+
+    Counters are kept out of metadata.json so that a flush never touches the
+    category folders (whose mtime stamps CategoryIndex and CatalogSearch).
+    All workers add to the same table, and the leaderboard is read from it
+    through idx_file_downloads_count, so it covers every worker's downloads.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._db = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.pending = Counter()
+        self.forgotten = set()
+
+    def _conn(self) -> sqlite3.Connection:
+        if self._db is None or self._pid != os.getpid():
+            db = sqlite3.connect(str(self.path), timeout=10, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS file_downloads (
+                    category TEXT NOT NULL, name TEXT NOT NULL, downloads INTEGER NOT NULL,
+                    PRIMARY KEY (category, name)
+                );
+                CREATE INDEX IF NOT EXISTS idx_file_downloads_count ON file_downloads (downloads);
+            """)
+            self._db, self._pid = db, os.getpid()
+            self._migrate_metadata(db)
+        return self._db
+
+    def _migrate_metadata(self, db: sqlite3.Connection):
+        # One-time import of the counters older versions kept in metadata.json
+        if db.execute("SELECT 1 FROM file_downloads LIMIT 1").fetchone():
+            return
+        rows = [(cat, name, info["downloads"]) for cat in CATEGORIES
+                for name, info in load_metadata(cat).items() if info.get("downloads")]
+        db.execute("BEGIN IMMEDIATE")
+        db.executemany("INSERT OR IGNORE INTO file_downloads (category, name, downloads) VALUES (?, ?, ?)", rows)
+        db.execute("COMMIT")
+
+    def record(self, cat: str, name: str):
+        self.pending[(cat, name)] += 1
+
+    def forget(self, cat: str, name: str):
+        """File deleted or replaced: its count starts over."""
+        self.pending.pop((cat, name), None)
+        self.forgotten.add((cat, name))
+
+    def counts(self, cat: str) -> Dict[str, int]:
+        """name -> downloads for one category, including this process's unwritten bumps."""
+        with self._lock:
+            rows = self._conn().execute(
+                "SELECT name, downloads FROM file_downloads WHERE category = ?", (cat,)).fetchall()
+        counts = {name: n for name, n in rows if (cat, name) not in self.forgotten}
+        for (c, name), n in self.pending.items():
+            if c == cat:
+                counts[name] = counts.get(name, 0) + n
+        return counts
+
+    def top(self, n: int = 10):
+        """Most downloaded files of all workers as (cat, name, count), read from the index."""
+        with self._lock:
+            rows = self._conn().execute(
+                "SELECT category, name, downloads FROM file_downloads ORDER BY downloads DESC LIMIT ?",
+                (n + len(self.forgotten),)).fetchall()
+        return [row for row in rows if (row[0], row[1]) not in self.forgotten][:n]
+
+    def take_pending(self):
+        pending, forgotten = self.pending, self.forgotten
+        self.pending, self.forgotten = Counter(), set()
+        return pending, forgotten
+
+    def write(self, pending):
+        """Apply forgets, then add the pending counts, in one transaction."""
+        counts, forgotten = pending
+        if not counts and not forgotten:
+            return
+        with self._lock:
+            db = self._conn()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.executemany("DELETE FROM file_downloads WHERE category = ? AND name = ?", sorted(forgotten))
+                db.executemany("""
+                    INSERT INTO file_downloads (category, name, downloads) VALUES (?, ?, ?)
+                    ON CONFLICT (category, name) DO UPDATE SET downloads = downloads + excluded.downloads
+                """, [(cat, name, n) for (cat, name), n in counts.items()])
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
 
+    def flush(self):
+        self.write(self.take_pending())
 
-def register_user(user_id: int, username: Optional[str]):
-    try:
-        data = json.loads(USERS_JSON.read_text())
-    except Exception:
-        data = {}
-    sid = str(user_id)
-    if sid not in data:
-        data[sid] = {"username": username or "", "first_seen": int(time.time())}
-        USERS_JSON.write_text(json.dumps(data))
 
+download_stats = DownloadStats(ACTIVITY_DB)
 
-def get_all_users():
-    try:
-        data = json.loads(USERS_JSON.read_text())
-        return list(data.keys())
-    except Exception:
-        return []
+
+def register_user(user_id: int, username: Optional[str]):
+    user_store.register(user_id, username)
 
 
 def is_admin_session(uid: int) -> bool:
@@ -177,12 +1210,52 @@ def is_admin_session(uid: int) -> bool:
 
 
 def start_admin_session(uid: int, minutes: int = 120):
-    admin_sessions[uid] = time.time() + minutes * 60
+    admin_sessions.set(uid, time.time() + minutes * 60, ttl=minutes * 60)
 
 
 # ---------------------------
 # UI builders
 # ---------------------------
+PROFILE_TEMPLATE = "👤 User Profile\\n\\nID: {uid}\\nUsername: @{username}\\nFirst seen: {first_seen}"
+ME_TEMPLATE = "👤 Profile\\nID: {uid}\\nUsername: @{username}\\nFirst seen: {first_seen}"
+
+# parse_mode="Markdown" texts take values only through md_escape() / md_code()
+MD_ESCAPE = str.maketrans({ch: "\\\\" + ch for ch in "_*`["})
+
+
+def md_escape(text) -> str:
+    """Escape a value placed outside Markdown entities."""
+    return str(text).translate(MD_ESCAPE)
+
+
+def md_code(text) -> str:
+    """A value as a `code` span; values a span can't hold (backticks, empty) are escaped instead."""
+    text = str(text)
+    if text and "`" not in text:
+        return f"`{text}`"
+    return text.translate(MD_ESCAPE)
+
+
+@functools.lru_cache(maxsize=4096)
+def format_timestamp(ts: Optional[int]) -> str:
+    if not ts:
+        return "n/a"
+    return datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m-%d %H:%M UTC")
+
+
+@functools.lru_cache(maxsize=4096)
+def render_profile(template: str, uid: str, username: str, first_seen: Optional[int]) -> str:
+    """Profile text; the username is escaped once per (user, username) and reused."""
+    return template.format(uid=md_code(uid), username=md_escape(username), first_seen=format_timestamp(first_seen))
+
+
+def user_profile(uid: str, template: str = PROFILE_TEMPLATE) -> str:
+    info = user_store.get(int(uid))
+    return render_profile(template, uid, info.get("username", ""), info.get("first_seen"))
+
+
+# markups are immutable, so the menu is built once and shared
+@functools.lru_cache(maxsize=None)
 def build_main_menu():
     keyboard = [
         [InlineKeyboardButton("DTAC", callback_data="menu_dtac")],
@@ -196,12 +1269,680 @@ def build_main_menu():
     return InlineKeyboardMarkup(keyboard)
 
 
+def build_category_page(cat: str, names, prev_cursor: Optional[str], next_cursor: Optional[str]):
+    kb = []
+    for name in names:
+        token = safe_encode_filename(name)
+        kb.append([InlineKeyboardButton(name if len(name) <= 30 else name[:27] + "...", callback_data=f"getfile:{cat}:{token}")])
+    nav = []
+    if prev_cursor:
+        nav.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"catp:{cat}:p:{prev_cursor}"))
+    if next_cursor:
+        nav.append(InlineKeyboardButton("Next ➡️", callback_data=f"catp:{cat}:n:{next_cursor}"))
+    if nav:
+        kb.append(nav)
+    total = category_index.count(cat)
+    if total > 1:
+        kb.append([InlineKeyboardButton(f"📦 Send all ({total})", callback_data=f"sendall:{cat}")])
+    kb.append([InlineKeyboardButton("🔙 Back", callback_data="back_main")])
+    text = f"Select a file from {CATEGORIES.get(cat)} ({total} total):"
+    return text, InlineKeyboardMarkup(kb)
+
+
+class RenderCache:
+    """Digest of the last text + markup rendered into each message, LRU-bounded."""
+
+    def __init__(self, max_entries: int = RENDER_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._digests = OrderedDict()
+        self.skipped = 0
+
+    @staticmethod
+    def digest(text: str, reply_markup=None, **kwargs) -> bytes:
+        markup = reply_markup.to_dict() if reply_markup is not None else None
+        payload = json.dumps([text, markup, kwargs], sort_keys=True, default=str)
+        return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).digest()
+
+    def unchanged(self, key, digest: bytes) -> bool:
+        if self._digests.get(key) == digest:
+            self._digests.move_to_end(key)
+            return True
+        return False
+
+    def store(self, key, digest: bytes):
+        self._digests[key] = digest
+        self._digests.move_to_end(key)
+        while len(self._digests) > self.max_entries:
+            self._digests.popitem(last=False)
+
+    def discard(self, key):
+        self._digests.pop(key, None)
+
+
+render_cache = RenderCache()
+
+
+async def safe_edit(query, text: str, reply_markup=None, **kwargs):
+    """edit_message_text that skips the API call when the message would not change.
+
+    Messages are keyed by (chat_id, message_id), or inline_message_id for
+    inline messages; a chat is always served by one worker, so the in-process
+    cache sees every edit of its messages.
+    """
+    if query.message:
+        key = (query.message.chat_id, query.message.message_id)
+    else:
+        key = query.inline_message_id
+    return await cached_edit(key, query.edit_message_text, text, reply_markup=reply_markup, **kwargs)
+
+
+async def cached_edit(key, edit, text: str, reply_markup=None, **kwargs):
+    """Call edit(text, ...) unless render_cache says message `key` already shows it."""
+    digest = RenderCache.digest(text, reply_markup, **kwargs)
+    if render_cache.unchanged(key, digest):
+        render_cache.skipped += 1
+        return None
+    try:
+        result = await edit(text, reply_markup=reply_markup, **kwargs)
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+        result = None
+    render_cache.store(key, digest)
+    return result
+
+
+MENU_TEXT = "မင်္ဂလာပါ! လိုချင်တဲ့ service ကို ရွေးပါ။"
+
+# Last menu message per chat: chat_id -> {"id": message_id, "at": ts}
+menu_anchors: Dict[int, dict] = per_user_state("menu_anchor", ttl=86400)
+
+
 # Helper to send main menu (used by handlers and catch-all)
-async def send_main_menu(chat_id: int, context: ContextTypes.DEFAULT_TYPE, text: str = "မင်္ဂလာပါ! လိုချင်တဲ့ service ကို ရွေးပါ။"):
+async def send_main_menu(chat_id: int, context: ContextTypes.DEFAULT_TYPE, text: str = MENU_TEXT):
+    activity.emit("menu", chat_id)
     try:
-        await context.bot.send_message(chat_id=chat_id, text=text, reply_markup=build_main_menu())
+        msg = await context.bot.send_message(chat_id=chat_id, text=text, reply_markup=build_main_menu())
     except Exception:
         logger.exception("Failed to send main menu to %s", chat_id)
+        return
+    menu_anchors[chat_id] = {"id": msg.message_id, "at": time.time()}
+    render_cache.store((chat_id, msg.message_id), RenderCache.digest(text, build_main_menu()))
+
+
+async def show_menu(chat_id: int, context: ContextTypes.DEFAULT_TYPE, after_message_id: int):
+    """Menu reply to a free-text message, reusing the chat's last menu where possible.
+
+    Within MENU_DEBOUNCE of the last menu nothing is sent. If the last menu
+    is still near the bottom of the chat (private chat message ids are
+    sequential) it is edited back to the main menu; only a scrolled-away or
+    deleted menu gets a new message. The edit skips render_cache: only
+    Telegram can tell us the user deleted the anchor.
+    """
+    anchor = menu_anchors.get(chat_id)
+    if anchor:
+        if time.time() - anchor["at"] < MENU_DEBOUNCE:
+            return
+        if after_message_id - anchor["id"] <= MENU_ANCHOR_GAP:
+            message_id = anchor["id"]
+            markup = build_main_menu()
+            try:
+                await context.bot.edit_message_text(MENU_TEXT, chat_id=chat_id, message_id=message_id, reply_markup=markup)
+                alive = True
+            except BadRequest as e:
+                alive = "not modified" in str(e).lower()
+            if alive:
+                render_cache.store((chat_id, message_id), RenderCache.digest(MENU_TEXT, markup))
+                activity.emit("menu", chat_id)
+                menu_anchors[chat_id] = {"id": message_id, "at": time.time()}
+                return
+            # deleted by the user (or too old to edit): forget it and send a fresh one
+            menu_anchors.pop(chat_id, None)
+            render_cache.discard((chat_id, message_id))
+    await send_main_menu(chat_id=chat_id, context=context)
+
+
+# ---------------------------
+# Diagnostics (BOT_DIAGNOSTICS=1)
+# ---------------------------
+class Diagnostics:
+    """Measures event-loop lag and records stack samples of slow handlers.
+
+    Two probes feed the same call-site table:
+    - a watchdog thread samples the loop thread's stack while the loop is
+      blocked (sync file I/O, sqlite, CPU work inside a handler)
+    - profiled() handlers that are still awaiting after the threshold get
+      their coroutine chain sampled (slow network calls, long sleeps)
+    """
+
+    def __init__(self, interval: float, threshold: float):
+        self.interval = interval
+        self.threshold = threshold
+        self.lags = deque(maxlen=1200)
+        self.max_lag = 0.0
+        self.site_hits = Counter()
+        self.site_seconds = defaultdict(float)
+        self.slow_handlers = Counter()
+        self._lock = threading.Lock()
+        self._beat = time.monotonic()
+        self._loop_thread = None
+        self._own_file = Diagnostics.record.__code__.co_filename
+
+    async def lag_loop(self):
+        """Heartbeat task: the overshoot of each sleep is the loop lag."""
+        self._loop_thread = threading.get_ident()
+        threading.Thread(target=self._watchdog, name="diag-watchdog", daemon=True).start()
+        while True:
+            start = time.monotonic()
+            self._beat = start
+            await asyncio.sleep(self.interval)
+            lag = max(time.monotonic() - start - self.interval, 0.0)
+            self.lags.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+            if lag >= self.threshold:
+                logger.warning("event loop lag %.3fs", lag)
+
+    def _watchdog(self):
+        stalled_since = None
+        while True:
+            time.sleep(self.interval / 2)
+            stalled = time.monotonic() - self._beat > self.interval + self.threshold
+            if stalled and stalled_since != self._beat:
+                # one sample per stall, taken while the loop is still blocked
+                stalled_since = self._beat
+                frame = sys._current_frames().get(self._loop_thread)
+                if frame is not None:
+                    self.record(traceback.extract_stack(frame), self.threshold)
+
+    def record(self, stack: traceback.StackSummary, seconds: float):
+        """Attribute `seconds` to the innermost bot frame plus the leaf call."""
+        if not stack:
+            return
+        own = [f for f in stack if f.filename == self._own_file]
+        leaf = stack[-1]
+        site = f"{leaf.name} ({Path(leaf.filename).name}:{leaf.lineno})"
+        if own and own[-1] is not leaf:
+            site = f"{own[-1].name}:{own[-1].lineno} -> {site}"
+        with self._lock:
+            self.site_hits[site] += 1
+            self.site_seconds[site] += seconds
+
+    @staticmethod
+    def _coro_stack(task: asyncio.Task) -> traceback.StackSummary:
+        frames = []
+        coro = task.get_coro()
+        while coro is not None:
+            frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+            if frame is None:
+                break
+            frames.append((frame, frame.f_lineno))
+            coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+        return traceback.StackSummary.extract(frames, lookup_lines=False)
+
+    def profiled(self, handler):
+        """Wrap a PTB callback; samples its await chain once it runs too long."""
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            task = asyncio.current_task()
+            samples = []
+            timer = asyncio.get_running_loop().call_later(
+                self.threshold, lambda: samples.append(self._coro_stack(task)))
+            start = time.monotonic()
+            try:
+                return await handler(update, context)
+            finally:
+                timer.cancel()
+                elapsed = time.monotonic() - start
+                if elapsed >= self.threshold:
+                    with self._lock:
+                        self.slow_handlers[handler.__name__] += 1
+                    if samples:
+                        self.record(samples[0], elapsed)
+                    logger.warning("slow handler %s took %.3fs", handler.__name__, elapsed)
+        return wrapper
+
+    def report(self, top: int = 10) -> str:
+        lags = sorted(self.lags)
+        if lags:
+            avg = sum(lags) / len(lags)
+            p95 = lags[min(len(lags) - 1, int(len(lags) * 0.95))]
+            lines = [f"Loop lag: avg {avg * 1000:.1f}ms, p95 {p95 * 1000:.1f}ms, max {self.max_lag * 1000:.1f}ms"]
+        else:
+            lines = ["Loop lag: no samples yet"]
+        with self._lock:
+            sites = sorted(self.site_seconds.items(), key=lambda kv: kv[1], reverse=True)[:top]
+            handlers = self.slow_handlers.most_common(top)
+            hits = dict(self.site_hits)
+        lines.append("")
+        lines.append(f"Top slow call sites (>= {self.threshold:.1f}s):")
+        if not sites:
+            lines.append("none")
+        for site, secs in sites:
+            lines.append(f"{hits[site]}x {secs:.2f}s  {site[:120]}")
+        if handlers:
+            lines.append("")
+            lines.append("Slow handlers:")
+            lines.extend(f"{count}x {name}" for name, count in handlers)
+        return "\\n".join(lines)
+
+
+diagnostics: Optional[Diagnostics] = Diagnostics(DIAG_LAG_INTERVAL, DIAG_SLOW_SECONDS) if DIAGNOSTICS else None
+
+
+def instrument(handler):
+    """Profile handler when diagnostics mode is on, otherwise return it as-is."""
+    return diagnostics.profiled(handler) if diagnostics else handler
+
+
+# ---------------------------
+# Inline search
+# ---------------------------
+class SearchIndex:
+    """In-memory prefix + trigram index over short titles.
+
+    Every word prefix (up to PREFIX_MAX chars) maps to the documents holding
+    it, so "dt" or "zivpn" is one dict lookup; longer query words that are not
+    a word prefix fall back to intersecting trigram sets and a substring check.
+    All query words must match; word-prefix hits rank above substring hits.
+    """
+
+    PREFIX_MAX = 12
+
+    def __init__(self):
+        self.docs = []  # (lowercased text, title length, payload)
+        self.prefixes = defaultdict(set)
+        self.trigrams = defaultdict(set)
+
+    @staticmethod
+    def words(text: str):
+        return [w for w in re.split(r"[^\\w]+", text.lower()) if w]
+
+    def add(self, title: str, payload, keywords: str = ""):
+        doc_id = len(self.docs)
+        text = f"{title} {keywords}".lower()
+        self.docs.append((text, len(title), payload))
+        for word in self.words(text):
+            for i in range(1, min(len(word), self.PREFIX_MAX) + 1):
+                self.prefixes[word[:i]].add(doc_id)
+        for i in range(len(text) - 2):
+            self.trigrams[text[i:i + 3]].add(doc_id)
+
+    def _substring(self, word: str):
+        if len(word) < 3:
+            return set()
+        ids = None
+        for i in range(len(word) - 2):
+            hits = self.trigrams.get(word[i:i + 3])
+            if not hits:
+                return set()
+            ids = set(hits) if ids is None else ids & hits
+        return {d for d in ids if word in self.docs[d][0]}
+
+    def search(self, query: str, limit: int = INLINE_MAX_RESULTS):
+        words = self.words(query)
+        if not words:
+            return [payload for _, _, payload in self.docs[:limit]]
+        candidates = None
+        prefix_hits = Counter()
+        for word in words:
+            by_prefix = self.prefixes.get(word, set()) if len(word) <= self.PREFIX_MAX else set()
+            prefix_hits.update(by_prefix)
+            ids = by_prefix | self._substring(word)
+            candidates = ids if candidates is None else candidates & ids
+            if not candidates:
+                return []
+        ranked = sorted(candidates, key=lambda d: (-prefix_hits[d], self.docs[d][1], d))
+        return [self.docs[d][2] for d in ranked[:limit]]
+
+
+class CatalogSearch:
+    """SearchIndex over CATEGORIES and their files, rebuilt when a category folder changes."""
+
+    def __init__(self):
+        self._stamp = None
+        self._index = SearchIndex()
+
+    def index(self) -> SearchIndex:
+        stamp = tuple(category_folder(k).stat().st_mtime_ns for k in CATEGORIES)
+        if stamp != self._stamp:
+            index = SearchIndex()
+            for key, label in CATEGORIES.items():
+                index.add(label, ("cat", key, None, None), keywords=key.replace("_", " "))
+            for key, label in CATEGORIES.items():
+                meta = load_metadata(key)
+                for name in category_index.names(key):
+                    index.add(name, ("file", key, name, meta.get(name, {}).get("file_id")), keywords=label)
+            self._index, self._stamp = index, stamp
+        return self._index
+
+
+catalog_search = CatalogSearch()
+
+
+async def inline_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.inline_query
+    activity.emit("inline", query.from_user.id)
+    results = []
+    for kind, cat, name, file_id in catalog_search.index().search(query.query):
+        label = CATEGORIES.get(cat, cat)
+        result_id = f"{kind}:{zlib.crc32(f'{cat}/{name}'.encode('utf-8')):x}"
+        if kind == "file" and file_id:
+            results.append(InlineQueryResultCachedDocument(
+                id=result_id, title=name, document_file_id=file_id, description=label, caption=label))
+            continue
+        link = f"https://t.me/{context.bot.username}?start=cat_{cat}"
+        title = name if kind == "file" else label
+        description = label if kind == "file" else f"{category_index.count(cat)} file(s)"
+        results.append(InlineQueryResultArticle(
+            id=result_id, title=title, description=description,
+            input_message_content=InputTextMessageContent(f"{title}\\n{link}"),
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("📂 Open", url=link)]])))
+    await query.answer(results, cache_time=INLINE_CACHE_TIME)
+
+
+# ---------------------------
+# Throttling (per-user token buckets)
+# ---------------------------
+class Throttle:
+    """Token bucket per user: `burst` actions at once, refilled at `rate` per second.
+
+    Buckets live in an OrderedDict kept in last-use order, so idle users are
+    evicted from the front in O(1); an evicted bucket would be full anyway.
+    """
+
+    def __init__(self, rate: float, burst: float, ttl: float = 600):
+        self.rate = rate
+        self.burst = burst
+        self.ttl = max(ttl, burst / rate)
+        self.buckets: "OrderedDict[int, tuple]" = OrderedDict()  # user_id -> (tokens, last_ts)
+        self.hits = 0
+
+    def _tokens(self, user_id: int, now: float) -> float:
+        tokens, last = self.buckets.get(user_id, (self.burst, now))
+        return min(self.burst, tokens + (now - last) * self.rate)
+
+    def allow(self, user_id: int) -> bool:
+        now = time.monotonic()
+        tokens = self._tokens(user_id, now)
+        allowed = tokens >= 1
+        if not allowed:
+            self.hits += 1
+        self.buckets.pop(user_id, None)
+        self.buckets[user_id] = (tokens - 1 if allowed else tokens, now)
+        while self.buckets:
+            oldest, (_, last) = next(iter(self.buckets.items()))
+            if now - last < self.ttl:
+                break
+            del self.buckets[oldest]
+        return allowed
+
+    def wait(self, user_id: int) -> float:
+        """Seconds until the user has a token again."""
+        return max(0.0, (1 - self._tokens(user_id, time.monotonic())) / self.rate)
+
+
+menu_throttle = Throttle(MENU_RATE, MENU_BURST)
+callback_throttle = Throttle(CALLBACK_RATE, CALLBACK_BURST)
+deferred_menus = set()  # chat ids with a coalesced menu already scheduled
+
+
+async def deferred_menu(chat_id: int, context: ContextTypes.DEFAULT_TYPE, after_message_id: int):
+    """One menu for a burst of throttled messages, shown once the bucket refills."""
+    try:
+        await asyncio.sleep(menu_throttle.wait(chat_id))
+        if menu_throttle.allow(chat_id):
+            await show_menu(chat_id, context, after_message_id)
+    finally:
+        deferred_menus.discard(chat_id)
+
+
+# ---------------------------
+# Delivery (albums under a global send limiter)
+# ---------------------------
+class SendLimiter:
+    """Outbound pacing: at most `concurrency` sends in flight, `rate` messages/second
+    bot-wide, and one send per CHAT_SEND_INTERVAL to any single chat.
+
+    An album counts as one message per item toward the bot-wide rate. The
+    per-chat wait happens before taking a bot-wide slot, so one chat's
+    queue never holds up deliveries to other chats.
+    """
+
+    def __init__(self, rate: float, concurrency: int, chat_interval: float = CHAT_SEND_INTERVAL):
+        self.rate = rate
+        self.concurrency = concurrency
+        self.chat_interval = chat_interval
+        self.next_at = 0.0
+        self.chat_next: Dict[int, float] = {}
+        self._sem: Optional[asyncio.Semaphore] = None
+
+    def defer_chat(self, chat_id: int, seconds: float):
+        """Push the chat's next send back, e.g. after a RetryAfter."""
+        self.chat_next[chat_id] = max(self.chat_next.get(chat_id, 0.0), time.monotonic() + seconds)
+
+    @asynccontextmanager
+    async def slot(self, cost: int = 1, chat_id: Optional[int] = None):
+        if chat_id is not None:
+            now = time.monotonic()
+            if len(self.chat_next) > 10_000:
+                self.chat_next = {c: t for c, t in self.chat_next.items() if t > now}
+            start = max(now, self.chat_next.get(chat_id, 0.0))
+            self.chat_next[chat_id] = start + self.chat_interval
+            if start > now:
+                await asyncio.sleep(start - now)
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.concurrency)
+        async with self._sem:
+            now = time.monotonic()
+            start = max(now, self.next_at)
+            self.next_at = start + cost / self.rate
+            if start > now:
+                await asyncio.sleep(start - now)
+            yield
+
+
+send_limiter = SendLimiter(SEND_RATE, SEND_CONCURRENCY)
+
+
+async def send_category_files(bot, chat_id: int, cat: str) -> list:
+    """Send every current file of `cat` as document albums of up to ALBUM_SIZE.
+
+    Albums are queued together and paced by send_limiter (per chat and
+    bot-wide); a RetryAfter delays the chat and retries the album.
+    Files with a cached file_id are not re-uploaded; ids Telegram assigns to
+    the others are saved back to metadata for next time. Returns the names sent.
+    """
+    folder = category_folder(cat)
+    names = category_index.names(cat)
+    meta = load_metadata(cat)
+    label = CATEGORIES.get(cat, cat)
+
+    def source(name: str):
+        return meta.get(name, {}).get("file_id") or folder / name
+
+    async def send(chunk):
+        for attempt in range(BROADCAST_RETRIES + 1):
+            try:
+                async with send_limiter.slot(len(chunk), chat_id):
+                    if len(chunk) == 1:
+                        return chunk, [await bot.send_document(chat_id, source(chunk[0]), filename=chunk[0], caption=label)]
+                    media = [InputMediaDocument(source(name), filename=name, caption=label if i == 0 else None)
+                             for i, name in enumerate(chunk)]
+                    return chunk, await bot.send_media_group(chat_id, media)
+            except RetryAfter as e:
+                if attempt == BROADCAST_RETRIES:
+                    raise
+                send_limiter.defer_chat(chat_id, e.retry_after)
+
+    chunks = [names[i:i + ALBUM_SIZE] for i in range(0, len(names), ALBUM_SIZE)]
+    results = await asyncio.gather(*(send(chunk) for chunk in chunks), return_exceptions=True)
+    sent, learned = [], {}
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error("album to %s failed: %s", chat_id, result)
+            continue
+        chunk, messages = result
+        sent.extend(chunk)
+        for name, msg in zip(chunk, messages):
+            if msg.document and not meta.get(name, {}).get("file_id"):
+                learned[name] = msg.document.file_id
+    if learned:
+        with file_lock(folder / "metadata.json"):
+            meta = load_metadata(cat)
+            for name, file_id in learned.items():
+                if name in meta:
+                    meta[name]["file_id"] = file_id
+            save_metadata(cat, meta)
+    return sent
+
+
+sending_all: set = set()  # chats with a "Send all" delivery in progress
+
+
+async def send_all_task(bot, query, cat: str):
+    """Background "Send all": deliver the files, record the downloads and restore the menu."""
+    try:
+        sent = await send_category_files(bot, query.message.chat_id, cat)
+    finally:
+        sending_all.discard(query.message.chat_id)
+    for name in sent:
+        download_stats.record(cat, name)
+    user_store.record_download(query.from_user.id, cat)
+    activity.emit("download", query.from_user.id, cat)
+    await safe_edit(query, f"Sent {len(sent)} of {category_index.count(cat)} files from {CATEGORIES[cat]}.",
+                    reply_markup=build_main_menu())
+
+
+# ---------------------------
+# Uploads (multi-file, bounded worker pool)
+# ---------------------------
+class UploadBatch:
+    """One admin's multi-file upload session and its live progress message."""
+
+    def __init__(self, chat_id: int, cat: str):
+        self.chat_id = chat_id
+        self.cat = cat
+        self.queued = self.done = self.failed = 0
+        self.recent = deque(maxlen=5)
+        self.message_id: Optional[int] = None
+        self.closed = False
+        self.last_edit = 0.0
+        self.refresh_task: Optional[asyncio.Task] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.closed and self.done + self.failed == self.queued
+
+    def render(self):
+        lines = [f"Uploading to {CATEGORIES.get(self.cat, self.cat)}",
+                 f"{self.done}/{self.queued} saved, {self.failed} failed"]
+        lines += list(self.recent)
+        if self.finished:
+            return "\\n".join(lines + ["Upload finished."]), None
+        if self.closed:
+            return "\\n".join(lines + ["Finishing queued files..."]), None
+        lines.append("Send more documents (caption expiry:7 to expire), then tap Done or /done.")
+        return "\\n".join(lines), InlineKeyboardMarkup([[InlineKeyboardButton("✅ Done", callback_data="upload_done")]])
+
+
+upload_batches: Dict[int, UploadBatch] = {}  # admin_id -> open or draining batch
+upload_queue: Optional[asyncio.Queue] = None
+
+
+def save_upload(cat: str, name: str, doc, expiry_days: int):
+    """Record one uploaded file; the lock makes concurrent workers' read-modify-writes atomic."""
+    expiry_ts = int(time.time()) + expiry_days * 86400 if expiry_days else 0
+    with file_lock(category_folder(cat) / "metadata.json"):
+        meta = load_metadata(cat)
+        meta[name] = {"uploaded_at": int(time.time()), "expiry_ts": expiry_ts, "file_id": doc.file_id,
+                      "file_unique_id": doc.file_unique_id, "size": doc.file_size or 0}
+        save_metadata(cat, meta)
+    download_stats.forget(cat, name)
+    category_index.invalidate(cat)  # an overwrite keeps the folder mtime but moves the file up
+
+
+async def store_upload(bot, cat: str, doc, caption: str) -> str:
+    fname = doc.file_name or doc.file_id
+    safe = "".join(c for c in fname if c.isalnum() or c in "._- ")
+    out = category_folder(cat) / safe
+    if STORAGE_MODE != "file_id":
+        part = out.with_name(f".{out.name}.{os.getpid()}.part")
+        tgfile = await bot.get_file(doc.file_id)
+        try:
+            await tgfile.download_to_drive(str(part))
+            os.replace(part, out)  # listings never see a half-written file
+        finally:
+            part.unlink(missing_ok=True)
+    elif out.exists():
+        out.unlink()  # a stale mirror copy must not outlive the new upload
+    expiry_days = 0
+    if caption.lower().startswith("expiry:"):
+        try:
+            expiry_days = int(caption.split(":", 1)[1].strip())
+        except ValueError:
+            expiry_days = 0
+    await asyncio.get_running_loop().run_in_executor(None, save_upload, cat, out.name, doc, expiry_days)
+    return out.name
+
+
+async def refresh_upload_progress(bot, batch: UploadBatch):
+    """Edit the progress message, at most once per UPLOAD_PROGRESS_INTERVAL."""
+    await asyncio.sleep(max(0.0, batch.last_edit + UPLOAD_PROGRESS_INTERVAL - time.monotonic()))
+    batch.refresh_task = None
+    batch.last_edit = time.monotonic()
+    text, markup = batch.render()
+    edit = functools.partial(bot.edit_message_text, chat_id=batch.chat_id, message_id=batch.message_id)
+    try:
+        await cached_edit((batch.chat_id, batch.message_id), edit, text, reply_markup=markup)
+    except Exception:
+        logger.exception("upload progress edit failed")
+
+
+def schedule_progress(bot, batch: UploadBatch):
+    if batch.message_id is not None and batch.refresh_task is None:
+        batch.refresh_task = asyncio.get_running_loop().create_task(refresh_upload_progress(bot, batch))
+
+
+async def upload_worker(bot, queue: asyncio.Queue):
+    while True:
+        uid, batch, doc, caption = await queue.get()
+        try:
+            name = await store_upload(bot, batch.cat, doc, caption)
+            batch.done += 1
+            batch.recent.append(f"✅ {name}")
+        except Exception:
+            logger.exception("upload of %s failed", doc.file_name)
+            batch.failed += 1
+            batch.recent.append(f"❌ {doc.file_name or doc.file_id}")
+        finally:
+            queue.task_done()
+        if batch.finished and upload_batches.get(uid) is batch:
+            del upload_batches[uid]
+        schedule_progress(bot, batch)
+
+
+def enqueue_upload(application, uid: int, batch: UploadBatch, doc, caption: str):
+    """Queue one document; the pool of UPLOAD_WORKERS is started on first use."""
+    global upload_queue
+    if upload_queue is None:
+        upload_queue = asyncio.Queue()
+        for _ in range(UPLOAD_WORKERS):
+            application.create_task(upload_worker(application.bot, upload_queue))
+    batch.queued += 1
+    upload_queue.put_nowait((uid, batch, doc, caption))
+
+
+async def finish_upload(bot, uid: int) -> bool:
+    """Close the admin's upload session; queued files still complete."""
+    upload_state.pop(uid, None)
+    batch = upload_batches.get(uid)
+    if not batch:
+        return False
+    batch.closed = True
+    if batch.finished:
+        del upload_batches[uid]
+    schedule_progress(bot, batch)
+    return True
 
 
 # ---------------------------
@@ -212,33 +1953,78 @@ async def cleanup_expired_loop(app):
     while True:
         try:
             for cat in list(CATEGORIES.keys()):
-                meta = load_metadata(cat)
-                changed = False
-                for fname, info in list(meta.items()):
-                    exp_ts = info.get("expiry_ts", 0)
-                    if exp_ts and time.time() >= exp_ts:
-                        fpath = category_folder(cat) / fname
-                        if fpath.exists():
-                            try:
-                                fpath.unlink()
-                                logger.info("Deleted expired file %s", fpath)
-                            except Exception:
-                                logger.exception("Failed to delete %s", fpath)
-                        meta.pop(fname, None)
-                        changed = True
-                if changed:
-                    save_metadata(cat, meta)
+                # same lock as save_upload, so an upload saved meanwhile is not overwritten
+                with file_lock(category_folder(cat) / "metadata.json"):
+                    meta = load_metadata(cat)
+                    changed = False
+                    for fname, info in list(meta.items()):
+                        exp_ts = info.get("expiry_ts", 0)
+                        if exp_ts and time.time() >= exp_ts:
+                            fpath = category_folder(cat) / fname
+                            if fpath.exists():
+                                try:
+                                    fpath.unlink()
+                                    logger.info("Deleted expired file %s", fpath)
+                                except Exception:
+                                    logger.exception("Failed to delete %s", fpath)
+                            meta.pop(fname, None)
+                            download_stats.forget(cat, fname)
+                            changed = True
+                    if changed:
+                        save_metadata(cat, meta)
         except Exception:
             logger.exception("cleanup loop error")
         await asyncio.sleep(3600)
 
 
+async def mirror_loop(app):
+    """STORAGE_MODE=file_id with MIRROR_FILES=1: keep a local copy of every stored file.
+
+    Only a backup; sends and listings never depend on it. The Bot API's
+    getFile refuses files over 20 MB, so those stay Telegram-only.
+    """
+    skipped = set()
+    while True:
+        try:
+            for cat in CATEGORIES:
+                folder = category_folder(cat)
+                for name, info in load_metadata(cat).items():
+                    out = folder / name
+                    if not info.get("file_id") or out.exists() or (cat, name) in skipped:
+                        continue
+                    if info.get("size", 0) > MIRROR_MAX_BYTES:
+                        skipped.add((cat, name))
+                        logger.info("Not mirroring %s/%s: larger than getFile allows", cat, name)
+                        continue
+                    part = out.with_name(f".{name}.{os.getpid()}.part")
+                    try:
+                        tgfile = await app.bot.get_file(info["file_id"])
+                        await tgfile.download_to_drive(str(part))
+                        os.replace(part, out)
+                    except Exception:
+                        logger.exception("mirror of %s/%s failed", cat, name)
+                    finally:
+                        part.unlink(missing_ok=True)
+                    await asyncio.sleep(DELAY_BETWEEN)
+        except Exception:
+            logger.exception("mirror loop error")
+        await asyncio.sleep(MIRROR_INTERVAL)
+
+
 # ---------------------------
 # Handlers
 # ---------------------------
 async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     register_user(user.id, user.username)
+    # deep link from an inline result: /start cat_<key> opens that category
+    arg = context.args[0] if context.args else ""
+    if update.message and arg.startswith("cat_") and arg[4:] in CATEGORIES:
+        cat = arg[4:]
+        names, prev_cursor, next_cursor = category_index.page(cat)
+        if names:
+            text, markup = build_category_page(cat, names, prev_cursor, next_cursor)
+            return await update.message.reply_text(text, reply_markup=markup)
     # send menu (reply if invoked via /start, else as message)
     try:
         if update.message:
@@ -251,12 +2037,15 @@ async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
+    if not is_admin_session(query.from_user.id) and not callback_throttle.allow(query.from_user.id):
+        await query.answer("Too many taps, please slow down.")
+        return
     await query.answer()
     data = query.data or ""
 
     # Navigation
     if data == "menu_dtac":
-        await query.edit_message_text("DTAC အပိုင်း — ရွေးပါ:", reply_markup=InlineKeyboardMarkup([
+        await safe_edit(query, "DTAC အပိုင်း — ရွေးပါ:", reply_markup=InlineKeyboardMarkup([
             [InlineKeyboardButton("DTAC GAME PLAN", callback_data="cat:dtac_game_plan")],
             [InlineKeyboardButton("DTAC ZIVPN", callback_data="cat:dtac_zivpn")],
             [InlineKeyboardButton("DTAC NOPRO", callback_data="cat:dtac_nopro")],
@@ -265,7 +2054,7 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
         return
 
     if data == "menu_true":
-        await query.edit_message_text("TRUE အပိုင်း — ရွေးပါ:", reply_markup=InlineKeyboardMarkup([
+        await safe_edit(query, "TRUE အပိုင်း — ရွေးပါ:", reply_markup=InlineKeyboardMarkup([
             [InlineKeyboardButton("TRUE TWITTER PLAN", callback_data="cat:true_twitter")],
             [InlineKeyboardButton("TRUE VIBER PLAN", callback_data="cat:true_viber")],
             [InlineKeyboardButton("🔙 Back", callback_data="back_main")],
@@ -273,19 +2062,20 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
         return
 
     if data == "menu_ais":
-        await query.edit_message_text("AIS အပိုင်း — ရွေးပါ:", reply_markup=InlineKeyboardMarkup([
+        await safe_edit(query, "AIS အပိုင်း — ရွေးပါ:", reply_markup=InlineKeyboardMarkup([
             [InlineKeyboardButton("V2RAY 64KBPS", callback_data="cat:ais_v2ray_64")],
             [InlineKeyboardButton("🔙 Back", callback_data="back_main")],
         ]))
         return
 
     if data == "back_main":
-        await query.edit_message_text("Main menu:", reply_markup=build_main_menu())
+        activity.emit("menu", query.from_user.id)
+        await safe_edit(query, "Main menu:", reply_markup=build_main_menu())
         return
 
     # Contact Admin
     if data == "contact_admin":
-        await query.edit_message_text(f"📞 Contact Admin\\n\\n{ADMIN_USERNAME}", reply_markup=build_main_menu())
+        await safe_edit(query, f"📞 Contact Admin\\n\\n{ADMIN_USERNAME}", reply_markup=build_main_menu())
         return
 
     # Donate
@@ -293,30 +2083,24 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
         if TRUEMONEY_QR_PATH.exists():
             # send photo then menu
             await context.bot.send_photo(chat_id=query.message.chat_id, photo=InputFile(str(TRUEMONEY_QR_PATH)),
-                                         caption=f"TrueMoney: `{TRUEMONEY_NUMBER}`", parse_mode="Markdown")
-            await query.edit_message_text("Main menu:", reply_markup=build_main_menu())
+                                         caption=f"TrueMoney: {md_code(TRUEMONEY_NUMBER)}", parse_mode="Markdown")
+            await safe_edit(query, "Main menu:", reply_markup=build_main_menu())
             return
         else:
-            await query.edit_message_text(f"TrueMoney: `{TRUEMONEY_NUMBER}`", parse_mode="Markdown", reply_markup=build_main_menu())
+            await safe_edit(query, f"TrueMoney: {md_code(TRUEMONEY_NUMBER)}", parse_mode="Markdown", reply_markup=build_main_menu())
             return
 
     # My profile
     if data == "my_profile":
-        uid = str(query.from_user.id)
-        users = json.loads(USERS_JSON.read_text())
-        info = users.get(uid, {})
-        uname = info.get("username", "")
-        first = info.get("first_seen")
-        first_str = datetime.utcfromtimestamp(first).strftime("%Y-%m-%d %H:%M UTC") if first else "n/a"
-        text = f"👤 User Profile\\n\\nID: `{uid}`\\nUsername: @{uname}\\nFirst seen: {first_str}"
-        await query.edit_message_text(text, parse_mode="Markdown", reply_markup=build_main_menu())
+        text = user_profile(str(query.from_user.id))
+        await safe_edit(query, text, parse_mode="Markdown", reply_markup=build_main_menu())
         return
 
     # Admin panel
     if data == "admin_panel":
         uid = query.from_user.id
         if not is_admin_session(uid):
-            await query.edit_message_text("Admin access required. Use /adminlogin <PIN> to start admin session.", reply_markup=build_main_menu())
+            await safe_edit(query, "Admin access required. Use /adminlogin <PIN> to start admin session.", reply_markup=build_main_menu())
             return
         keyboard = [
             [InlineKeyboardButton("Upload File", callback_data="admin_upload")],
@@ -324,201 +2108,222 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
              InlineKeyboardButton("Stats", callback_data="admin_stats")],
             [InlineKeyboardButton("Broadcast Text", callback_data="admin_broadcast_text"),
              InlineKeyboardButton("Broadcast Media", callback_data="admin_broadcast_media")],
+            [InlineKeyboardButton("Top Files", callback_data="admin_topfiles"),
+             InlineKeyboardButton("Diagnostics", callback_data="admin_diag")],
             [InlineKeyboardButton("Logout", callback_data="admin_logout")],
             [InlineKeyboardButton("🔙 Back", callback_data="back_main")],
         ]
-        await query.edit_message_text("Admin Panel", reply_markup=InlineKeyboardMarkup(keyboard))
+        await safe_edit(query, "Admin Panel", reply_markup=InlineKeyboardMarkup(keyboard))
         return
 
     if data == "admin_logout":
         uid = query.from_user.id
         admin_sessions.pop(uid, None)
-        await query.edit_message_text("Admin session ended.", reply_markup=build_main_menu())
+        await safe_edit(query, "Admin session ended.", reply_markup=build_main_menu())
         return
 
     if data == "admin_upload":
         uid = query.from_user.id
         if not is_admin_session(uid):
-            await query.edit_message_text("Admin session required. /adminlogin <PIN>", reply_markup=build_main_menu())
+            await safe_edit(query, "Admin session required. /adminlogin <PIN>", reply_markup=build_main_menu())
             return
         keyboard = [[InlineKeyboardButton(label, callback_data=f"upload:{key}")] for key, label in CATEGORIES.items()]
         keyboard.append([InlineKeyboardButton("Cancel", callback_data="back_main")])
-        await query.edit_message_text("Select category to upload to:", reply_markup=InlineKeyboardMarkup(keyboard))
+        await safe_edit(query, "Select category to upload to:", reply_markup=InlineKeyboardMarkup(keyboard))
         return
 
     if data.startswith("upload:"):
         uid = query.from_user.id
         if not is_admin_session(uid):
-            await query.edit_message_text("Admin session required. /adminlogin <PIN>", reply_markup=build_main_menu())
+            await safe_edit(query, "Admin session required. /adminlogin <PIN>", reply_markup=build_main_menu())
             return
         cat = data.split(":", 1)[1]
         upload_state[uid] = cat
-        await query.edit_message_text(f"Send the document to upload to *{CATEGORIES.get(cat, cat)}*.\\nOptional caption: `expiry:7` to expire in 7 days.", parse_mode="Markdown")
+        await safe_edit(query, f"Send one or more documents to upload to {md_escape(CATEGORIES.get(cat, cat))}, then /done.\\nOptional caption: `expiry:7` to expire in 7 days.", parse_mode="Markdown")
+        return
+
+    if data == "upload_done":
+        await finish_upload(context.bot, query.from_user.id)
         return
 
     if data == "admin_listfiles":
         uid = query.from_user.id
         if not is_admin_session(uid):
-            await query.edit_message_text("Admin session required. /adminlogin <PIN>", reply_markup=build_main_menu())
+            await safe_edit(query, "Admin session required. /adminlogin <PIN>", reply_markup=build_main_menu())
             return
         lines = []
         for k, label in CATEGORIES.items():
-            files = list_category_files(k)
-            lines.append(f"{label}: {len(files)} file(s)")
+            lines.append(f"{label}: {category_index.count(k)} file(s)")
         text = "Files summary:\\n\\n" + "\\n".join(lines)
-        await query.edit_message_text(text, reply_markup=build_main_menu())
+        await safe_edit(query, text, reply_markup=build_main_menu())
         return
 
     if data == "admin_stats":
         uid = query.from_user.id
         if not is_admin_session(uid):
-            await query.edit_message_text("Admin session required. /adminlogin <PIN>", reply_markup=build_main_menu())
+            await safe_edit(query, "Admin session required. /adminlogin <PIN>", reply_markup=build_main_menu())
+            return
+        stats = activity.summary()
+        lines = [
+            "Admin Stats", "",
+            f"Registered users: {user_store.count()}",
+            f"DAU: {stats['dau']}  MAU: {stats['mau']}",
+            "Last 24h: " + (", ".join(f"{kind} {n}" for kind, n in stats["last_24h"]) or "no activity"),
+            "Top categories (30d downloads):",
+        ]
+        lines += [f"  {CATEGORIES.get(cat, cat)}: {n}" for cat, n in stats["top_categories"]] or ["  none yet"]
+        lines.append(f"Categories: {len(CATEGORIES)}")
+        lines.append(f"Throttled: {menu_throttle.hits} messages, {callback_throttle.hits} taps")
+        text = "\\n".join(lines)
+        await safe_edit(query, text, reply_markup=build_main_menu())
+        return
+
+    if data == "admin_topfiles":
+        uid = query.from_user.id
+        if not is_admin_session(uid):
+            await safe_edit(query, "Admin session required. /adminlogin <PIN>", reply_markup=build_main_menu())
+            return
+        lines = [f"{i}. {name} ({CATEGORIES.get(cat, cat)}): {n}" for i, (cat, name, n) in enumerate(download_stats.top(TOP_FILES), 1)]
+        await safe_edit(query, "Top Files\\n\\n" + ("\\n".join(lines) or "No downloads yet."), reply_markup=build_main_menu())
+        return
+
+    if data == "admin_diag":
+        uid = query.from_user.id
+        if not is_admin_session(uid):
+            await safe_edit(query, "Admin session required. /adminlogin <PIN>", reply_markup=build_main_menu())
             return
-        users = json.loads(USERS_JSON.read_text())
-        text = f"Admin Stats\\n\\nRegistered users: {len(users)}\\nCategories: {len(CATEGORIES)}"
-        await query.edit_message_text(text, reply_markup=build_main_menu())
+        await safe_edit(query, diagnostics_text(), reply_markup=build_main_menu())
         return
 
     if data == "admin_broadcast_text":
         uid = query.from_user.id
         if not is_admin_session(uid):
-            await query.edit_message_text("Admin session required. /adminlogin <PIN>", reply_markup=build_main_menu())
+            await safe_edit(query, "Admin session required. /adminlogin <PIN>", reply_markup=build_main_menu())
             return
         broadcast_state[uid] = {"mode": "await_text"}
-        await query.edit_message_text("Send the text you want to broadcast (or use /broadcast <text>).")
+        await safe_edit(query, "Send the text you want to broadcast (or use /broadcast <text>).")
         return
 
     if data == "admin_broadcast_media":
         uid = query.from_user.id
         if not is_admin_session(uid):
-            await query.edit_message_text("Admin session required. /adminlogin <PIN>", reply_markup=build_main_menu())
+            await safe_edit(query, "Admin session required. /adminlogin <PIN>", reply_markup=build_main_menu())
             return
         broadcast_state[uid] = {"mode": "await_media"}
-        await query.edit_message_text("Send the photo or document to broadcast (you can add caption).")
+        await safe_edit(query, "Send the message or album to broadcast (any type; it is copied as-is).")
+        return
+
+    # Category selection by user (first page), catp:<cat>:<n|p>:<cursor> for next/prev pages
+    if data.startswith("cat:") or data.startswith("catp:"):
+        if data.startswith("catp:"):
+            _, cat, direction, cursor = (data.split(":", 3) + ["", "", ""])[:4]
+        else:
+            cat, direction, cursor = data.split(":", 1)[1], "n", None
+        activity.emit("view", query.from_user.id, cat)
+        names, prev_cursor, next_cursor = category_index.page(cat, cursor or None, backwards=(direction == "p"))
+        if not names:
+            await safe_edit(query, f"No files for {CATEGORIES.get(cat, cat)} yet.\\nContact admin to upload.", reply_markup=build_main_menu())
+            return
+        if not cursor and len(names) == 1:
+            await context.bot.send_document(chat_id=query.message.chat_id, document=category_index.source(cat, names[0]), caption=f"{CATEGORIES.get(cat)}")
+            user_store.record_download(query.from_user.id, cat)
+            download_stats.record(cat, names[0])
+            activity.emit("download", query.from_user.id, cat)
+            await safe_edit(query, "Main menu:", reply_markup=build_main_menu())
+            return
+        text, markup = build_category_page(cat, names, prev_cursor, next_cursor)
+        await safe_edit(query, text, reply_markup=markup)
         return
 
-    # Category selection by user
-    if data.startswith("cat:"):
+    if data.startswith("sendall:"):
         cat = data.split(":", 1)[1]
-        files = list_category_files(cat)
-        if not files:
-            await query.edit_message_text(f"No files for {CATEGORIES.get(cat, cat)} yet.\\nContact admin to upload.", reply_markup=build_main_menu())
+        if cat not in CATEGORIES:
+            await safe_edit(query, "Unknown category.", reply_markup=build_main_menu())
             return
-        if len(files) == 1:
-            fpath = files[0]
-            await context.bot.send_document(chat_id=query.message.chat_id, document=InputFile(str(fpath)), caption=f"{CATEGORIES.get(cat)}")
-            await query.edit_message_text("Main menu:", reply_markup=build_main_menu())
+        chat_id = query.message.chat_id
+        if chat_id in sending_all:  # repeated tap while the first delivery is running
             return
-        kb = []
-        for f in files[:10]:
-            token = safe_encode_filename(f.name)
-            kb.append([InlineKeyboardButton(f.name if len(f.name) <= 30 else f.name[:27] + "...", callback_data=f"getfile:{cat}:{token}")])
-        kb.append([InlineKeyboardButton("🔙 Back", callback_data="back_main")])
-        await query.edit_message_text(f"Select a file from {CATEGORIES.get(cat)}:", reply_markup=InlineKeyboardMarkup(kb))
+        # Deliver in the background: the albums are paced per chat and would
+        # otherwise hold up every other update until they are all sent
+        sending_all.add(chat_id)
+        await safe_edit(query, f"Sending {category_index.count(cat)} files from {CATEGORIES[cat]}...")
+        context.application.create_task(send_all_task(context.bot, query, cat), update=update)
         return
 
     if data.startswith("getfile:"):
         parts = data.split(":", 2)
         if len(parts) < 3:
-            await query.edit_message_text("Invalid file request.", reply_markup=build_main_menu())
+            await safe_edit(query, "Invalid file request.", reply_markup=build_main_menu())
             return
         cat, token = parts[1], parts[2]
         fname = safe_decode_filename(token)
-        fpath = category_folder(cat) / fname
-        if not fpath.exists():
-            await query.edit_message_text("File not found (maybe expired).", reply_markup=build_main_menu())
+        document = category_index.source(cat, fname)
+        if document is None:
+            await safe_edit(query, "File not found (maybe expired).", reply_markup=build_main_menu())
             return
-        await context.bot.send_document(chat_id=query.message.chat_id, document=InputFile(str(fpath)), caption=f"{CATEGORIES.get(cat)}")
-        await query.edit_message_text("Main menu:", reply_markup=build_main_menu())
+        await context.bot.send_document(chat_id=query.message.chat_id, document=document, caption=f"{CATEGORIES.get(cat)}")
+        user_store.record_download(query.from_user.id, cat)
+        download_stats.record(cat, fname)
+        activity.emit("download", query.from_user.id, cat)
+        await safe_edit(query, "Main menu:", reply_markup=build_main_menu())
         return
 
-    await query.edit_message_text("Unknown action.", reply_markup=build_main_menu())
+    await safe_edit(query, "Unknown action.", reply_markup=build_main_menu())
 
 
 async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
+    message = update.effective_message
+
+    # Later parts of an album that is being collected for broadcast
+    group = message.media_group_id
+    if group and group in pending_albums:
+        pending_albums[group].append(message.message_id)
+        return
 
-    # If admin is in upload flow
+    # If admin is in upload flow: documents are queued, one progress message per session
     if uid in upload_state:
-        cat = upload_state.pop(uid)
-        doc = update.message.document
+        cat = upload_state[uid]
+        doc = message.document
         if not doc:
-            return await update.message.reply_text("Please send a document file to upload.")
-        fname = doc.file_name or doc.file_id
-        safe = "".join(c for c in fname if c.isalnum() or c in "._- ")
-        out = category_folder(cat) / safe
-        try:
-            tgfile = await context.bot.get_file(doc.file_id)
-            await tgfile.download_to_drive(str(out))
-        except Exception:
-            logger.exception("download failed")
-            return await update.message.reply_text("Failed to download file.")
-        caption = (update.message.caption or "").strip()
-        expiry_days = 0
-        if caption.lower().startswith("expiry:"):
-            try:
-                expiry_days = int(caption.split(":", 1)[1].strip())
-            except:
-                expiry_days = 0
-        meta = load_metadata(cat)
-        expiry_ts = int(time.time()) + expiry_days * 86400 if expiry_days else 0
-        meta[out.name] = {"uploaded_at": int(time.time()), "expiry_ts": expiry_ts}
-        save_metadata(cat, meta)
-        return await update.message.reply_text(f"Uploaded {out.name} to {cat}. Expiry days: {expiry_days}")
+            return await message.reply_text("Please send a document file to upload, or /done to finish.")
+        batch = upload_batches.get(uid)
+        if batch is not None and not batch.closed and batch.cat != cat:
+            # Category switched mid-session: close the old batch (its queued files still
+            # complete) so its progress message loses the Done button
+            batch.closed = True
+            schedule_progress(context.bot, batch)
+        if batch is None or batch.closed or batch.cat != cat:
+            batch = upload_batches[uid] = UploadBatch(update.effective_chat.id, cat)
+        enqueue_upload(context.application, uid, batch, doc, (message.caption or "").strip())
+        if batch.message_id is None:
+            text, markup = batch.render()
+            msg = await message.reply_text(text, reply_markup=markup)
+            batch.message_id = msg.message_id
+            batch.last_edit = time.monotonic()
+        schedule_progress(context.bot, batch)
+        return
 
-    # If admin in broadcast state (text or media)
+    # If admin in broadcast state: any message type is copied as-is
     if uid in broadcast_state:
         state = broadcast_state.pop(uid)
-        mode = state.get("mode")
-        if mode == "await_text":
-            text = update.message.text or ""
-            if not text:
-                return await update.message.reply_text("Send text to broadcast.")
-            users = get_all_users()
-            await update.message.reply_text(f"Broadcasting to {len(users)} users...")
-            sent = failed = 0
-            for s in users:
-                try:
-                    await context.bot.send_message(int(s), text)
-                    sent += 1
-                except Exception:
-                    failed += 1
-                await asyncio.sleep(DELAY_BETWEEN)
-            return await update.message.reply_text(f"Broadcast done. Sent {sent}, Failed {failed}")
-        if mode == "await_media":
-            if update.message.photo:
-                file_id = update.message.photo[-1].file_id
-                caption = update.message.caption or ""
-                users = get_all_users()
-                await update.message.reply_text(f"Broadcasting photo to {len(users)} users...")
-                sent = failed = 0
-                for s in users:
-                    try:
-                        await context.bot.send_photo(int(s), file_id, caption=caption)
-                        sent += 1
-                    except Exception:
-                        failed += 1
-                    await asyncio.sleep(DELAY_BETWEEN)
-                return await update.message.reply_text(f"Broadcast done. Sent {sent}, Failed {failed}")
-            elif update.message.document:
-                file_id = update.message.document.file_id
-                caption = update.message.caption or ""
-                users = get_all_users()
-                await update.message.reply_text(f"Broadcasting document to {len(users)} users...")
-                sent = failed = 0
-                for s in users:
-                    try:
-                        await context.bot.send_document(int(s), file_id, caption=caption)
-                        sent += 1
-                    except Exception:
-                        failed += 1
-                    await asyncio.sleep(DELAY_BETWEEN)
-                return await update.message.reply_text(f"Broadcast done. Sent {sent}, Failed {failed}")
-            else:
-                return await update.message.reply_text("Please send a photo or document.")
-
-    # Not admin flows: do nothing here (catch-all sends menu below)
-    return
+        try:
+            segment, _ = Segment.parse(state.get("filters", ""))
+            if message.media_group_id:
+                if Segment.parse(message.caption or "")[1] != (message.caption or "").lstrip():
+                    raise ValueError("put album filters on the command, e.g. /broadcast_startphoto sample:5")
+                pending_albums[message.media_group_id] = [message.message_id]
+                context.application.create_task(broadcast_album(message, segment, context))
+                return
+            segment, send = broadcast_payload(message, context, segment)
+        except ValueError as e:
+            return await message.reply_text(f"Bad audience filter: {e}")
+        await message.reply_text(f"Broadcasting to {user_store.count(segment)} users ({segment.describe()})...")
+        sent, failed, pruned = await broadcast(segment, send)
+        return await message.reply_text(f"Broadcast done. Sent {sent}, Failed {failed}, Pruned {pruned} unreachable")
+
+    # Not admin flows: same as any other private message
+    return await always_menu_handler(update, context)
 
 
 # Catch-all handler: send menu on any private chat message (unless admin in flow)
@@ -534,14 +2339,19 @@ async def always_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
         return
 
     # If message is a command, let command handlers handle it (don't double-send)
-    if update.message and update.message.text and update.message.text.startswith("/"):
+    message = update.effective_message
+    if message and message.text and message.text.startswith("/"):
         return
 
-    # register user if not yet
-    register_user(user_id, update.effective_user.username)
-
-    # send menu
-    await send_main_menu(chat_id=update.effective_chat.id, context=context)
+    # (the user row is upserted by track_activity's buffered write, not per message)
+    chat_id = update.effective_chat.id
+    message_id = message.message_id
+    if menu_throttle.allow(user_id):
+        await show_menu(chat_id, context, message_id)
+    elif chat_id not in deferred_menus:
+        # coalesce a burst into at most one more menu once the bucket refills
+        deferred_menus.add(chat_id)
+        context.application.create_task(deferred_menu(chat_id, context, message_id))
 
 
 # ---------------------------
@@ -568,6 +2378,8 @@ async def adminpanel_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
          InlineKeyboardButton("Stats", callback_data="admin_stats")],
         [InlineKeyboardButton("Broadcast Text", callback_data="admin_broadcast_text"),
          InlineKeyboardButton("Broadcast Media", callback_data="admin_broadcast_media")],
+        [InlineKeyboardButton("Top Files", callback_data="admin_topfiles"),
+         InlineKeyboardButton("Diagnostics", callback_data="admin_diag")],
     ]
     await update.message.reply_text("Admin Panel", reply_markup=InlineKeyboardMarkup(kb))
 
@@ -577,27 +2389,126 @@ async def broadcast_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin_session(uid):
         return await update.message.reply_text("Admin only.")
     if not context.args:
-        return await update.message.reply_text("Usage: /broadcast your message here")
-    text = " ".join(context.args)
-    users = get_all_users()
-    await update.message.reply_text(f"Broadcasting to {len(users)} users...")
+        return await update.message.reply_text(
+            "Usage: /broadcast [filters] your message here\\n"
+            "Filters: since:YYYY-MM-DD until:YYYY-MM-DD active:7d idle:30d cat:<category> sample:5")
+    try:
+        segment, send = broadcast_payload(update.message, context, command=True)
+    except ValueError as e:
+        return await update.message.reply_text(f"Bad audience filter: {e}")
+    await update.message.reply_text(f"Broadcasting to {user_store.count(segment)} users ({segment.describe()})...")
+    sent, failed, pruned = await broadcast(segment, send)
+    await update.message.reply_text(f"Done. Sent {sent}, Failed {failed}, Pruned {pruned} unreachable")
+
+
+pending_albums: Dict[str, list] = {}  # media_group_id -> admin message ids, while collecting
+
+
+def shift_entities(entities, cut: str):
+    """Re-base entities after the leading `cut` text is removed (offsets are UTF-16 units)."""
+    by = len(cut.encode("utf-16-le")) // 2
+    return [
+        MessageEntity(e.type, e.offset - by, e.length, url=e.url, user=e.user,
+                      language=e.language, custom_emoji_id=e.custom_emoji_id)
+        for e in entities if e.offset >= by
+    ]
+
+
+def broadcast_payload(message: Message, context: ContextTypes.DEFAULT_TYPE, segment: Optional[Segment] = None, command: bool = False):
+    """Build (segment, send) that fans the admin's message out with one call per user.
+
+    Without leading filters the message is copy_message'd untouched, so any
+    type (video, voice, sticker, ...) works and entities need no re-parsing.
+    Filters in a caption become a caption override with shifted entities;
+    filters in text (or a /broadcast command) resend the rest as text.
+    """
+    text = message.text is not None
+    body = message.text if text else (message.caption or "")
+    start = len(body.split(None, 1)[0]) if command and body else 0
+    segment, rest = Segment.parse(body[start:], segment)
+    cut = body[:len(body) - len(rest)]
+    chat_id, message_id = message.chat_id, message.message_id
+    if not cut:
+        return segment, lambda to: context.bot.copy_message(to, chat_id, message_id)
+    if text:
+        if not rest:
+            raise ValueError("nothing to send after the filters")
+        entities = shift_entities(message.entities, cut)
+        return segment, lambda to: context.bot.send_message(to, rest, entities=entities)
+    entities = shift_entities(message.caption_entities, cut)
+    return segment, lambda to: context.bot.copy_message(to, chat_id, message_id, caption=rest, caption_entities=entities)
+
+
+async def broadcast_album(first: Message, segment: Segment, context: ContextTypes.DEFAULT_TYPE):
+    """Wait for the rest of an album, then copy all its parts per user with copy_messages."""
+    await asyncio.sleep(BROADCAST_ALBUM_WAIT)
+    message_ids = sorted(pending_albums.pop(first.media_group_id, []))
+    chat_id = first.chat_id
+    await first.reply_text(f"Broadcasting album of {len(message_ids)} to {user_store.count(segment)} users ({segment.describe()})...")
+    sent, failed, pruned = await broadcast(segment, lambda to: context.bot.copy_messages(to, chat_id, message_ids))
+    await first.reply_text(f"Broadcast done. Sent {sent}, Failed {failed}, Pruned {pruned} unreachable")
+
+
+UNREACHABLE_ERRORS = ("chat not found", "user is deactivated", "peer_id_invalid", "bot was blocked")
+
+
+def is_unreachable(exc: Exception) -> bool:
+    """True when retrying later cannot help: blocked, kicked, deleted account."""
+    if isinstance(exc, Forbidden):
+        return True
+    return isinstance(exc, BadRequest) and any(m in exc.message.lower() for m in UNREACHABLE_ERRORS)
+
+
+async def broadcast(segment: Segment, send):
+    """Call send(chat_id) for every user in the segment, paced by DELAY_BETWEEN.
+
+    Unreachable users are marked inactive so later broadcasts skip them;
+    returns (sent, failed, pruned), where failed excludes the pruned ones.
+    """
     sent = failed = 0
-    for s in users:
-        try:
-            await context.bot.send_message(int(s), text)
-            sent += 1
-        except Exception:
-            failed += 1
+    pruned = []
+    for chat_id in user_store.audience(segment):
+        for attempt in range(BROADCAST_RETRIES + 1):
+            try:
+                await send(chat_id)
+                sent += 1
+            except RetryAfter as e:
+                if attempt < BROADCAST_RETRIES:
+                    await asyncio.sleep(e.retry_after)
+                    continue
+                failed += 1
+            except Exception as e:
+                if is_unreachable(e):
+                    pruned.append(chat_id)
+                else:
+                    failed += 1
+                    logger.warning("broadcast to %s failed: %s", chat_id, e)
+            break
         await asyncio.sleep(DELAY_BETWEEN)
-    await update.message.reply_text(f"Done. Sent {sent}, Failed {failed}")
+    if pruned:
+        user_store.deactivate(pruned)
+        logger.info("broadcast pruned %d unreachable users", len(pruned))
+    return sent, failed, len(pruned)
 
 
 async def broadcast_startphoto_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
     if not is_admin_session(uid):
         return await update.message.reply_text("Admin only.")
-    broadcast_state[uid] = {"mode": "await_media"}
-    await update.message.reply_text("Send the photo/document to broadcast (with optional caption).")
+    filters_text = " ".join(context.args)
+    try:
+        _, unknown = Segment.parse(filters_text)
+    except ValueError as e:
+        return await update.message.reply_text(f"Bad audience filter: {e}")
+    if unknown:
+        return await update.message.reply_text(f"Unknown audience filter: {unknown.split()[0]}")
+    broadcast_state[uid] = {"mode": "await_media", "filters": filters_text}
+    await update.message.reply_text("Send the message or album to broadcast; it is copied as-is to every user.")
+
+
+async def done_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await finish_upload(context.bot, update.effective_user.id):
+        return await update.message.reply_text("No active upload.")
 
 
 async def broadcast_cancel_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -611,69 +2522,215 @@ async def broadcast_cancel_cmd(update: Update, context: ContextTypes.DEFAULT_TYP
 async def listfiles_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text_lines = []
     for k, label in CATEGORIES.items():
-        files = list_category_files(k)
-        text_lines.append(f"{label}: {len(files)} file(s)")
+        text_lines.append(f"{label}: {category_index.count(k)} file(s)")
+        # most downloaded first
+        counts = download_stats.counts(k)
+        ranked = sorted((name for name in category_index.names(k) if counts.get(name)), key=lambda name: -counts[name])
+        text_lines += [f"  {name}: {counts[name]}" for name in ranked[:3]]
     await update.message.reply_text("Files:\\n" + "\\n".join(text_lines))
 
 
+def diagnostics_text() -> str:
+    if not diagnostics:
+        return "Diagnostics disabled. Set BOT_DIAGNOSTICS=1 and restart the bot."
+    return "Diagnostics\\n\\n" + diagnostics.report()
+
+
+async def diag_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    if not is_admin_session(uid):
+        return await update.message.reply_text("Admin only.")
+    await update.message.reply_text(diagnostics_text())
+
+
 async def me_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    uid = str(update.effective_user.id)
-    users = json.loads(USERS_JSON.read_text())
-    info = users.get(uid, {})
-    uname = info.get("username", "")
-    first = info.get("first_seen")
-    first_str = datetime.utcfromtimestamp(first).strftime("%Y-%m-%d %H:%M UTC") if first else "n/a"
-    await update.message.reply_text(f"👤 Profile\\nID: `{uid}`\\nUsername: @{uname}\\nFirst seen: {first_str}", parse_mode="Markdown")
+    text = user_profile(str(update.effective_user.id), ME_TEMPLATE)
+    await update.message.reply_text(text, parse_mode="Markdown")
 
 
 # ---------------------------
 # Main / Setup
 # ---------------------------
-def main():
-    if not BOT_TOKEN:
-        print("Please set BOT_TOKEN env var")
-        return
+_first_update_logged = False
 
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
 
-    # command handlers
-    app.add_handler(CommandHandler("start", start_cmd))
-    app.add_handler(CommandHandler("adminlogin", adminlogin_cmd))
-    app.add_handler(CommandHandler("adminpanel", adminpanel_cmd))
-    app.add_handler(CommandHandler("broadcast", broadcast_cmd))
-    app.add_handler(CommandHandler("broadcast_startphoto", broadcast_startphoto_cmd))
-    app.add_handler(CommandHandler("broadcast_cancel", broadcast_cancel_cmd))
-    app.add_handler(CommandHandler("listfiles", listfiles_cmd))
-    app.add_handler(CommandHandler("me", me_cmd))
+async def track_activity(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat = update.effective_chat
+    if chat and chat.type == "private" and update.effective_user:
+        user_store.touch(update.effective_user.id, update.effective_user.username)
+
+
+async def log_first_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    global _first_update_logged
+    if not _first_update_logged:
+        _first_update_logged = True
+        logger.info("First update %.2fs after process start", process_uptime())
+
+
+def register_handlers(app):
+    # restart-to-first-update timing (group -1 runs before, and never blocks, the rest)
+    app.add_handler(TypeHandler(Update, log_first_update), group=-1)
+    # last_seen for audience segments (buffered, written by flush_state_loop)
+    app.add_handler(TypeHandler(Update, track_activity), group=-2)
+
+    # command handlers (instrument() is a no-op unless BOT_DIAGNOSTICS=1)
+    app.add_handler(CommandHandler("start", instrument(start_cmd)))
+    app.add_handler(CommandHandler("adminlogin", instrument(adminlogin_cmd)))
+    app.add_handler(CommandHandler("adminpanel", instrument(adminpanel_cmd)))
+    app.add_handler(CommandHandler("broadcast", instrument(broadcast_cmd)))
+    app.add_handler(CommandHandler("broadcast_startphoto", instrument(broadcast_startphoto_cmd)))
+    app.add_handler(CommandHandler("broadcast_cancel", instrument(broadcast_cancel_cmd)))
+    app.add_handler(CommandHandler("done", instrument(done_cmd)))
+    app.add_handler(CommandHandler("listfiles", instrument(listfiles_cmd)))
+    app.add_handler(CommandHandler("me", instrument(me_cmd)))
+    app.add_handler(CommandHandler("diag", instrument(diag_cmd)))
 
     # callback queries
-    app.add_handler(CallbackQueryHandler(callback_query_handler))
+    app.add_handler(CallbackQueryHandler(instrument(callback_query_handler)))
+
+    # inline mode: @bot <query>
+    app.add_handler(InlineQueryHandler(instrument(inline_query_handler)))
 
     # message handler for uploads & admin broadcast (must be before catch-all if using filters specific)
-    app.add_handler(MessageHandler((filters.Document.ALL | filters.PHOTO) & filters.ChatType.PRIVATE, message_handler))
+    app.add_handler(MessageHandler(filters.ATTACHMENT & filters.ChatType.PRIVATE & ~filters.UpdateType.EDITED_MESSAGE, instrument(message_handler)))
     # allow text messages for admin broadcast flows
-    app.add_handler(MessageHandler(filters.TEXT & filters.ChatType.PRIVATE, message_handler))
+    app.add_handler(MessageHandler(filters.TEXT & filters.ChatType.PRIVATE & ~filters.UpdateType.EDITED_MESSAGE, instrument(message_handler)))
 
     # catch-all menu handler (register LAST so it won't override admin flows)
-    app.add_handler(MessageHandler(filters.ALL & filters.ChatType.PRIVATE, always_menu_handler))
+    app.add_handler(MessageHandler(filters.ALL & filters.ChatType.PRIVATE, instrument(always_menu_handler)))
+
+    app.add_error_handler(error_handler)
+
+
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
+    logger.error("Error while handling update: %s", type(context.error).__name__,
+                 exc_info=context.error, extra={"ctx": describe_update(update)})
+
+
+def run_app(app):
+    if WEBHOOK_URL:
+        app.run_webhook(listen="0.0.0.0", port=WEBHOOK_PORT, url_path=WEBHOOK_PATH,
+                        webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}")
+    else:
+        app.run_polling()
+
+
+def shard_for(update: Update, shards: int) -> int:
+    """Same chat -> same worker, so per-chat state and ordering stay local."""
+    if update.effective_chat:
+        key = update.effective_chat.id
+    elif update.effective_user:
+        key = update.effective_user.id
+    else:
+        key = update.update_id
+    return key % shards
+
+
+def run_worker(index: int, inbox):
+    """Worker process: dispatches the updates the front process routes to it."""
+    init_runtime(f"bot-worker{index}")
+
+    async def consume():
+        app = ApplicationBuilder().token(BOT_TOKEN).updater(None).build()
+        register_handlers(app)
+        async with app:
+            await app.start()
+            app.create_task(flush_state_loop())
+            if diagnostics:
+                app.create_task(diagnostics.lag_loop())
+            logger.info("worker %d ready (pid %d)", index, os.getpid())
+            loop = asyncio.get_running_loop()
+            while True:
+                payload = await loop.run_in_executor(None, inbox.get)
+                if payload is None:
+                    break
+                await app.update_queue.put(Update.de_json(json.loads(payload), app.bot))
+            await app.stop()
+            state_store.flush()
+            user_store.flush()
+            activity.flush()
+            download_stats.flush()
+
+    asyncio.run(consume())
+
+
+def run_sharded():
+    import multiprocessing
+
+    # fork (not spawn): workers inherit the loaded module and its state
+    mp = multiprocessing.get_context("fork")
+    inboxes = [mp.Queue(maxsize=10000) for _ in range(WORKERS)]
+    workers = [mp.Process(target=run_worker, args=(i, q), name=f"bot-worker{i}", daemon=True)
+               for i, q in enumerate(inboxes)]
+    for w in workers:
+        w.start()
+
+    async def route(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        inboxes[shard_for(update, WORKERS)].put(json.dumps(update.to_dict()))
+        raise ApplicationHandlerStop
+
+    async def on_router_startup(app_inst):
+        # cleanup touches shared files only, so it runs once here, not per worker
+        app_inst.create_task(cleanup_expired_loop(app_inst))
+        if STORAGE_MODE == "file_id" and MIRROR_FILES:
+            app_inst.create_task(mirror_loop(app_inst))
+        logger.info("Ready %.2fs after process start", process_uptime())
+
+    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    app.add_handler(TypeHandler(Update, route))
+    app.post_init = on_router_startup
+    print(f"Bot running with {WORKERS} workers...")
+    try:
+        run_app(app)
+    finally:
+        for q in inboxes:
+            q.put(None)
+        for w in workers:
+            w.join(timeout=10)
+
+
+def main():
+    if not BOT_TOKEN:
+        print("Please set BOT_TOKEN env var")
+        return
+
+    init_runtime()
+
+    if WORKERS > 1:
+        return run_sharded()
+
+    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    register_handlers(app)
 
     # startup: cleanup loop
     async def on_startup(app_inst):
         # start background task
         app_inst.create_task(cleanup_expired_loop(app_inst))
+        if STORAGE_MODE == "file_id" and MIRROR_FILES:
+            app_inst.create_task(mirror_loop(app_inst))
+        app_inst.create_task(flush_state_loop())
+        if diagnostics:
+            app_inst.create_task(diagnostics.lag_loop())
+        logger.info("Ready %.2fs after process start", process_uptime())
         # optional: send menu to all users on startup (be careful with rate limits)
-        # users = get_all_users()
-        # for u in users:
+        # for u in user_store.audience():
         #     try:
         #         await send_main_menu(chat_id=int(u), context=app_inst)
         #     except Exception:
         #         pass
         #     await asyncio.sleep(1.0)
 
+    async def on_shutdown(app_inst):
+        state_store.flush()
+        user_store.flush()
+        activity.flush()
+        download_stats.flush()
+
     app.post_init = on_startup
+    app.post_shutdown = on_shutdown
 
     print("Bot running...")
-    app.run_polling()
+    run_app(app)
 
 if __name__ == "__main__":
     main()
@@ -721,7 +2778,7 @@ def install_python_dependencies(venv_dir):
     print("Installing Python dependencies...")
     try:
         subprocess.run([str(pip_path), 'install', '--upgrade', 'pip'], check=True)
-        subprocess.run([str(pip_path), 'install', 'python-telegram-bot==20.5'], check=True)
+        subprocess.run([str(pip_path), 'install', 'python-telegram-bot==20.8'], check=True)
         print("✓ Dependencies installed successfully")
     except subprocess.CalledProcessError as e:
         print(f"✗ Failed to install dependencies: {e}")
@@ -782,6 +2839,9 @@ def create_bot_file():
         
         # Make executable
         bot_file.chmod(0o755)
+        
+        # Precompile so the first start already loads cached bytecode
+        py_compile.compile(str(bot_file), doraise=True)
         print("✓ bot.py file created")
         return bot_file
     except Exception as e:
@@ -805,9 +2865,9 @@ After=network.target
 
 [Service]
 User={username}
-WorkingDirectory={Path.home()}
+WorkingDirectory={bot_file.parent}
 EnvironmentFile=/etc/default/telegram-bot
-ExecStart={venv_dir}/bin/python {bot_file}
+ExecStart={venv_dir}/bin/python -m {bot_file.stem}
 Restart=always
 RestartSec=5
 
@@ -833,7 +2893,7 @@ WantedBy=multi-user.target
         print(f"✗ Failed to create systemd service: {e}")
         print("\nYou can run the bot manually with:")
         print(f"source {venv_dir}/bin/activate")
-        print(f"python {bot_file}")
+        print(f"cd {bot_file.parent} && python -m {bot_file.stem}")
 
 def run_bot_manual(venv_dir, bot_file):
     """Run bot manually"""
@@ -852,14 +2912,12 @@ def run_bot_manual(venv_dir, bot_file):
     print(f"\nActivating virtual environment and running bot...")
     print(f"Press Ctrl+C to stop the bot")
     
-    # Change to home directory
-    os.chdir(Path.home())
-    
-    # Import and run bot
-    sys.path.insert(0, str(Path.home()))
+    # Change to the bot's directory
+    os.chdir(bot_file.parent)
     
-    # Execute the bot code
-    exec(BOT_CODE)
+    # Run the bot as a module with the venv's interpreter (loads cached bytecode)
+    python = str(venv_dir / 'bin' / 'python')
+    os.execv(python, [python, '-m', bot_file.stem])
 
 def main():
     """Main function"""
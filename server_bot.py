@@ -2,25 +2,62 @@
 """
 Telegram Server Information Bot
 Simplified version with only TrueMoney donation
+
+Cold start: `python -X importtime server_bot.py` puts imports at ~0.2s
+(PTB 20.8), nearly all of it telegram/httpx and asyncio, which the first
+update needs anyway. Nothing touches the disk at import time: logging and
+the database are set up in main(), and sharding imports multiprocessing on
+demand. "Ready" and "First update" log lines give the time since process
+start after each restart.
 """
+from __future__ import annotations
 
+import io
 import os
+import itertools
+import re
+import csv
+import copy
 import json
+import time
+import queue
+import hashlib
+import functools
+import atexit
 import logging
+import logging.handlers
 import sqlite3
-from datetime import datetime
+import asyncio
+import tempfile
+import threading
+from collections import Counter, OrderedDict, defaultdict
+from collections.abc import MutableMapping
+from datetime import datetime, timedelta
 from typing import Dict, List, Optional
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import (
+    Update,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    InputFile,
+    InlineQueryResultArticle,
+    InputTextMessageContent
+)
 from telegram.ext import (
     Application,
     CommandHandler,
     CallbackQueryHandler,
+    InlineQueryHandler,
     MessageHandler,
     filters,
     ContextTypes,
-    ConversationHandler
+    ConversationHandler,
+    TypeHandler,
+    ApplicationHandlerStop,
+    BasePersistence,
+    PersistenceInput
 )
+from telegram.error import BadRequest
 
 # ==================== CONFIGURATION ====================
 BOT_TOKEN = "YOUR_BOT_TOKEN_HERE"  # 🔴 REPLACE WITH YOUR BOT TOKEN
@@ -29,31 +66,212 @@ ADMIN_IDS = [123456789]  # 🔴 REPLACE WITH YOUR TELEGRAM ID
 # Database configuration
 DB_NAME = "servers.db"
 
+# Worker processes. With more than 1, a front process receives updates (polling,
+# or the webhook when WEBHOOK_URL is set) and routes them to workers by chat_id;
+# per-user state lives in DB_NAME.
+WORKERS = 1
+
+# Webhook instead of polling, e.g. "https://bot.example.com" (Telegram posts to
+# WEBHOOK_URL/WEBHOOK_PATH); needs pip install "python-telegram-bot[webhooks]"
+WEBHOOK_URL = ""
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "telegram"
+
+# Sessions and half-finished add-server flows are kept in DB_NAME and survive
+# restarts; pending changes are written in one transaction this often (seconds)
+STATE_FLUSH_INTERVAL = 2
+STATE_TTL = 30 * 60          # abandoned add-server flows expire after 30 minutes
+STATE_MAX_ENTRIES = 10000    # in-memory entries per state dict
+STATE_SWEEP_INTERVAL = 60    # seconds between expiry sweeps
+RENDER_CACHE_SIZE = 10000    # messages whose last render is remembered
+CARD_CACHE_SIZE = 5000       # rendered server cards kept in memory
+
+# Plans offered per provider
+PLANS = {
+    "dtac": [
+        "DTAC GAME PLAN",
+        "DTAC ZIVPN (အရံနက်)",
+        "DTAC NOPRO"
+    ],
+    "true": [
+        "TRUE TWITTER PLAN",
+        "TRUE VIBER PLAN"
+    ],
+    "ais": [
+        "V2RAY 64KBPS"
+    ]
+}
+
+# Bulk import: admins upload a CSV or JSON document with these columns
+IMPORT_FIELDS = ["provider", "plan", "server_ip", "username", "password", "expired_date"]
+IMPORT_MAX_BYTES = 5 * 1024 * 1024
+
+# Which server a user gets for a plan: "round_robin", "least_used" (fewest
+# copies) or "weighted" (fewest copies per weight, set with /weight <id> <n>).
+# A user keeps the same server for a plan for ASSIGN_TTL seconds.
+ASSIGN_STRATEGY = "least_used"
+ASSIGN_TTL = 7 * 24 * 3600
+ASSIGN_CANDIDATES = 20  # servers read per pick, in the strategy's order
+
+# Health checks: every active server_ip gets a TCP connect this often; dead
+# servers are hidden from users and live ones are preferred by latency.
+# server_ip may carry its own port ("1.2.3.4:443"), else HEALTH_CHECK_PORT is used.
+HEALTH_CHECK_INTERVAL = 300      # seconds between rounds
+HEALTH_CHECK_TIMEOUT = 3         # seconds per connect
+HEALTH_CHECK_CONCURRENCY = 50    # connects in flight
+HEALTH_CHECK_PORT = 22
+
+# Pagination
+ADMIN_PAGE_SIZE = 10  # servers per page in the admin delete list
+ADMIN_LIST_PAGE_SIZE = 25  # servers fetched per page of the admin server list
+EXPORT_BATCH_SIZE = 500  # rows per query when exporting the server list
+EXPORT_PART_BYTES = 20 * 1024 * 1024  # exports are sent as documents of about this size
+MESSAGE_LIMIT = 4096  # Telegram message length limit (characters)
+
+# Inline search (@bot dtac) needs inline mode turned on with /setinline in @BotFather
+INLINE_CACHE_TIME = 60   # seconds Telegram may reuse an answer (per user)
+INLINE_MAX_RESULTS = 10  # plans answered per query
+INLINE_CANDIDATES = 20   # newest servers per plan considered for an inline answer
+
 # Conversation states
 ADD_SERVER_IP, ADD_SERVER_USERNAME, ADD_SERVER_PASSWORD, ADD_SERVER_EXPIRE, ADD_SERVER_CONFIRM = range(5)
 
 # ==================== SETUP LOGGING ====================
-def setup_logging():
-    """Setup logging configuration"""
-    os.makedirs("logs", exist_ok=True)
-    
-    logging.basicConfig(
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        level=logging.INFO,
-        handlers=[
-            logging.FileHandler(f"logs/bot_{datetime.now().strftime('%Y%m%d')}.log"),
-            logging.StreamHandler()
-        ]
-    )
+LOG_DIR = "logs"
+LOG_MAX_BYTES = 10 * 1024 * 1024  # rotate when the file grows past 10 MB...
+LOG_BACKUP_COUNT = 14             # ...or at midnight, keeping 14 old files
+ERROR_SAMPLE_WINDOW = 60          # seconds
+ERROR_SAMPLE_BURST = 5            # identical warnings/errors logged per window
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        ctx = getattr(record, "ctx", None)
+        if ctx:
+            entry["ctx"] = ctx
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            entry["suppressed"] = suppressed
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class DailyRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """Rotate the log at LOG_MAX_BYTES and at midnight"""
+
+    def __init__(self, filename: str, max_bytes: int, backup_count: int):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+        self.rollover_at = self._next_midnight()
+
+    @staticmethod
+    def _next_midnight() -> float:
+        tomorrow = datetime.now().date() + timedelta(days=1)
+        return datetime.combine(tomorrow, datetime.min.time()).timestamp()
+
+    def shouldRollover(self, record):
+        if record.created >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.rollover_at = self._next_midnight()
+
+class ErrorSampler(logging.Filter):
+    """Rate-limit repeated warnings and errors (drop count goes in `suppressed`)"""
+
+    def __init__(self, window: float, burst: int):
+        super().__init__()
+        self.window = window
+        self.burst = burst
+        self._seen: Dict[tuple, list] = {}
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING:
+            return True
+        exc_type = record.exc_info[0] if record.exc_info else None
+        key = (record.name, record.levelno, str(record.msg), exc_type)
+        slot = self._seen.get(key)
+        if slot is None or record.created - slot[0] >= self.window:
+            if slot and slot[1] > self.burst:
+                record.suppressed = slot[1] - self.burst
+            if len(self._seen) > 1000:
+                self._seen.clear()
+            self._seen[key] = [record.created, 1]
+            return True
+        slot[1] += 1
+        return slot[1] <= self.burst
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queue a copy of the record; the listener thread formats it"""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+def setup_logging(name: str = "bot"):
+    """Setup non-blocking logging: handlers only enqueue, a listener thread writes"""
+    os.makedirs(LOG_DIR, exist_ok=True)
+    
+    file_handler = DailyRotatingFileHandler(os.path.join(LOG_DIR, f"{name}.log"), LOG_MAX_BYTES, LOG_BACKUP_COUNT)
+    file_handler.setFormatter(JsonFormatter())
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(ErrorSampler(ERROR_SAMPLE_WINDOW, ERROR_SAMPLE_BURST))
+    
+    listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    
+    # force: workers call this again after fork, when the parent's listener thread is gone
+    logging.basicConfig(level=logging.INFO, handlers=[queue_handler], force=True)
     return logging.getLogger(__name__)
 
-logger = setup_logging()
+def describe_update(update) -> Dict:
+    """Short summary of an update for logs"""
+    if not isinstance(update, Update):
+        return {"update": type(update).__name__}
+    info = {"update_id": update.update_id}
+    if update.effective_user:
+        info["user_id"] = update.effective_user.id
+    if update.effective_chat:
+        info["chat_id"] = update.effective_chat.id
+    if update.callback_query:
+        info["callback"] = (update.callback_query.data or "")[:64]
+    elif update.effective_message and update.effective_message.text:
+        info["text_len"] = len(update.effective_message.text)
+    return info
+
+def process_uptime() -> float:
+    """Seconds since process start (imports included)"""
+    try:
+        with open("/proc/self/stat") as fh:
+            start_ticks = int(fh.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as fh:
+            uptime = float(fh.read().split()[0])
+        return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return time.monotonic() - MODULE_LOADED_AT
+
+MODULE_LOADED_AT = time.monotonic()
+
+# Handlers are attached by setup_logging(), called from main() / run_worker()
+logger = logging.getLogger(__name__)
 
 # ==================== DATABASE ====================
 class Database:
-    def __init__(self):
-        self.init_db()
-    
     def init_db(self):
         """Initialize database"""
         conn = sqlite3.connect(DB_NAME)
@@ -81,6 +299,33 @@ class Database:
             )
         ''')
         
+        # Capacity weight for weighted assignment
+        columns = {row[1] for row in cursor.execute("PRAGMA table_info(servers)")}
+        if "weight" not in columns:
+            cursor.execute("ALTER TABLE servers ADD COLUMN weight INTEGER DEFAULT 1")
+        
+        # Keyset pagination indexes (newest first by id)
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_servers_plan
+            ON servers (provider, plan, is_active, id)
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_servers_active ON servers (is_active, id)
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_statistics_server ON statistics (server_id)
+        ''')
+        
+        # Latest health check results, written by the one process that probes
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS health (
+                server_ip TEXT PRIMARY KEY,
+                up INTEGER NOT NULL,
+                latency REAL,
+                checked_at REAL NOT NULL
+            )
+        ''')
+        
         conn.commit()
         conn.close()
     
@@ -105,6 +350,38 @@ class Database:
         conn.close()
         return server_id
     
+    def bulk_add_servers(self, rows: List[Dict], replace: bool = False) -> int:
+        """Insert many servers in one transaction
+        
+        With replace=True the active servers of every provider/plan in `rows`
+        are deactivated first, so a plan's catalogue is swapped atomically.
+        """
+        conn = sqlite3.connect(DB_NAME, isolation_level=None)
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            if replace:
+                cursor.executemany(
+                    'UPDATE servers SET is_active = 0 WHERE provider = ? AND plan = ? AND is_active = 1',
+                    sorted({(row['provider'], row['plan']) for row in rows})
+                )
+            last_id = cursor.execute('SELECT COALESCE(MAX(id), 0) FROM servers').fetchone()[0]
+            cursor.executemany('''
+                INSERT INTO servers (provider, plan, server_ip, username, password, expired_date, weight)
+                VALUES (:provider, :plan, :server_ip, :username, :password, :expired_date, :weight)
+            ''', rows)
+            cursor.execute('''
+                INSERT INTO statistics (server_id) SELECT id FROM servers WHERE id > ?
+            ''', (last_id,))
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        return len(rows)
+    
     def get_servers(self, provider: str = None, plan: str = None) -> List[Dict]:
         """Get servers with optional filters"""
         conn = sqlite3.connect(DB_NAME)
@@ -153,6 +430,124 @@ class Database:
         conn.close()
         return dict(row) if row else None
     
+    def get_servers_page(self, limit: int, after_id: int = None, before_id: int = None,
+                         provider: str = None, plan: str = None):
+        """Keyset page of servers, newest first
+        
+        after_id: next page (ids below it), before_id: previous page (ids above it).
+        Returns (servers, has_prev, has_next) without counting or scanning the table.
+        """
+        conn = sqlite3.connect(DB_NAME)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        
+        where = "s.is_active = 1"
+        params = []
+        if provider:
+            where += " AND s.provider = ?"
+            params.append(provider)
+        if plan:
+            where += " AND s.plan = ?"
+            params.append(plan)
+        
+        if before_id is not None:
+            cursor.execute(f'''
+                SELECT s.*, st.copy_count
+                FROM servers s
+                LEFT JOIN statistics st ON s.id = st.server_id
+                WHERE {where} AND s.id > ?
+                ORDER BY s.id ASC LIMIT ?
+            ''', params + [before_id, limit + 1])
+            rows = [dict(row) for row in cursor.fetchall()]
+            has_prev = len(rows) > limit
+            servers = rows[:limit][::-1]
+            has_next = True
+        else:
+            bound = " AND s.id < ?" if after_id is not None else ""
+            bound_params = [after_id] if after_id is not None else []
+            cursor.execute(f'''
+                SELECT s.*, st.copy_count
+                FROM servers s
+                LEFT JOIN statistics st ON s.id = st.server_id
+                WHERE {where}{bound}
+                ORDER BY s.id DESC LIMIT ?
+            ''', params + bound_params + [limit + 1])
+            rows = [dict(row) for row in cursor.fetchall()]
+            has_next = len(rows) > limit
+            servers = rows[:limit]
+            has_prev = after_id is not None
+        
+        conn.close()
+        return servers, has_prev, has_next
+    
+    def get_plan_servers(self, plans: List[tuple], limit: int, include_ids=(),
+                         order: str = "s.id DESC", order_params=()) -> Dict[tuple, List[Dict]]:
+        """First `limit` active servers of each (provider, plan) by `order`, in one query
+        
+        Servers listed in include_ids are returned as well, even past the limit.
+        """
+        result = {tuple(p): [] for p in plans}
+        if not plans:
+            return result
+        conn = sqlite3.connect(DB_NAME)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        
+        pairs = ", ".join("(?, ?)" for _ in plans)
+        ids = ", ".join("?" for _ in include_ids)
+        cursor.execute(f'''
+            SELECT * FROM (
+                SELECT s.*, st.copy_count,
+                       ROW_NUMBER() OVER (PARTITION BY s.provider, s.plan ORDER BY {order}) AS position
+                FROM servers s
+                LEFT JOIN statistics st ON s.id = st.server_id
+                WHERE s.is_active = 1 AND (s.provider, s.plan) IN (VALUES {pairs})
+            )
+            WHERE position <= ? OR id IN ({ids})
+            ORDER BY position
+        ''', list(order_params) + [v for p in plans for v in p] + [limit] + list(include_ids))
+        for row in cursor.fetchall():
+            server = dict(row)
+            del server['position']
+            result[(server['provider'], server['plan'])].append(server)
+        
+        conn.close()
+        return result
+    
+    def iter_servers(self, batch_size: int = EXPORT_BATCH_SIZE, provider: str = None, plan: str = None):
+        """Yield all active servers, newest first, fetched in keyset batches"""
+        after_id = None
+        while True:
+            servers, _, has_next = self.get_servers_page(
+                batch_size, after_id=after_id, provider=provider, plan=plan
+            )
+            yield from servers
+            if not has_next:
+                return
+            after_id = servers[-1]['id']
+    
+    def get_neighbor_ids(self, server_id: int):
+        """(previous_id, next_id) of a server within its provider/plan, newest first
+        
+        Servers the last health check found down are skipped (unprobed ones count as up).
+        """
+        conn = sqlite3.connect(DB_NAME)
+        cursor = conn.cursor()
+        
+        same_plan = '''
+            FROM servers s LEFT JOIN health h ON h.server_ip = s.server_ip
+            WHERE s.is_active = 1 AND COALESCE(h.up, 1) = 1
+            AND s.provider = (SELECT provider FROM servers WHERE id = ?)
+            AND s.plan = (SELECT plan FROM servers WHERE id = ?)
+        '''
+        cursor.execute(f"SELECT MIN(s.id) {same_plan} AND s.id > ?", (server_id, server_id, server_id))
+        prev_id = cursor.fetchone()[0]
+        cursor.execute(f"SELECT MAX(s.id) {same_plan} AND s.id < ?", (server_id, server_id, server_id))
+        next_id = cursor.fetchone()[0]
+        
+        conn.close()
+        return prev_id, next_id
+    
     def delete_server(self, server_id: int) -> bool:
         """Delete server"""
         conn = sqlite3.connect(DB_NAME)
@@ -164,6 +559,41 @@ class Database:
         conn.close()
         return affected > 0
     
+    def set_weight(self, server_id: int, weight: int) -> bool:
+        """Set a server's capacity weight"""
+        conn = sqlite3.connect(DB_NAME)
+        cursor = conn.cursor()
+        cursor.execute('UPDATE servers SET weight = ? WHERE id = ? AND is_active = 1', (weight, server_id))
+        affected = cursor.rowcount
+        conn.commit()
+        conn.close()
+        return affected > 0
+    
+    def save_health(self, status: Dict[str, tuple]):
+        """Replace the stored health check results"""
+        conn = sqlite3.connect(DB_NAME)
+        cursor = conn.cursor()
+        
+        cursor.execute('DELETE FROM health')
+        cursor.executemany(
+            'INSERT INTO health (server_ip, up, latency, checked_at) VALUES (?, ?, ?, ?)',
+            [(ip, int(up), latency, checked_at) for ip, (up, latency, checked_at) in status.items()]
+        )
+        
+        conn.commit()
+        conn.close()
+    
+    def get_health(self) -> Dict[str, tuple]:
+        """server_ip -> (up, latency, checked_at) of the last health check"""
+        conn = sqlite3.connect(DB_NAME)
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT server_ip, up, latency, checked_at FROM health')
+        status = {ip: (bool(up), latency, checked_at) for ip, up, latency, checked_at in cursor.fetchall()}
+        
+        conn.close()
+        return status
+    
     def increment_copy_count(self, server_id: int):
         """Increment copy count for a server"""
         conn = sqlite3.connect(DB_NAME)
@@ -176,16 +606,628 @@ class Database:
         conn.commit()
         conn.close()
 
-# Initialize database
+# Tables are created by main() via db.init_db(), not at import
 db = Database()
 
+# ==================== PERSISTENT STATE ====================
+_MISSING = object()
+
+class StateStore:
+    """State table in DB_NAME, shared by all workers"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._db = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._reader = None
+        self._reader_pid = None
+        self._read_lock = threading.Lock()
+        self._dicts = []
+
+    def _conn(self) -> sqlite3.Connection:
+        # Re-open after fork so workers never share their parent's handle
+        if self._db is None or self._pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS state (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    PRIMARY KEY (namespace, key)
+                )
+            ''')
+            columns = {row[1] for row in db.execute("PRAGMA table_info(state)")}
+            if "expires_at" not in columns:
+                db.execute("ALTER TABLE state ADD COLUMN expires_at REAL")
+            db.execute("CREATE INDEX IF NOT EXISTS idx_state_expires ON state (expires_at)")
+            self._db, self._pid = db, os.getpid()
+        return self._db
+
+    def _read_conn(self) -> sqlite3.Connection:
+        # Lookups get their own connection so (under WAL) they never wait for a flush
+        if self._reader is None or self._reader_pid != os.getpid():
+            with self._lock:
+                self._conn()  # creates the table on first use
+            self._reader = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            self._reader_pid = os.getpid()
+        return self._reader
+
+    def get(self, namespace: str, key: str):
+        """Stored value and expiry, or (_MISSING, None)"""
+        with self._read_lock:
+            row = self._read_conn().execute('''
+                SELECT value, expires_at FROM state
+                WHERE namespace = ? AND key = ? AND (expires_at IS NULL OR expires_at > ?)
+            ''', (namespace, key, time.time())).fetchone()
+        return (json.loads(row[0]), row[1]) if row else (_MISSING, None)
+
+    def items(self, namespace: str) -> List[tuple]:
+        with self._read_lock:
+            rows = self._read_conn().execute('''
+                SELECT key, value, expires_at FROM state
+                WHERE namespace = ? AND (expires_at IS NULL OR expires_at > ?)
+            ''', (namespace, time.time())).fetchall()
+        return [(key, json.loads(value), expires_at) for key, value, expires_at in rows]
+
+    def register(self, pdict: "PersistentDict"):
+        self._dicts.append(pdict)
+
+    def evict_expired(self):
+        """Expire cached entries of all dicts (event loop only)"""
+        for pdict in self._dicts:
+            pdict.evict_expired()
+
+    def collect(self):
+        """Pending writes of all dicts (event loop only)"""
+        upserts, deletes = [], []
+        for pdict in self._dicts:
+            ups, dels = pdict.take_dirty()
+            upserts.extend((pdict.namespace, key, value, expires_at) for key, value, expires_at in ups)
+            deletes.extend((pdict.namespace, key) for key in dels)
+        return upserts, deletes
+
+    def write(self, pending, sweep: bool = False):
+        """Save collected changes in one transaction, optionally purging expired rows (thread-safe)"""
+        upserts, deletes = pending
+        if not upserts and not deletes and not sweep:
+            return
+        with self._lock:
+            db = self._conn()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.executemany(
+                    "INSERT OR REPLACE INTO state (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                    upserts
+                )
+                db.executemany("DELETE FROM state WHERE namespace = ? AND key = ?", deletes)
+                if sweep:
+                    db.execute("DELETE FROM state WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),))
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+
+    def flush(self):
+        self.write(self.collect())
+
+class PersistentDict(MutableMapping):
+    """State namespace loaded on demand (misses cached too), kept in an LRU and saved by the flusher
+
+    Assign a new value to save a change; mutating a stored value is not saved.
+    """
+
+    def __init__(self, store: StateStore, namespace: str, ttl: Optional[float] = None,
+                 max_entries: int = 10000, encode_key=str, decode_key=int):
+        self.store = store
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.encode_key = encode_key
+        self.decode_key = decode_key
+        # key -> (value, expires_at); _MISSING marks an absent key or an unsaved delete
+        self._cache: "OrderedDict" = OrderedDict()
+        self._dirty = set()
+        store.register(self)
+
+    def _load(self, key):
+        entry = self._cache.get(key)
+        if entry is None:
+            entry = self.store.get(self.namespace, self.encode_key(key))
+            self._cache[key] = entry
+            self._trim()
+        else:
+            self._cache.move_to_end(key)
+        value, expires_at = entry
+        if value is not _MISSING and expires_at and expires_at <= time.time():
+            self._cache[key] = (_MISSING, None)
+            self._dirty.add(key)
+            return _MISSING
+        return value
+
+    def _trim(self):
+        if len(self._cache) <= self.max_entries:
+            return
+        for key in list(self._cache):
+            if len(self._cache) <= self.max_entries:
+                break
+            if key not in self._dirty:
+                del self._cache[key]
+
+    def set(self, key, value, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else ttl
+        self._cache[key] = (value, time.time() + ttl if ttl else None)
+        self._cache.move_to_end(key)
+        self._dirty.add(key)
+        self._trim()
+
+    def __getitem__(self, key):
+        value = self._load(key)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        if self._load(key) is _MISSING:
+            raise KeyError(key)
+        self._cache[key] = (_MISSING, None)
+        self._dirty.add(key)
+
+    def __contains__(self, key):
+        return self._load(key) is not _MISSING
+
+    def evict_expired(self):
+        now = time.time()
+        for key, (value, expires_at) in list(self._cache.items()):
+            if value is not _MISSING and expires_at and expires_at <= now:
+                self._cache[key] = (_MISSING, None)
+                self._dirty.add(key)
+
+    def _snapshot(self) -> Dict:
+        merged = {
+            self.decode_key(key): (value, expires_at)
+            for key, value, expires_at in self.store.items(self.namespace)
+        }
+        merged.update(self._cache)
+        now = time.time()
+        return {
+            key: value for key, (value, expires_at) in merged.items()
+            if value is not _MISSING and not (expires_at and expires_at <= now)
+        }
+
+    def __iter__(self):
+        return iter(self._snapshot())
+
+    def __len__(self):
+        return len(self._snapshot())
+
+    def take_dirty(self):
+        upserts, deletes = [], []
+        for key in self._dirty:
+            value, expires_at = self._cache[key]
+            if value is _MISSING:
+                deletes.append(self.encode_key(key))
+            else:
+                upserts.append((self.encode_key(key), json.dumps(value), expires_at))
+        self._dirty.clear()
+        return upserts, deletes
+
+state_store = StateStore(DB_NAME)
+
+def per_user_state(namespace: str, ttl: Optional[float] = STATE_TTL) -> PersistentDict:
+    """Persistent state keyed by user id"""
+    return PersistentDict(state_store, namespace, ttl=ttl, max_entries=STATE_MAX_ENTRIES)
+
+async def flush_state_loop():
+    """Save state changes every STATE_FLUSH_INTERVAL seconds"""
+    loop = asyncio.get_running_loop()
+    next_sweep = time.monotonic() + STATE_SWEEP_INTERVAL
+    while True:
+        await asyncio.sleep(STATE_FLUSH_INTERVAL)
+        sweep = time.monotonic() >= next_sweep
+        if sweep:
+            state_store.evict_expired()
+            next_sweep = time.monotonic() + STATE_SWEEP_INTERVAL
+        try:
+            await loop.run_in_executor(None, state_store.write, state_store.collect(), sweep)
+        except Exception:
+            logger.exception("State flush failed")
+
+class SQLitePersistence(BasePersistence):
+    """Keeps ConversationHandler states in the state table.
+
+    Only conversations are stored; the bot keeps its own per-user data in
+    PersistentDicts, so user/chat/bot/callback data are switched off.
+    """
+
+    def __init__(self, store: StateStore):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=False, callback_data=False),
+            update_interval=STATE_FLUSH_INTERVAL
+        )
+        self.store = store
+        self._conversations: Dict[str, PersistentDict] = {}
+
+    def _conversation(self, name: str) -> PersistentDict:
+        if name not in self._conversations:
+            self._conversations[name] = PersistentDict(
+                self.store, f"conv:{name}", ttl=STATE_TTL, max_entries=STATE_MAX_ENTRIES,
+                encode_key=lambda key: json.dumps(list(key)),
+                decode_key=lambda key: tuple(json.loads(key))
+            )
+        return self._conversations[name]
+
+    async def get_conversations(self, name: str) -> Dict:
+        return dict(self._conversation(name))
+
+    async def update_conversation(self, name: str, key, new_state):
+        conversation = self._conversation(name)
+        if new_state is None:
+            conversation.pop(key, None)
+        else:
+            conversation[key] = new_state
+
+    async def flush(self):
+        self.store.flush()
+
+    async def get_user_data(self) -> Dict:
+        return {}
+
+    async def get_chat_data(self) -> Dict:
+        return {}
+
+    async def get_bot_data(self) -> Dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_user_data(self, user_id: int, data: Dict):
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: Dict):
+        pass
+
+    async def update_bot_data(self, data: Dict):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_user_data(self, user_id: int):
+        pass
+
+    async def drop_chat_data(self, chat_id: int):
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict):
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict):
+        pass
+
+    async def refresh_bot_data(self, bot_data: Dict):
+        pass
+
+# ==================== LOAD BALANCING ====================
+class ServerAssigner:
+    """Picks the server a user gets for a plan, sticky per (user, provider, plan).
+
+    A pick reads only the plan's first ASSIGN_CANDIDATES servers in the
+    strategy's SQL order, never the whole plan. Assignments and round-robin
+    cursors live in PersistentDicts, so they are kept in memory and written to
+    DB_NAME by the state flusher. With WORKERS > 1 each worker rotates its own
+    cursor and counts its own picks; the spread stays even.
+    """
+
+    ORDERS = {
+        "round_robin": "s.id DESC",
+        "least_used": "COALESCE(st.copy_count, 0) ASC, s.id DESC",
+        "weighted": "(COALESCE(st.copy_count, 0) + 1.0) / MAX(COALESCE(s.weight, 1), 1) ASC, s.id DESC",
+    }
+    STRATEGIES = tuple(ORDERS)
+
+    def __init__(self, strategy: str = ASSIGN_STRATEGY):
+        if strategy not in self.STRATEGIES:
+            raise ValueError(f"Unknown assignment strategy: {strategy}")
+        self.strategy = strategy
+        self.order = self.ORDERS[strategy]
+        self.sticky = PersistentDict(state_store, "assign", ttl=ASSIGN_TTL,
+                                     max_entries=STATE_MAX_ENTRIES, decode_key=str)
+        self.cursors = PersistentDict(state_store, "assign_cursor",
+                                      max_entries=STATE_MAX_ENTRIES, decode_key=str)
+        self.picks = Counter()  # assignments made since start, not yet reflected in copy_count
+
+    def pick(self, user_id: int, provider: str, plan: str) -> Optional[Dict]:
+        """Server for this user out of the plan's active, reachable servers"""
+        key = f"{user_id}:{provider}:{plan}"
+        assigned = self.sticky.get(key)
+        if assigned is not None:
+            server = db.get_server(assigned)
+            if (server and (server['provider'], server['plan']) == (provider, plan)
+                    and prober.is_up(server['server_ip'])):
+                return server
+        
+        plan_key = f"{provider}:{plan}"
+        order, params = self.order, ()
+        last = self.cursors.get(plan_key) if self.strategy == "round_robin" else None
+        if last is not None:
+            # Ids below the last pick come first, then wrap around to the newest
+            order, params = f"s.id < ? DESC, {order}", (last,)
+        candidates = db.get_plan_servers([(provider, plan)], ASSIGN_CANDIDATES,
+                                         order=order, order_params=params)[(provider, plan)]
+        if not candidates:
+            return None
+        
+        server = self._choose(candidates)
+        if self.strategy == "round_robin":
+            self.cursors[plan_key] = server['id']
+        self.sticky[key] = server['id']
+        self.picks[server['id']] += 1
+        return server
+
+    def _choose(self, candidates: List[Dict]) -> Dict:
+        # Candidates arrive in SQL order; dead servers are skipped and ties
+        # between equally used ones go to the lower latency
+        ranked = prober.rank(candidates)
+        latency = {s['id']: i for i, s in enumerate(ranked)}
+        if self.strategy == "round_robin":
+            return next(s for s in candidates if s['id'] in latency)
+        
+        def load(server: Dict) -> float:
+            used = (server.get('copy_count') or 0) + self.picks[server['id']]
+            if self.strategy == "weighted":
+                return (used + 1) / max(1, server.get('weight') or 1)
+            return used
+        
+        return min(ranked, key=lambda s: (load(s), latency[s['id']]))
+
+    def assigned_id(self, user_id: int, provider: str, plan: str) -> Optional[int]:
+        return self.sticky.get(f"{user_id}:{provider}:{plan}")
+
+    def preview(self, user_id: int, provider: str, plan: str, servers: List[Dict]) -> Optional[Dict]:
+        """The user's current server for the plan, else the first of `servers`; records nothing"""
+        assigned = self.assigned_id(user_id, provider, plan)
+        for server in servers:
+            if server['id'] == assigned:
+                return server
+        return servers[0] if servers else None
+
+assigner = ServerAssigner()
+
+# ==================== HEALTH CHECKS ====================
+class HealthProber:
+    """TCP reachability and connect latency of every server, checked in the background.
+
+    One process probes (run) and stores the results in DB_NAME; with
+    WORKERS > 1 the workers only reload them (follow). A server that has not
+    been probed yet counts as reachable.
+    """
+
+    def __init__(self, port: int = HEALTH_CHECK_PORT, timeout: float = HEALTH_CHECK_TIMEOUT,
+                 concurrency: int = HEALTH_CHECK_CONCURRENCY):
+        self.port = port
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.status: Dict[str, tuple] = {}  # server_ip -> (up, latency seconds or None, checked_at)
+
+    def parse_target(self, server_ip: str):
+        """(host, port) from "host", "host:port", "[v6]:port" or a bare IPv6 address"""
+        server_ip = server_ip.strip()
+        if server_ip.startswith("["):
+            host, _, rest = server_ip[1:].partition("]")
+            port = rest.lstrip(":")
+            return host, int(port) if port.isdigit() else self.port
+        host, sep, port = server_ip.rpartition(":")
+        if sep and port.isdigit() and ":" not in host:
+            return host, int(port)
+        return server_ip, self.port
+
+    async def probe(self, host: str, port: int) -> Optional[float]:
+        """Connect latency in seconds, or None if the host is unreachable"""
+        started = time.monotonic()
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), self.timeout)
+        except (OSError, asyncio.TimeoutError):
+            return None
+        latency = time.monotonic() - started
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+        return latency
+
+    async def check(self, server_ips) -> Dict[str, tuple]:
+        """Probe each distinct server_ip with at most `concurrency` connects at a time"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        
+        async def check_one(server_ip: str):
+            async with semaphore:
+                latency = await self.probe(*self.parse_target(server_ip))
+            self.status[server_ip] = (latency is not None, latency, time.time())
+        
+        targets = set(server_ips)
+        await asyncio.gather(*(check_one(ip) for ip in targets))
+        return {ip: self.status[ip] for ip in targets}
+
+    async def run(self, interval: float = HEALTH_CHECK_INTERVAL):
+        """Probe all active servers every `interval` seconds"""
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                servers = await loop.run_in_executor(None, db.get_servers)
+                results = await self.check(s['server_ip'] for s in servers)
+                down = sum(1 for up, _, _ in results.values() if not up)
+                logger.info("Health check: %d servers, %d down", len(results), down)
+                # Forget servers that were deleted
+                for ip in set(self.status) - set(results):
+                    del self.status[ip]
+                await loop.run_in_executor(None, db.save_health, dict(self.status))
+            except Exception:
+                logger.exception("Health check failed")
+            await asyncio.sleep(interval)
+
+    async def follow(self, interval: float = HEALTH_CHECK_INTERVAL):
+        """Reload the results stored by the probing process every `interval` seconds"""
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                self.status = await loop.run_in_executor(None, db.get_health)
+            except Exception:
+                logger.exception("Loading health check results failed")
+            await asyncio.sleep(interval)
+
+    def is_up(self, server_ip: str) -> bool:
+        entry = self.status.get(server_ip)
+        return entry is None or entry[0]
+
+    def rank(self, servers: List[Dict]) -> List[Dict]:
+        """Reachable servers, fastest first (unprobed ones last); dead ones are dropped.
+
+        If every server is down the list is returned unchanged, so an outage of
+        the prober's own network doesn't empty the bot.
+        """
+        alive = [s for s in servers if self.is_up(s['server_ip'])]
+        if not alive:
+            return servers
+        
+        def latency(server: Dict):
+            entry = self.status.get(server['server_ip'])
+            return entry[1] if entry else float("inf")
+        
+        return sorted(alive, key=latency)
+
+    def status_line(self, server_ip: str) -> str:
+        entry = self.status.get(server_ip)
+        if entry is None:
+            return ""
+        up, latency, _ = entry
+        if not up:
+            return "🔴 **Status:** unreachable"
+        return f"🟢 **Status:** online ({latency * 1000:.0f} ms)"
+
+prober = HealthProber()
+
+# ==================== INLINE SEARCH ====================
+class SearchIndex:
+    """Plan search by word prefix, with trigrams for matches inside a word"""
+
+    PREFIX_MAX = 12
+
+    def __init__(self):
+        self.docs = []  # (lowercased text, title length, payload)
+        self.prefixes = defaultdict(set)
+        self.trigrams = defaultdict(set)
+
+    @staticmethod
+    def words(text: str) -> List[str]:
+        return [w for w in re.split(r"[^\w]+", text.lower()) if w]
+
+    def add(self, title: str, payload, keywords: str = ""):
+        doc_id = len(self.docs)
+        text = f"{title} {keywords}".lower()
+        self.docs.append((text, len(title), payload))
+        for word in self.words(text):
+            for i in range(1, min(len(word), self.PREFIX_MAX) + 1):
+                self.prefixes[word[:i]].add(doc_id)
+        for i in range(len(text) - 2):
+            self.trigrams[text[i:i + 3]].add(doc_id)
+
+    def _substring(self, word: str) -> set:
+        if len(word) < 3:
+            return set()
+        ids = None
+        for i in range(len(word) - 2):
+            hits = self.trigrams.get(word[i:i + 3])
+            if not hits:
+                return set()
+            ids = set(hits) if ids is None else ids & hits
+        return {d for d in ids if word in self.docs[d][0]}
+
+    def search(self, query: str, limit: int = INLINE_MAX_RESULTS) -> list:
+        words = self.words(query)
+        if not words:
+            return [payload for _, _, payload in self.docs[:limit]]
+        candidates = None
+        prefix_hits = Counter()
+        for word in words:
+            by_prefix = self.prefixes.get(word, set()) if len(word) <= self.PREFIX_MAX else set()
+            prefix_hits.update(by_prefix)
+            ids = by_prefix | self._substring(word)
+            candidates = ids if candidates is None else candidates & ids
+            if not candidates:
+                return []
+        ranked = sorted(candidates, key=lambda d: (-prefix_hits[d], self.docs[d][1], d))
+        return [self.docs[d][2] for d in ranked[:limit]]
+
+def build_plan_index() -> SearchIndex:
+    """Index every (provider, plan) under its plan name and provider"""
+    index = SearchIndex()
+    for provider, plans in PLANS.items():
+        for plan in plans:
+            index.add(plan, (provider, plan), keywords=provider)
+    return index
+
+plan_index = build_plan_index()
+
+# ==================== BULK IMPORT ====================
+def parse_server_file(content: bytes, filename: str):
+    """Validate an uploaded CSV or JSON server list
+    
+    Returns (rows, errors). Rows are ready for Database.bulk_add_servers;
+    extra columns such as id or copy_count (from an export) are ignored.
+    """
+    text = content.decode("utf-8-sig")
+    if filename.lower().endswith(".json"):
+        records = json.loads(text)
+        if isinstance(records, dict):
+            records = records.get("servers", [])
+        if not isinstance(records, list):
+            return [], ["JSON must be a list of servers"]
+        first_line = 1
+    else:
+        records = list(csv.DictReader(io.StringIO(text)))
+        first_line = 2  # line 1 is the header
+    
+    rows, errors = [], []
+    for line, record in enumerate(records, first_line):
+        if not isinstance(record, dict):
+            errors.append(f"{line}: not an object")
+            continue
+        row = {field: str(record.get(field) or "").strip() for field in IMPORT_FIELDS}
+        missing = [field for field in IMPORT_FIELDS if not row[field]]
+        if missing:
+            errors.append(f"{line}: missing {', '.join(missing)}")
+            continue
+        row["provider"] = row["provider"].lower()
+        if row["plan"] not in PLANS.get(row["provider"], []):
+            errors.append(f"{line}: unknown plan {row['provider']}/{row['plan']}")
+            continue
+        try:
+            row["weight"] = max(1, int(record.get("weight") or 1))
+        except (TypeError, ValueError):
+            errors.append(f"{line}: weight must be a number")
+            continue
+        rows.append(row)
+    return rows, errors
+
 # ==================== KEYBOARD BUILDERS ====================
 class Keyboards:
-    """Keyboard templates"""
+    """Keyboard templates (markups are immutable, so each distinct one is built once)"""
     
     @staticmethod
     def main_menu(user_id: int):
         """Main menu keyboard"""
+        return Keyboards._main_menu(user_id in ADMIN_IDS)
+    
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _main_menu(is_admin: bool):
         keyboard = [
             [InlineKeyboardButton("📱 DTAC", callback_data="provider_dtac")],
             [InlineKeyboardButton("🔵 TRUE", callback_data="provider_true")],
@@ -194,52 +1236,50 @@ class Keyboards:
             [InlineKeyboardButton("ℹ️ Help", callback_data="help")]
         ]
         
-        if user_id in ADMIN_IDS:
+        if is_admin:
             keyboard.append([InlineKeyboardButton("👑 Admin", callback_data="admin_panel")])
         
         return InlineKeyboardMarkup(keyboard)
     
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def provider_menu(provider: str):
         """Provider plans menu"""
-        plans = {
-            "dtac": [
-                "DTAC GAME PLAN",
-                "DTAC ZIVPN (အရံနက်)",
-                "DTAC NOPRO"
-            ],
-            "true": [
-                "TRUE TWITTER PLAN", 
-                "TRUE VIBER PLAN"
-            ],
-            "ais": [
-                "V2RAY 64KBPS"
-            ]
-        }
-        
         keyboard = []
-        for plan in plans.get(provider, []):
+        for plan in PLANS.get(provider, []):
             keyboard.append([InlineKeyboardButton(plan, callback_data=f"plan_{provider}_{plan}")])
         
         keyboard.append([InlineKeyboardButton("🔙 Main Menu", callback_data="main_menu")])
         return InlineKeyboardMarkup(keyboard)
     
     @staticmethod
-    def server_menu(server_id: int, provider: str, plan: str):
-        """Server info with copy buttons"""
+    @functools.lru_cache(maxsize=4096)  # keyed by server id, so bounded
+    def server_menu(server_id: int, provider: str, plan: str,
+                    prev_id: Optional[int] = None, next_id: Optional[int] = None):
+        """Server info with copy buttons and prev/next within the plan"""
         keyboard = [
             [InlineKeyboardButton("🌐 Copy IP", callback_data=f"copy_ip_{server_id}")],
             [InlineKeyboardButton("👤 Copy Username", callback_data=f"copy_user_{server_id}")],
             [InlineKeyboardButton("🔑 Copy Password", callback_data=f"copy_pass_{server_id}")],
-            [InlineKeyboardButton("📅 Copy Expiry", callback_data=f"copy_expire_{server_id}")],
-            [
-                InlineKeyboardButton("📋 More Servers", callback_data=f"plan_{provider}_{plan}"),
-                InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")
-            ]
+            [InlineKeyboardButton("📅 Copy Expiry", callback_data=f"copy_expire_{server_id}")]
         ]
+        
+        nav = []
+        if prev_id:
+            nav.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"server_{prev_id}"))
+        if next_id:
+            nav.append(InlineKeyboardButton("Next ➡️", callback_data=f"server_{next_id}"))
+        if nav:
+            keyboard.append(nav)
+        
+        keyboard.append([
+            InlineKeyboardButton("🔙 Plans", callback_data=f"provider_{provider}"),
+            InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")
+        ])
         return InlineKeyboardMarkup(keyboard)
     
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def donate_menu():
         """Donation menu (TrueMoney only)"""
         keyboard = [
@@ -249,17 +1289,20 @@ class Keyboards:
         return InlineKeyboardMarkup(keyboard)
     
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def admin_menu():
         """Admin panel menu"""
         keyboard = [
             [InlineKeyboardButton("➕ Add Server", callback_data="admin_add")],
             [InlineKeyboardButton("🗑️ Delete Server", callback_data="admin_delete")],
             [InlineKeyboardButton("📋 Server List", callback_data="admin_list")],
+            [InlineKeyboardButton("📥 Bulk Import", callback_data="admin_import")],
             [InlineKeyboardButton("🔙 Main Menu", callback_data="main_menu")]
         ]
         return InlineKeyboardMarkup(keyboard)
     
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def admin_add_menu():
         """Admin add server - provider selection"""
         keyboard = [
@@ -271,21 +1314,55 @@ class Keyboards:
         return InlineKeyboardMarkup(keyboard)
     
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def admin_plan_menu(provider: str):
         """Admin add server - plan selection"""
-        plans = {
-            "dtac": ["DTAC GAME PLAN", "DTAC ZIVPN (အရံနက်)", "DTAC NOPRO"],
-            "true": ["TRUE TWITTER PLAN", "TRUE VIBER PLAN"],
-            "ais": ["V2RAY 64KBPS"]
-        }
-        
         keyboard = []
-        for plan in plans.get(provider, []):
+        for plan in PLANS.get(provider, []):
             keyboard.append([InlineKeyboardButton(plan, callback_data=f"addplan_{provider}_{plan}")])
         
         keyboard.append([InlineKeyboardButton("🔙 Back", callback_data="admin_add")])
         return InlineKeyboardMarkup(keyboard)
     
+    @staticmethod
+    def delete_list(servers: List[Dict], has_prev: bool, has_next: bool):
+        """One page of servers to delete, with prev/next keyset cursors"""
+        keyboard = []
+        for server in servers:
+            btn_text = f"❌ {server['server_ip']} ({server['plan']})"
+            keyboard.append([
+                InlineKeyboardButton(btn_text, callback_data=f"delete_{server['id']}")
+            ])
+        
+        nav = []
+        if has_prev:
+            nav.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"admindel_p_{servers[0]['id']}"))
+        if has_next:
+            nav.append(InlineKeyboardButton("Next ➡️", callback_data=f"admindel_n_{servers[-1]['id']}"))
+        if nav:
+            keyboard.append(nav)
+        
+        keyboard.append([InlineKeyboardButton("🔙 Admin Panel", callback_data="admin_panel")])
+        return InlineKeyboardMarkup(keyboard)
+    
+    @staticmethod
+    def server_list_nav(first_id: int, last_id: int, has_prev: bool, has_next: bool):
+        """Admin server list navigation and export"""
+        keyboard = []
+        nav = []
+        if has_prev:
+            nav.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"adminlist_p_{first_id}"))
+        if has_next:
+            nav.append(InlineKeyboardButton("Next ➡️", callback_data=f"adminlist_n_{last_id}"))
+        if nav:
+            keyboard.append(nav)
+        keyboard.append([
+            InlineKeyboardButton("📤 Export CSV", callback_data="admin_export"),
+            InlineKeyboardButton("📤 Export JSON", callback_data="admin_export_json")
+        ])
+        keyboard.append([InlineKeyboardButton("🔙 Admin Panel", callback_data="admin_panel")])
+        return InlineKeyboardMarkup(keyboard)
+    
     @staticmethod
     def delete_confirmation(server_id: int):
         """Delete confirmation"""
@@ -298,25 +1375,61 @@ class Keyboards:
         return InlineKeyboardMarkup(keyboard)
 
 # ==================== MESSAGE FORMATTERS ====================
+# Messages use parse_mode="Markdown"; every interpolated value goes through
+# Messages.md (plain text) or Messages.code (a `code` span), never raw.
+MD_ESCAPE = str.maketrans({char: "\\" + char for char in "_*`["})
+
+# Static parts of the server card; fields are escaped once per server version
+SERVER_CARD = """🌐 **Server Information**
+
+📱 **Provider:** {provider}
+📋 **Plan:** {plan}
+
+📡 **Server IP:** {server_ip}
+👤 **Username:** {username}
+🔑 **Password:** {password}
+📅 **Expired Date:** {expired_date}
+
+"""
+SERVER_CARD_COPIED = "📊 **Copied:** {} times"
+
 class Messages:
     """Message templates"""
     
+    _cards: "OrderedDict" = OrderedDict()  # server version -> rendered card without the copy count
+    
+    @staticmethod
+    def md(value) -> str:
+        """Escape a value placed outside Markdown entities"""
+        return str(value).translate(MD_ESCAPE)
+    
+    @staticmethod
+    def code(value) -> str:
+        """A value as a `code` span; values a span can't hold (backticks, empty) are escaped instead"""
+        text = str(value)
+        if text and "`" not in text:
+            return f"`{text}`"
+        return text.translate(MD_ESCAPE)
+    
     @staticmethod
     def server_info(server: Dict) -> str:
-        """Format server information"""
-        return f"""
-🌐 **Server Information**
-
-📱 **Provider:** {server['provider'].upper()}
-📋 **Plan:** {server['plan']}
-
-📡 **Server IP:** `{server['server_ip']}`
-👤 **Username:** `{server['username']}`
-🔑 **Password:** `{server['password']}`
-📅 **Expired Date:** `{server['expired_date']}`
-
-📊 **Copied:** {server.get('copy_count', 0)} times
-        """
+        """Format server information (cached per server version)"""
+        version = (server['id'], server['provider'], server['plan'], server['server_ip'],
+                   server['username'], server['password'], server['expired_date'])
+        card = Messages._cards.get(version)
+        if card is None:
+            card = SERVER_CARD.format(
+                provider=Messages.md(server['provider'].upper()),
+                plan=Messages.md(server['plan']),
+                server_ip=Messages.code(server['server_ip']),
+                username=Messages.code(server['username']),
+                password=Messages.code(server['password']),
+                expired_date=Messages.code(server['expired_date'])
+            )
+            Messages._cards[version] = card
+            if len(Messages._cards) > CARD_CACHE_SIZE:
+                Messages._cards.popitem(last=False)
+        return card + SERVER_CARD_COPIED.format(server.get('copy_count') or 0)
     
     @staticmethod
     def donate_info() -> str:
@@ -333,20 +1446,134 @@ class Messages:
 
 ကျေးဇူးတင်ပါတယ်။ 🙏
         """
+    
+    @staticmethod
+    def server_list_entry(server: Dict) -> str:
+        """One record of the admin server list"""
+        return (
+            f"• {Messages.md(server['plan'])}\n"
+            f"  IP: {Messages.code(server['server_ip'])}\n"
+            f"  User: {Messages.code(server['username'])}\n"
+            f"  Expires: {Messages.md(server['expired_date'])}\n"
+            f"  Copies: {server.get('copy_count') or 0} · Weight: {server.get('weight') or 1}\n\n"
+        )
+    
+    @staticmethod
+    def fit_records(header: str, records: List[str], limit: int = MESSAGE_LIMIT):
+        """Number of whole records that fit in one message after the header"""
+        size = len(header)
+        for count, record in enumerate(records):
+            size += len(record)
+            if size > limit:
+                return count
+        return len(records)
+    
+    @staticmethod
+    def server_csv(servers, out, max_bytes: int = None):
+        """Write servers to the binary file `out` as CSV, stopping once it holds max_bytes"""
+        fields = ["id", "provider", "plan", "server_ip", "username", "password",
+                  "expired_date", "weight", "copy_count", "created_at"]
+        line = io.StringIO()
+        writer = csv.DictWriter(line, fieldnames=fields, extrasaction="ignore")
+        
+        def write_line():
+            out.write(line.getvalue().encode("utf-8"))
+            line.seek(0)
+            line.truncate()
+        
+        writer.writeheader()
+        write_line()
+        for server in servers:
+            writer.writerow(server)
+            write_line()
+            if max_bytes and out.tell() >= max_bytes:
+                break
+    
+    @staticmethod
+    def server_json(servers, out, max_bytes: int = None):
+        """Write servers to the binary file `out` as a JSON list the importer reads back,
+        stopping once it holds max_bytes"""
+        fields = IMPORT_FIELDS + ["weight"]
+        out.write(b"[")
+        for i, server in enumerate(servers):
+            record = json.dumps({field: server.get(field) for field in fields}, ensure_ascii=False)
+            out.write(f"{',' if i else ''}\n{record}".encode("utf-8"))
+            if max_bytes and out.tell() >= max_bytes:
+                break
+        out.write(b"\n]\n")
+    
+    @staticmethod
+    def export_part(write, rows, out, first: bool) -> bool:
+        """Write the next part of an export to `out`; False once `rows` is used up"""
+        head = next(rows, None)
+        if head is None and not first:
+            return False
+        write(itertools.chain([head] if head else [], rows), out, EXPORT_PART_BYTES)
+        return True
+
+# ==================== RENDER CACHE ====================
+class RenderCache:
+    """Hash of the last render of each message"""
+
+    def __init__(self, max_entries: int = RENDER_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._digests: "OrderedDict" = OrderedDict()
+        self.skipped = 0
+
+    @staticmethod
+    def digest(text: str, reply_markup=None, **kwargs) -> bytes:
+        markup = reply_markup.to_dict() if reply_markup is not None else None
+        payload = json.dumps([text, markup, kwargs], sort_keys=True, default=str)
+        return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).digest()
+
+    def unchanged(self, key, digest: bytes) -> bool:
+        if self._digests.get(key) == digest:
+            self._digests.move_to_end(key)
+            return True
+        return False
+
+    def store(self, key, digest: bytes):
+        self._digests[key] = digest
+        self._digests.move_to_end(key)
+        while len(self._digests) > self.max_entries:
+            self._digests.popitem(last=False)
+
+render_cache = RenderCache()
+
+async def safe_edit(query, text: str, reply_markup=None, **kwargs):
+    """Edit the message unless it would come out the same (no API call then)"""
+    if query.message:
+        key = (query.message.chat_id, query.message.message_id)
+    else:
+        key = query.inline_message_id
+    digest = RenderCache.digest(text, reply_markup, **kwargs)
+    if render_cache.unchanged(key, digest):
+        render_cache.skipped += 1
+        return None
+    try:
+        result = await query.edit_message_text(text, reply_markup=reply_markup, **kwargs)
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+        result = None
+    render_cache.store(key, digest)
+    return result
 
 # ==================== BOT HANDLERS ====================
 class BotHandlers:
     """Bot command handlers"""
     
     def __init__(self):
-        self.user_data = {}
+        # PersistentDict only saves assignments: each step re-assigns
+        # self.user_data[uid] = data after changing it, never just mutates the dict
+        self.user_data = per_user_state("add_server")
     
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /start command"""
         user = update.effective_user
         
         welcome = f"""
-🤖 **Welcome {user.first_name}!**
+🤖 **Welcome {Messages.md(user.first_name)}!**
 
 Select your internet provider to get server information.
 Each server comes with easy copy buttons for quick setup.
@@ -382,6 +1609,100 @@ Need help? Contact admin.
         
         await update.message.reply_text(help_text, parse_mode="Markdown")
     
+    async def import_servers(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle an uploaded CSV/JSON server list (admin only)"""
+        user = update.effective_user
+        if user.id not in ADMIN_IDS:
+            return
+        
+        document = update.message.document
+        filename = document.file_name or ""
+        if not filename.lower().endswith((".csv", ".json")):
+            await update.message.reply_text("❌ Send a .csv or .json file to import servers.")
+            return
+        if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+            await update.message.reply_text("❌ File is too large to import.")
+            return
+        
+        tg_file = await context.bot.get_file(document.file_id)
+        content = bytes(await tg_file.download_as_bytearray())
+        
+        loop = asyncio.get_running_loop()
+        try:
+            rows, errors = await loop.run_in_executor(None, parse_server_file, content, filename)
+        except (UnicodeDecodeError, ValueError, csv.Error) as e:
+            await update.message.reply_text(f"❌ Could not read {filename}: {e}")
+            return
+        
+        if errors:
+            shown = "\n".join(errors[:10])
+            more = f"\n…and {len(errors) - 10} more" if len(errors) > 10 else ""
+            await update.message.reply_text(
+                f"❌ Nothing imported, {len(errors)} invalid rows:\n{shown}{more}"
+            )
+            return
+        if not rows:
+            await update.message.reply_text("❌ No servers found in the file.")
+            return
+        
+        replace = (update.message.caption or "").strip().lower() == "replace"
+        count = await loop.run_in_executor(None, db.bulk_add_servers, rows, replace)
+        logger.info("Imported %d servers from %s (replace=%s)", count, filename, replace)
+        await update.message.reply_text(
+            f"✅ Imported {count} servers" + (" (replaced existing plans)" if replace else ""),
+            reply_markup=Keyboards.admin_menu()
+        )
+    
+    async def inline_query(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Answer @bot <query> with the user's server for each matching plan
+        
+        Read-only: shows the current assignment or the best candidate, so typing
+        a query never assigns servers or moves the rotation.
+        """
+        query = update.inline_query
+        user_id = query.from_user.id
+        plans = plan_index.search(query.query)
+        assigned = [a for a in (assigner.assigned_id(user_id, *p) for p in plans) if a is not None]
+        loop = asyncio.get_running_loop()
+        by_plan = await loop.run_in_executor(
+            None, db.get_plan_servers, plans, INLINE_CANDIDATES, assigned, assigner.order
+        )
+        results = []
+        for provider, plan in plans:
+            servers = prober.rank(by_plan[(provider, plan)])
+            server = assigner.preview(user_id, provider, plan, servers)
+            if not server:
+                continue
+            results.append(InlineQueryResultArticle(
+                id=str(server['id']),
+                title=plan,
+                description=f"{provider.upper()} · {server['server_ip']}",
+                input_message_content=InputTextMessageContent(
+                    Messages.server_info(server), parse_mode="Markdown"
+                )
+            ))
+        
+        # Answers depend on the user's sticky assignment, so cache them per user
+        await query.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=True)
+    
+    async def set_weight(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /weight <server_id> <weight> (admin only)"""
+        user = update.effective_user
+        if user.id not in ADMIN_IDS:
+            await update.message.reply_text("❌ Admin only!")
+            return
+        try:
+            server_id, weight = int(context.args[0]), int(context.args[1])
+        except (IndexError, ValueError):
+            await update.message.reply_text("Usage: /weight <server_id> <weight>")
+            return
+        if weight < 1:
+            await update.message.reply_text("❌ Weight must be at least 1.")
+        elif db.set_weight(server_id, weight):
+            await update.message.reply_text(f"✅ Server {server_id} weight set to {weight}.")
+        else:
+            await update.message.reply_text("❌ Server not found!")
+    
     async def button_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle all button presses"""
         query = update.callback_query
@@ -397,7 +1718,8 @@ Need help? Contact admin.
         # Provider selection
         elif data.startswith("provider_"):
             provider = data.replace("provider_", "")
-            await query.edit_message_text(
+            await safe_edit(
+                query,
                 f"📡 **{provider.upper()} Plans**\n\nSelect a plan:",
                 reply_markup=Keyboards.provider_menu(provider),
                 parse_mode="Markdown"
@@ -410,6 +1732,14 @@ Need help? Contact admin.
             plan = "_".join(parts[2:])
             await self.show_servers(query, provider, plan)
         
+        # Prev/next server within a plan
+        elif data.startswith("server_"):
+            server = db.get_server(int(data.replace("server_", "")))
+            if server:
+                await self.show_server_card(query, server)
+            else:
+                await query.answer("❌ Server not found!", show_alert=True)
+        
         # Copy buttons
         elif data.startswith("copy_"):
             parts = data.split("_")
@@ -419,13 +1749,15 @@ Need help? Contact admin.
         
         # Donation
         elif data == "donate":
-            await query.edit_message_text(
+            await safe_edit(
+                query,
                 Messages.donate_info(),
                 reply_markup=Keyboards.donate_menu(),
                 parse_mode="Markdown"
             )
         elif data == "donate_truemoney":
-            await query.edit_message_text(
+            await safe_edit(
+                query,
                 Messages.donate_info(),
                 reply_markup=Keyboards.donate_menu(),
                 parse_mode="Markdown"
@@ -434,7 +1766,8 @@ Need help? Contact admin.
         # Admin panel
         elif data == "admin_panel":
             if user.id in ADMIN_IDS:
-                await query.edit_message_text(
+                await safe_edit(
+                    query,
                     "👑 **Admin Panel**\n\nSelect an action:",
                     reply_markup=Keyboards.admin_menu(),
                     parse_mode="Markdown"
@@ -445,7 +1778,8 @@ Need help? Contact admin.
         # Admin add server
         elif data == "admin_add":
             if user.id in ADMIN_IDS:
-                await query.edit_message_text(
+                await safe_edit(
+                    query,
                     "➕ **Add Server**\n\nSelect provider:",
                     reply_markup=Keyboards.admin_add_menu(),
                     parse_mode="Markdown"
@@ -458,7 +1792,8 @@ Need help? Contact admin.
                 provider = data.replace("add_", "")
                 self.user_data[user.id] = {"provider": provider}
                 
-                await query.edit_message_text(
+                await safe_edit(
+                    query,
                     f"📱 **Provider:** {provider.upper()}\n\nSelect plan:",
                     reply_markup=Keyboards.admin_plan_menu(provider),
                     parse_mode="Markdown"
@@ -474,8 +1809,9 @@ Need help? Contact admin.
                 
                 self.user_data[user.id] = {"provider": provider, "plan": plan}
                 
-                await query.edit_message_text(
-                    f"📋 **Plan:** {plan}\n\n"
+                await safe_edit(
+                    query,
+                    f"📋 **Plan:** {Messages.md(plan)}\n\n"
                     "📡 **Enter Server IP:**\n\n"
                     "Example: `192.168.1.1` or `vpn.server.com`",
                     parse_mode="Markdown"
@@ -485,29 +1821,27 @@ Need help? Contact admin.
                 await query.answer("❌ Admin only!", show_alert=True)
                 return ConversationHandler.END
         
-        # Admin delete server
-        elif data == "admin_delete":
+        # Admin delete server (paged: admindel_n_<last id> / admindel_p_<first id>)
+        elif data == "admin_delete" or data.startswith("admindel_"):
             if user.id in ADMIN_IDS:
-                servers = db.get_servers()
+                after_id = before_id = None
+                if data.startswith("admindel_n_"):
+                    after_id = int(data.replace("admindel_n_", ""))
+                elif data.startswith("admindel_p_"):
+                    before_id = int(data.replace("admindel_p_", ""))
+                servers, has_prev, has_next = db.get_servers_page(
+                    ADMIN_PAGE_SIZE, after_id=after_id, before_id=before_id
+                )
                 if servers:
-                    message = "🗑️ **Delete Server**\n\n"
-                    keyboard = []
-                    
-                    for server in servers[:10]:  # Show first 10
-                        btn_text = f"❌ {server['server_ip']} ({server['plan']})"
-                        keyboard.append([
-                            InlineKeyboardButton(btn_text, callback_data=f"delete_{server['id']}")
-                        ])
-                    
-                    keyboard.append([InlineKeyboardButton("🔙 Admin Panel", callback_data="admin_panel")])
-                    
-                    await query.edit_message_text(
-                        message,
-                        reply_markup=InlineKeyboardMarkup(keyboard),
+                    await safe_edit(
+                        query,
+                        "🗑️ **Delete Server**\n\n",
+                        reply_markup=Keyboards.delete_list(servers, has_prev, has_next),
                         parse_mode="Markdown"
                     )
                 else:
-                    await query.edit_message_text(
+                    await safe_edit(
+                        query,
                         "📭 No servers to delete.",
                         reply_markup=Keyboards.admin_menu()
                     )
@@ -519,12 +1853,14 @@ Need help? Contact admin.
                 if data.startswith("delete_yes_"):
                     server_id = int(data.replace("delete_yes_", ""))
                     if db.delete_server(server_id):
-                        await query.edit_message_text(
+                        await safe_edit(
+                            query,
                             "✅ Server deleted successfully!",
                             reply_markup=Keyboards.admin_menu()
                         )
                     else:
-                        await query.edit_message_text(
+                        await safe_edit(
+                            query,
                             "❌ Failed to delete server.",
                             reply_markup=Keyboards.admin_menu()
                         )
@@ -533,11 +1869,12 @@ Need help? Contact admin.
                     server = db.get_server(server_id)
                     
                     if server:
-                        await query.edit_message_text(
+                        await safe_edit(
+                            query,
                             f"⚠️ **Confirm Delete**\n\n"
-                            f"Plan: {server['plan']}\n"
-                            f"IP: {server['server_ip']}\n"
-                            f"Username: {server['username']}\n\n"
+                            f"Plan: {Messages.md(server['plan'])}\n"
+                            f"IP: {Messages.md(server['server_ip'])}\n"
+                            f"Username: {Messages.md(server['username'])}\n\n"
                             f"Are you sure?",
                             reply_markup=Keyboards.delete_confirmation(server_id),
                             parse_mode="Markdown"
@@ -545,27 +1882,86 @@ Need help? Contact admin.
             else:
                 await query.answer("❌ Admin only!", show_alert=True)
         
-        # Admin list servers
-        elif data == "admin_list":
+        # Admin bulk import instructions (the document itself goes to import_servers)
+        elif data == "admin_import":
+            if user.id in ADMIN_IDS:
+                await safe_edit(
+                    query,
+                    "📥 **Bulk Import**\n\n"
+                    "Send a `.csv` or `.json` file with the columns:\n"
+                    f"`{','.join(IMPORT_FIELDS)}` (optional `weight`).\n\n"
+                    "A file from 📤 Export CSV or JSON works as-is. Caption it `replace` to "
+                    "swap out the current servers of the plans in the file.",
+                    reply_markup=Keyboards.admin_menu(),
+                    parse_mode="Markdown"
+                )
+            else:
+                await query.answer("❌ Admin only!", show_alert=True)
+        
+        # Admin export all servers as a CSV or JSON document
+        elif data in ("admin_export", "admin_export_json"):
+            if user.id in ADMIN_IDS:
+                if data == "admin_export_json":
+                    write, filename = Messages.server_json, "servers.json"
+                else:
+                    write, filename = Messages.server_csv, "servers.csv"
+                # Rows are paged out of the database into temp files. PTB reads a
+                # whole document into memory to upload it, so a large export is
+                # split into parts of about EXPORT_PART_BYTES
+                loop = asyncio.get_running_loop()
+                rows = db.iter_servers()
+                part = 1
+                while True:
+                    with tempfile.TemporaryFile() as out:
+                        if not await loop.run_in_executor(None, Messages.export_part, write, rows, out, part == 1):
+                            break
+                        out.seek(0)
+                        stem, ext = os.path.splitext(filename)
+                        await context.bot.send_document(
+                            chat_id=query.message.chat_id,
+                            document=InputFile(out, filename=filename if part == 1 else f"{stem}-{part}{ext}"),
+                            caption="📤 Server export" if part == 1 else f"📤 Server export, part {part}"
+                        )
+                    part += 1
+            else:
+                await query.answer("❌ Admin only!", show_alert=True)
+        
+        # Admin list servers (paged: adminlist_n_<last id> / adminlist_p_<first id>)
+        elif data == "admin_list" or data.startswith("adminlist_"):
             if user.id in ADMIN_IDS:
-                servers = db.get_servers()
+                after_id = before_id = None
+                if data.startswith("adminlist_n_"):
+                    after_id = int(data.replace("adminlist_n_", ""))
+                elif data.startswith("adminlist_p_"):
+                    before_id = int(data.replace("adminlist_p_", ""))
+                servers, has_prev, has_next = db.get_servers_page(
+                    ADMIN_LIST_PAGE_SIZE, after_id=after_id, before_id=before_id
+                )
                 
                 if servers:
-                    message = "📋 **All Servers**\n\n"
-                    for server in servers:
-                        message += f"• {server['plan']}\n"
-                        message += f"  IP: `{server['server_ip']}`\n"
-                        message += f"  User: `{server['username']}`\n"
-                        message += f"  Expires: {server['expired_date']}\n"
-                        message += f"  Copies: {server.get('copy_count', 0)}\n\n"
+                    header = "📋 **All Servers**\n\n"
+                    records = [Messages.server_list_entry(server) for server in servers]
+                    # Cut at a record boundary; the rest starts the next page
+                    shown = max(1, Messages.fit_records(header, records))
+                    if shown < len(servers):
+                        if before_id is not None:
+                            servers, records = servers[-shown:], records[-shown:]
+                            has_prev = True
+                        else:
+                            servers, records = servers[:shown], records[:shown]
+                            has_next = True
                     
-                    await query.edit_message_text(
-                        message[:4000],
-                        reply_markup=Keyboards.admin_menu(),
+                    await safe_edit(
+                        query,
+                        header + "".join(records),
+                        reply_markup=Keyboards.server_list_nav(
+                            servers[0]['id'], servers[-1]['id'], has_prev, has_next
+                        ),
                         parse_mode="Markdown"
                     )
                 else:
-                    await query.edit_message_text(
+                    await safe_edit(
+                        query,
                         "📭 No servers found.",
                         reply_markup=Keyboards.admin_menu()
                     )
@@ -575,29 +1971,42 @@ Need help? Contact admin.
     async def show_main_menu(self, query):
         """Show main menu"""
         user = query.from_user
-        await query.edit_message_text(
+        await safe_edit(
+            query,
             "🤖 **Select Provider:**",
             reply_markup=Keyboards.main_menu(user.id),
             parse_mode="Markdown"
         )
     
     async def show_servers(self, query, provider: str, plan: str):
-        """Show servers for a plan"""
-        servers = db.get_servers(provider=provider, plan=plan)
+        """Show the server assigned to this user for a plan (prev/next buttons browse the rest)"""
+        server = assigner.pick(query.from_user.id, provider, plan)
         
-        if not servers:
-            await query.edit_message_text(
-                f"📭 **No servers available for {plan}**\n\n"
+        if not server:
+            await safe_edit(
+                query,
+                f"📭 *No servers available for* {Messages.md(plan)}\n\n"
                 "Please check back later or try another plan.",
-                reply_markup=Keyboards.provider_menu(provider)
+                reply_markup=Keyboards.provider_menu(provider),
+                parse_mode="Markdown"
             )
             return
         
-        # Show first server
-        server = servers[0]
-        await query.edit_message_text(
-            Messages.server_info(server),
-            reply_markup=Keyboards.server_menu(server['id'], provider, plan),
+        await self.show_server_card(query, server)
+    
+    async def show_server_card(self, query, server: Dict):
+        """Render one server with copy buttons and its plan neighbours"""
+        prev_id, next_id = db.get_neighbor_ids(server['id'])
+        text = Messages.server_info(server)
+        status = prober.status_line(server['server_ip'])
+        if status:
+            text = f"{text.rstrip()}\n{status}"
+        await safe_edit(
+            query,
+            text,
+            reply_markup=Keyboards.server_menu(
+                server['id'], server['provider'], server['plan'], prev_id, next_id
+            ),
             parse_mode="Markdown"
         )
     
@@ -633,14 +2042,7 @@ Need help? Contact admin.
         
         # Refresh message with updated count
         server = db.get_server(server_id)
-        provider = server['provider']
-        plan = server['plan']
-        
-        await query.edit_message_text(
-            Messages.server_info(server),
-            reply_markup=Keyboards.server_menu(server_id, provider, plan),
-            parse_mode="Markdown"
-        )
+        await self.show_server_card(query, server)
     
     # ========== CONVERSATION HANDLERS ==========
     async def add_server_ip(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -651,15 +2053,16 @@ Need help? Contact admin.
             await update.message.reply_text("❌ Admin only!")
             return ConversationHandler.END
         
-        server_ip = update.message.text.strip()
-        
-        if user.id not in self.user_data:
-            self.user_data[user.id] = {}
+        data = self.user_data.get(user.id)
+        if data is None:
+            return await self.flow_expired(update)
         
-        self.user_data[user.id]["server_ip"] = server_ip
+        server_ip = update.message.text.strip()
+        data["server_ip"] = server_ip
+        self.user_data[user.id] = data
         
         await update.message.reply_text(
-            f"🌐 **Server IP:** `{server_ip}`\n\n"
+            f"🌐 **Server IP:** {Messages.code(server_ip)}\n\n"
             "👤 **Enter Username:**\n\n"
             "Example: `user123`",
             parse_mode="Markdown"
@@ -674,11 +2077,16 @@ Need help? Contact admin.
             await update.message.reply_text("❌ Admin only!")
             return ConversationHandler.END
         
+        data = self.user_data.get(user.id)
+        if data is None:
+            return await self.flow_expired(update)
+        
         username = update.message.text.strip()
-        self.user_data[user.id]["username"] = username
+        data["username"] = username
+        self.user_data[user.id] = data
         
         await update.message.reply_text(
-            f"👤 **Username:** `{username}`\n\n"
+            f"👤 **Username:** {Messages.code(username)}\n\n"
             "🔑 **Enter Password:**\n\n"
             "Example: `password123`",
             parse_mode="Markdown"
@@ -693,11 +2101,16 @@ Need help? Contact admin.
             await update.message.reply_text("❌ Admin only!")
             return ConversationHandler.END
         
+        data = self.user_data.get(user.id)
+        if data is None:
+            return await self.flow_expired(update)
+        
         password = update.message.text.strip()
-        self.user_data[user.id]["password"] = password
+        data["password"] = password
+        self.user_data[user.id] = data
         
         await update.message.reply_text(
-            f"🔑 **Password:** `{password}`\n\n"
+            f"🔑 **Password:** {Messages.code(password)}\n\n"
             "📅 **Enter Expiry Date:**\n\n"
             "Format: `YYYY-MM-DD` or `DD/MM/YYYY`\n"
             "Example: `2024-12-31`",
@@ -713,21 +2126,24 @@ Need help? Contact admin.
             await update.message.reply_text("❌ Admin only!")
             return ConversationHandler.END
         
+        data = self.user_data.get(user.id)
+        if data is None:
+            return await self.flow_expired(update)
+        
         expired_date = update.message.text.strip()
-        self.user_data[user.id]["expired_date"] = expired_date
+        data["expired_date"] = expired_date
+        self.user_data[user.id] = data
         
         # Show confirmation
-        data = self.user_data[user.id]
-        
         confirm_text = f"""
 ✅ **Confirm Server Details**
 
-📱 **Provider:** {data['provider'].upper()}
-📋 **Plan:** {data['plan']}
-🌐 **Server IP:** `{data['server_ip']}`
-👤 **Username:** `{data['username']}`
-🔑 **Password:** `{data['password']}`
-📅 **Expiry Date:** `{data['expired_date']}`
+📱 **Provider:** {Messages.md(data['provider'].upper())}
+📋 **Plan:** {Messages.md(data['plan'])}
+🌐 **Server IP:** {Messages.code(data['server_ip'])}
+👤 **Username:** {Messages.code(data['username'])}
+🔑 **Password:** {Messages.code(data['password'])}
+📅 **Expiry Date:** {Messages.code(data['expired_date'])}
 
 **Add this server?**
         """
@@ -754,7 +2170,7 @@ Need help? Contact admin.
         user = query.from_user
         
         if user.id not in ADMIN_IDS or user.id not in self.user_data:
-            await query.edit_message_text("❌ Session expired.")
+            await safe_edit(query, "❌ Session expired.")
             return ConversationHandler.END
         
         data = self.user_data[user.id]
@@ -770,11 +2186,12 @@ Need help? Contact admin.
                 expired_date=data['expired_date']
             )
             
-            await query.edit_message_text(
+            await safe_edit(
+                query,
                 f"🎉 **Server Added Successfully!**\n\n"
                 f"🆔 Server ID: #{server_id}\n"
-                f"📡 IP: {data['server_ip']}\n"
-                f"👤 Username: {data['username']}\n\n"
+                f"📡 IP: {Messages.md(data['server_ip'])}\n"
+                f"👤 Username: {Messages.md(data['username'])}\n\n"
                 f"Users can now access this server.",
                 reply_markup=Keyboards.admin_menu(),
                 parse_mode="Markdown"
@@ -785,14 +2202,23 @@ Need help? Contact admin.
                 del self.user_data[user.id]
             
         except Exception as e:
-            logger.error(f"Error adding server: {e}")
-            await query.edit_message_text(
+            logger.error("Error adding server: %s", e)
+            await safe_edit(
+                query,
                 f"❌ Error: {str(e)}",
                 reply_markup=Keyboards.admin_menu()
             )
         
         return ConversationHandler.END
     
+    async def flow_expired(self, update: Update):
+        """End an add-server flow whose data expired (STATE_TTL)"""
+        await update.message.reply_text(
+            "⌛ Session expired. Please start again from the Admin Panel.",
+            reply_markup=Keyboards.admin_menu()
+        )
+        return ConversationHandler.END
+    
     async def cancel(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Cancel any operation"""
         user = update.effective_user
@@ -800,6 +2226,11 @@ Need help? Contact admin.
         if user.id in self.user_data:
             del self.user_data[user.id]
         
+        # "Admin Panel" tapped on the confirmation: end the flow and show the panel
+        if update.callback_query:
+            await self.button_handler(update, context)
+            return ConversationHandler.END
+        
         await update.message.reply_text(
             "❌ Operation cancelled.",
             reply_markup=Keyboards.main_menu(user.id)
@@ -807,30 +2238,37 @@ Need help? Contact admin.
         return ConversationHandler.END
 
 # ==================== MAIN APPLICATION ====================
-def main():
-    """Main function"""
-    # Check token
-    if BOT_TOKEN == "YOUR_BOT_TOKEN_HERE":
-        print("\n" + "="*60)
-        print("❌ ERROR: Please update BOT_TOKEN in the script!")
-        print("1. Open bot.py with nano or vim")
-        print("2. Find line: BOT_TOKEN = \"YOUR_BOT_TOKEN_HERE\"")
-        print("3. Replace with your bot token from @BotFather")
-        print("4. Also update ADMIN_IDS with your Telegram ID")
-        print("="*60 + "\n")
-        return
-    
-    # Create application
-    app = Application.builder().token(BOT_TOKEN).build()
+async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    logger.error(
+        "Error while handling update: %s", type(context.error).__name__,
+        exc_info=context.error,
+        extra={"ctx": describe_update(update)}
+    )
+
+_first_update_logged = False
+
+async def log_first_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Log restart-to-first-update time once per process"""
+    global _first_update_logged
+    if not _first_update_logged:
+        _first_update_logged = True
+        logger.info("First update %.2fs after process start", process_uptime())
+
+def register_handlers(app: Application):
+    """Add all bot handlers to an application"""
     handlers = BotHandlers()
     
+    # Group -1 runs before (and never blocks) the handlers below
+    app.add_handler(TypeHandler(Update, log_first_update), group=-1)
+    
     # Add command handlers
     app.add_handler(CommandHandler("start", handlers.start))
     app.add_handler(CommandHandler("help", handlers.help))
     app.add_handler(CommandHandler("cancel", handlers.cancel))
+    app.add_handler(CommandHandler("weight", handlers.set_weight))
     
-    # Add callback query handler
-    app.add_handler(CallbackQueryHandler(handlers.button_handler, pattern="^(?!confirm_add|delete_yes_).*"))
+    # Inline mode
+    app.add_handler(InlineQueryHandler(handlers.inline_query))
     
     # Add conversation handler for adding servers
     conv_handler = ConversationHandler(
@@ -856,30 +2294,153 @@ def main():
                 CallbackQueryHandler(handlers.cancel, pattern="^admin_panel$")
             ]
         },
-        fallbacks=[CommandHandler("cancel", handlers.cancel)]
+        fallbacks=[CommandHandler("cancel", handlers.cancel)],
+        name="add_server",
+        persistent=True
     )
     app.add_handler(conv_handler)
     
+    # Generic callbacks go after the conversation: a group stops at its first
+    # matching handler, so addplan_ taps must reach conv_handler first
+    app.add_handler(CallbackQueryHandler(handlers.button_handler, pattern="^(?!confirm_add|delete_yes_).*"))
+    
+    # Bulk import documents from admins
+    app.add_handler(MessageHandler(
+        filters.Document.ALL & filters.User(user_id=ADMIN_IDS), handlers.import_servers
+    ))
+    
     # Add confirm delete handler separately
     app.add_handler(CallbackQueryHandler(handlers.button_handler, pattern="^confirm_add$|^delete_yes_"))
     
     # Error handler
-    async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        logger.error(f"Error: {context.error}")
-        if update:
-            logger.error(f"Update: {update}")
-    
     app.add_error_handler(error_handler)
+
+# ==================== SHARDING ====================
+def shard_for(update: Update, shards: int) -> int:
+    """Same chat always goes to the same worker (keeps conversation state local)"""
+    if update.effective_chat:
+        key = update.effective_chat.id
+    elif update.effective_user:
+        key = update.effective_user.id
+    else:
+        key = update.update_id
+    return key % shards
+
+def run_app(app: Application):
+    """Receive updates by webhook when WEBHOOK_URL is set, else by polling"""
+    if WEBHOOK_URL:
+        app.run_webhook(listen="0.0.0.0", port=WEBHOOK_PORT, url_path=WEBHOOK_PATH,
+                        webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                        allowed_updates=Update.ALL_TYPES)
+    else:
+        app.run_polling(allowed_updates=Update.ALL_TYPES)
+
+def application_builder():
+    """Builder with persistence and the state flusher preset"""
+    async def post_init(app: Application):
+        app.create_task(flush_state_loop())
+        app.create_task(prober.run())
+        logger.info("Ready %.2fs after process start", process_uptime())
+    
+    return (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .persistence(SQLitePersistence(state_store))
+        .post_init(post_init)
+    )
+
+def run_worker(index: int, inbox):
+    """Worker process: dispatch updates routed to it by the front process"""
+    setup_logging(f"bot-worker{index}")
+    
+    async def consume():
+        app = application_builder().updater(None).build()
+        register_handlers(app)
+        async with app:
+            await app.start()
+            # post_init only runs under run_polling, so start the background tasks here;
+            # the front process probes, workers just read its results
+            app.create_task(flush_state_loop())
+            app.create_task(prober.follow())
+            logger.info("Worker %d ready (pid %d)", index, os.getpid())
+            loop = asyncio.get_running_loop()
+            while True:
+                payload = await loop.run_in_executor(None, inbox.get)
+                if payload is None:
+                    break
+                await app.update_queue.put(Update.de_json(json.loads(payload), app.bot))
+            await app.stop()
+    
+    asyncio.run(consume())
+
+def run_sharded():
+    """Front process: receive updates (polling or webhook) and route each to a worker by chat_id"""
+    import multiprocessing
+    
+    mp = multiprocessing.get_context("fork")
+    inboxes = [mp.Queue(maxsize=10000) for _ in range(WORKERS)]
+    workers = [
+        mp.Process(target=run_worker, args=(i, inbox), name=f"worker-{i}", daemon=True)
+        for i, inbox in enumerate(inboxes)
+    ]
+    for worker in workers:
+        worker.start()
+    
+    async def route(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        inboxes[shard_for(update, WORKERS)].put(json.dumps(update.to_dict()))
+        raise ApplicationHandlerStop
+    
+    async def post_init(app: Application):
+        # Probe once for all workers
+        app.create_task(prober.run())
+    
+    app = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
+    app.add_handler(TypeHandler(Update, route))
+    try:
+        run_app(app)
+    finally:
+        for inbox in inboxes:
+            inbox.put(None)
+        for worker in workers:
+            worker.join(timeout=10)
+
+def main():
+    """Main function"""
+    # Check token
+    if BOT_TOKEN == "YOUR_BOT_TOKEN_HERE":
+        print("\n" + "="*60)
+        print("❌ ERROR: Please update BOT_TOKEN in the script!")
+        print("1. Open bot.py with nano or vim")
+        print("2. Find line: BOT_TOKEN = \"YOUR_BOT_TOKEN_HERE\"")
+        print("3. Replace with your bot token from @BotFather")
+        print("4. Also update ADMIN_IDS with your Telegram ID")
+        print("="*60 + "\n")
+        return
+    
+    setup_logging()
+    db.init_db()
     
     # Start bot
     print("\n" + "="*60)
     print("🤖 Server Information Bot Starting...")
     print(f"👑 Admin IDs: {ADMIN_IDS}")
     print("💾 Database: servers.db")
-    print("📁 Logs: logs/ directory")
+    print(f"📁 Logs: {LOG_DIR}/bot.log (JSON, rotated daily and at 10 MB)")
+    if WORKERS > 1:
+        print(f"🧩 Workers: {WORKERS} (updates split by chat_id)")
+    if WEBHOOK_URL:
+        print(f"🌐 Webhook: {WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH} (port {WEBHOOK_PORT})")
     print("="*60 + "\n")
     
-    app.run_polling(allowed_updates=Update.ALL_UPDATES)
+    if WORKERS > 1:
+        run_sharded()
+        return
+    
+    # Create application
+    app = application_builder().build()
+    register_handlers(app)
+    
+    run_app(app)
 
 if __name__ == "__main__":
     try:
@@ -888,4 +2449,4 @@ if __name__ == "__main__":
         print("\n👋 Bot stopped by user")
     except Exception as e:
         print(f"\n❌ Error: {e}")
-        logger.error(f"Bot crashed: {e}")
+        logger.error("Bot crashed: %s", e)
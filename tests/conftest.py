@@ -0,0 +1,39 @@
+import importlib.util
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope="session")
+def embedded_bot(tmp_path_factory):
+    """The bot that bot.py writes out, imported from its BOT_CODE string."""
+    pytest.importorskip("telegram")
+    installer = load_module("bot_installer", ROOT / "bot.py")
+    path = tmp_path_factory.mktemp("embedded") / "embedded_bot.py"
+    path.write_text(installer.BOT_CODE)
+    return load_module("embedded_bot", path)
+
+
+@pytest.fixture(scope="session")
+def server_bot():
+    pytest.importorskip("telegram")
+    return load_module("server_bot", ROOT / "server_bot.py")
+
+
+@pytest.fixture
+def db(server_bot, tmp_path, monkeypatch):
+    """server_bot's Database on a fresh servers.db."""
+    monkeypatch.setattr(server_bot, "DB_NAME", str(tmp_path / "servers.db"))
+    server_bot.db.init_db()
+    return server_bot.db
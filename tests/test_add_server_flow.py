@@ -0,0 +1,86 @@
+"""The add-server conversation must receive addplan_ taps routed by register_handlers."""
+import asyncio
+
+import pytest
+
+
+@pytest.fixture
+def app(server_bot, db, monkeypatch):
+    from telegram.ext import Application, ExtBot
+
+    monkeypatch.setattr(server_bot.state_store, "path", server_bot.DB_NAME)
+    monkeypatch.setattr(server_bot.state_store, "_db", None)
+    monkeypatch.setattr(server_bot.state_store, "_reader", None)
+    monkeypatch.setattr(server_bot.state_store, "_dicts", [])
+
+    sent = []
+
+    async def noop(self, *args, **kwargs):
+        return True
+
+    async def record_edit(query, text, reply_markup=None, **kwargs):
+        sent.append(("edit", text))
+
+    async def record_send(self, chat_id, text, *args, **kwargs):
+        sent.append(("send", text))
+
+    monkeypatch.setattr(ExtBot, "initialize", noop)
+    monkeypatch.setattr(ExtBot, "shutdown", noop)
+    monkeypatch.setattr(ExtBot, "answer_callback_query", noop)
+    monkeypatch.setattr(ExtBot, "send_message", record_send)
+    monkeypatch.setattr(server_bot, "safe_edit", record_edit)
+
+    application = (
+        Application.builder().token("1:x")
+        .persistence(server_bot.SQLitePersistence(server_bot.state_store))
+        .build()
+    )
+    server_bot.register_handlers(application)
+    application.sent = sent
+    return application
+
+
+def callback(update_id, data, user_id):
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id), "chat_instance": "1", "data": data,
+            "from": {"id": user_id, "is_bot": False, "first_name": "A"},
+            "message": {
+                "message_id": 10, "date": 0, "text": "menu",
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": 1, "is_bot": True, "first_name": "Bot"},
+            },
+        },
+    }
+
+
+def text_message(update_id, text, user_id):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": 0, "text": text,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "A"},
+        },
+    }
+
+
+def test_addplan_tap_enters_the_conversation(server_bot, app):
+    from telegram import Update
+
+    admin = server_bot.ADMIN_IDS[0]
+    conv = next(h for h in app.handlers[0] if getattr(h, "name", None) == "add_server")
+
+    async def scenario():
+        async with app:
+            await app.process_update(Update.de_json(callback(1, "addplan_dtac_DTAC NOPRO", admin), app.bot))
+            state = conv._conversations.get((admin, admin))
+            await app.process_update(Update.de_json(text_message(2, "10.0.0.1", admin), app.bot))
+            return state, conv._conversations.get((admin, admin))
+
+    state_after_tap, state_after_ip = asyncio.run(scenario())
+    assert state_after_tap == server_bot.ADD_SERVER_IP
+    assert state_after_ip == server_bot.ADD_SERVER_USERNAME
+    assert app.sent[0][0] == "edit" and "Enter Server IP" in app.sent[0][1]
+    assert app.sent[1][0] == "send" and "Enter Username" in app.sent[1][1]
@@ -0,0 +1,35 @@
+"""Download counters must not touch the category folders and must add up across workers."""
+
+
+def test_flush_leaves_category_folders_untouched(embedded_bot, tmp_path, monkeypatch):
+    monkeypatch.setattr(embedded_bot, "BASE_DIR", tmp_path / "files")
+    cat = next(iter(embedded_bot.CATEGORIES))
+    folder = embedded_bot.category_folder(cat)
+    (folder / "a.ovpn").write_text("x")
+    stamp = folder.stat().st_mtime_ns
+
+    stats = embedded_bot.DownloadStats(tmp_path / "activity.db")
+    for _ in range(3):
+        stats.record(cat, "a.ovpn")
+    stats.flush()
+
+    assert folder.stat().st_mtime_ns == stamp
+    assert stats.counts(cat) == {"a.ovpn": 3}
+
+
+def test_leaderboard_includes_every_workers_downloads(embedded_bot, tmp_path, monkeypatch):
+    monkeypatch.setattr(embedded_bot, "BASE_DIR", tmp_path / "files")
+    cat = next(iter(embedded_bot.CATEGORIES))
+    path = tmp_path / "activity.db"
+    worker_a, worker_b = embedded_bot.DownloadStats(path), embedded_bot.DownloadStats(path)
+    for stats, name, n in ((worker_a, "a.ovpn", 2), (worker_b, "a.ovpn", 2), (worker_b, "b.ovpn", 3)):
+        for _ in range(n):
+            stats.record(cat, name)
+        stats.flush()
+
+    assert worker_a.top(2) == [(cat, "a.ovpn", 4), (cat, "b.ovpn", 3)]
+
+    worker_a.forget(cat, "a.ovpn")
+    assert worker_a.top(2) == [(cat, "b.ovpn", 3)]
+    worker_a.flush()
+    assert worker_b.top(2) == [(cat, "b.ovpn", 3)]
@@ -0,0 +1,88 @@
+"""HealthProber against real sockets on 127.0.0.1."""
+import asyncio
+import socket
+import time
+
+
+async def open_server():
+    async def handle(reader, writer):
+        writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    return server, server.sockets[0].getsockname()[1]
+
+
+def closed_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_open_port_is_up_with_latency(server_bot):
+    async def scenario():
+        server, port = await open_server()
+        async with server:
+            prober = server_bot.HealthProber(timeout=2)
+            return await prober.check([f"127.0.0.1:{port}"]), port
+
+    results, port = asyncio.run(scenario())
+    up, latency, checked_at = results[f"127.0.0.1:{port}"]
+    assert up
+    assert 0 <= latency < 2
+    assert checked_at <= time.time()
+
+
+def test_closed_port_is_down(server_bot):
+    port = closed_port()
+    prober = server_bot.HealthProber(timeout=2)
+    results = asyncio.run(prober.check([f"127.0.0.1:{port}"]))
+    assert results[f"127.0.0.1:{port}"][:2] == (False, None)
+    assert not prober.is_up(f"127.0.0.1:{port}")
+
+
+def test_unanswered_connect_is_down_within_timeout(server_bot, monkeypatch):
+    async def blackhole(host, port):
+        await asyncio.sleep(60)
+
+    monkeypatch.setattr(server_bot.asyncio, "open_connection", blackhole)
+    prober = server_bot.HealthProber(timeout=0.2)
+    started = time.monotonic()
+    results = asyncio.run(prober.check(["192.0.2.1:22"]))
+    assert results["192.0.2.1:22"][0] is False
+    assert time.monotonic() - started < 1
+
+
+def test_semaphore_bounds_concurrent_connects(server_bot, monkeypatch):
+    in_flight = peak = 0
+    real_open = asyncio.open_connection
+
+    async def counting_open(host, port):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        try:
+            await asyncio.sleep(0.02)
+            return await real_open(host, port)
+        finally:
+            in_flight -= 1
+
+    async def scenario():
+        server, port = await open_server()
+        async with server:
+            prober = server_bot.HealthProber(port=port, timeout=2, concurrency=3)
+            return await prober.check(f"127.0.0.{i}" for i in range(1, 13))
+
+    monkeypatch.setattr(server_bot.asyncio, "open_connection", counting_open)
+    results = asyncio.run(scenario())
+    assert len(results) == 12
+    assert peak == 3
+
+
+def test_navigation_skips_servers_found_down(server_bot, db):
+    ids = [db.add_server("dtac", "DTAC NOPRO", f"10.0.0.{i}", "u", "p", "2030") for i in range(4)]
+    db.save_health({"10.0.0.1": (False, None, time.time()), "10.0.0.2": (False, None, time.time()),
+                    "10.0.0.3": (True, 0.01, time.time())})
+
+    # newest first: ids[3] (up), ids[2] (down), ids[1] (down), ids[0] (unprobed)
+    assert db.get_neighbor_ids(ids[3]) == (None, ids[0])
+    assert db.get_neighbor_ids(ids[0]) == (ids[3], None)
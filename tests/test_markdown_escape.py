@@ -0,0 +1,143 @@
+"""Escaped values must come back verbatim from Telegram's legacy Markdown parser."""
+import asyncio
+import itertools
+import random
+import re
+
+import pytest
+
+ALPHABET = "ab_*`[]()\\~>#+-=|{}.! \n0😀"
+SAMPLES = 3000
+
+
+def parse_legacy_markdown(text):
+    """Model of parse_mode="Markdown": returns (plain text, [(entity, text)]) or raises ValueError.
+
+    A backslash escapes only _ * ` [ outside entities; code spans and pre
+    blocks take their content literally.
+    """
+    plain, entities = [], []
+    i, n = 0, len(text)
+    while i < n:
+        c = text[i]
+        if c == "\\" and i + 1 < n and text[i + 1] in "_*`[":
+            plain.append(text[i + 1])
+            i += 2
+        elif c in "*_":
+            j = text.find(c, i + 1)
+            if j < 0:
+                raise ValueError(f"unclosed {c} at {i}")
+            entities.append(("bold" if c == "*" else "italic", text[i + 1:j]))
+            plain.append(text[i + 1:j])
+            i = j + 1
+        elif text.startswith("```", i):
+            j = text.find("```", i + 3)
+            if j < 0:
+                raise ValueError(f"unclosed pre at {i}")
+            entities.append(("pre", text[i + 3:j]))
+            plain.append(text[i + 3:j])
+            i = j + 3
+        elif c == "`":
+            j = text.find("`", i + 1)
+            if j < 0:
+                raise ValueError(f"unclosed ` at {i}")
+            entities.append(("code", text[i + 1:j]))
+            plain.append(text[i + 1:j])
+            i = j + 1
+        elif c == "[":
+            m = re.compile(r"\[([^\]]*)\]\(([^)]*)\)").match(text, i)
+            if not m:
+                raise ValueError(f"bad link at {i}")
+            entities.append(("text_link", m.group(1)))
+            plain.append(m.group(1))
+            i = m.end()
+        else:
+            plain.append(c)
+            i += 1
+    return "".join(plain), entities
+
+
+def random_values(seed):
+    rnd = random.Random(seed)
+    edge = ["", "\\", "\\\\", "`", "``", "```", "\\`", "\\_", "_*`[", "[x](y)", "*bold*", "a\\*b"]
+    yield from edge
+    for _ in range(SAMPLES):
+        yield "".join(rnd.choice(ALPHABET) for _ in range(rnd.randint(0, 16)))
+
+
+def labels(entities):
+    return [(kind, text) for kind, text in entities if kind != "code"]
+
+
+@pytest.fixture(params=["embedded", "server"])
+def escapers(request, embedded_bot, server_bot):
+    if request.param == "embedded":
+        return embedded_bot.md_escape, embedded_bot.md_code
+    return server_bot.Messages.md, server_bot.Messages.code
+
+
+def test_escaped_value_round_trips(escapers):
+    md, _ = escapers
+    for value in random_values(1):
+        assert parse_legacy_markdown(md(value)) == (value, []), repr(value)
+
+
+def test_code_value_round_trips(escapers):
+    _, code = escapers
+    for value in random_values(2):
+        plain, entities = parse_legacy_markdown(code(value))
+        assert plain == value, repr(value)
+        assert all(kind == "code" for kind, _ in entities), repr(value)
+
+
+def test_escaped_values_do_not_merge_with_neighbours(escapers):
+    md, code = escapers
+    values = list(random_values(3))
+    for left, right in zip(values, values[1:]):
+        text = f"*Label:* {md(left)} {code(right)} {md(right)} _end_"
+        plain, entities = parse_legacy_markdown(text)
+        assert plain == f"Label: {left} {right} {right} end", (left, right)
+        assert labels(entities) == [("bold", "Label:"), ("italic", "end")], (left, right)
+
+
+def test_profile_keeps_its_entities(embedded_bot):
+    baseline = parse_legacy_markdown(embedded_bot.render_profile(embedded_bot.PROFILE_TEMPLATE, "1", "x", None))[1]
+    for username in random_values(4):
+        plain, entities = parse_legacy_markdown(
+            embedded_bot.render_profile(embedded_bot.PROFILE_TEMPLATE, "12345", username, None))
+        assert f"@{username}\n" in plain + "\n"
+        assert labels(entities) == labels(baseline)
+
+
+def test_server_card_keeps_its_entities(server_bot):
+    def server(i, value):
+        return {"id": i, "provider": "dtac", "plan": value, "server_ip": value, "username": value,
+                "password": value, "expired_date": value, "copy_count": 1, "weight": 1}
+
+    baseline = parse_legacy_markdown(server_bot.Messages.server_info(server(0, "x")))[1]
+    for i, value in enumerate(random_values(5), 1):
+        for text in (server_bot.Messages.server_info(server(i, value)), server_bot.Messages.server_list_entry(server(i, value))):
+            plain, entities = parse_legacy_markdown(text)
+            assert value in plain
+        assert labels(parse_legacy_markdown(server_bot.Messages.server_info(server(i, value)))[1]) == labels(baseline)
+
+
+def test_empty_plan_message_is_markdown(server_bot, monkeypatch):
+    edits = []
+
+    async def record_edit(query, text, reply_markup=None, **kwargs):
+        edits.append((text, kwargs))
+
+    class Query:
+        from_user = type("User", (), {"id": 1})
+
+    monkeypatch.setattr(server_bot, "safe_edit", record_edit)
+    monkeypatch.setattr(server_bot.assigner, "pick", lambda *args: None)
+    handlers = server_bot.BotHandlers()
+    for i, plan in enumerate(itertools.islice(random_values(7), 200)):
+        asyncio.run(handlers.show_servers(Query(), "dtac", plan))
+        text, kwargs = edits[i]
+        assert kwargs.get("parse_mode") == "Markdown"
+        plain, entities = parse_legacy_markdown(text)
+        assert plan in plain
+        assert entities == [("bold", "No servers available for")]
@@ -0,0 +1,56 @@
+"""Server exports must import back unchanged through parse_server_file."""
+import tempfile
+
+import pytest
+
+
+@pytest.mark.parametrize("writer, filename", [("server_csv", "servers.csv"), ("server_json", "servers.json")])
+def test_export_round_trips_through_importer(server_bot, db, writer, filename):
+    originals = [
+        ("dtac", "DTAC NOPRO", "10.0.0.1:443", 'user,"quoted"', "pa\\ss\nword", "2030-01-01"),
+        ("true", "TRUE VIBER PLAN", "[2001:db8::1]:22", "ユーザー", "p", "2031-12-31"),
+        ("ais", "V2RAY 64KBPS", "10.0.0.3", "u", "{}[]", "2032-06-30"),
+    ]
+    for row in originals:
+        db.add_server(*row)
+    db.set_weight(2, 5)
+
+    with tempfile.TemporaryFile() as out:
+        getattr(server_bot.Messages, writer)(db.iter_servers(batch_size=2), out)
+        out.seek(0)
+        rows, errors = server_bot.parse_server_file(out.read(), filename)
+
+    assert errors == []
+    fields = server_bot.IMPORT_FIELDS
+    assert sorted(tuple(row[f] for f in fields) for row in rows) == sorted(originals)
+    assert {row["server_ip"]: row["weight"] for row in rows}["[2001:db8::1]:22"] == 5
+
+
+@pytest.mark.parametrize("writer, filename", [("server_csv", "servers.csv"), ("server_json", "servers.json")])
+def test_large_export_is_split_into_importable_parts(server_bot, db, monkeypatch, writer, filename):
+    for i in range(40):
+        db.add_server("dtac", "DTAC NOPRO", f"10.0.0.{i}", "user", "pass", "2030-01-01")
+    monkeypatch.setattr(server_bot, "EXPORT_PART_BYTES", 1000)
+
+    rows, parts = db.iter_servers(batch_size=7), []
+    while True:
+        with tempfile.TemporaryFile() as out:
+            write = getattr(server_bot.Messages, writer)
+            if not server_bot.Messages.export_part(write, rows, out, first=not parts):
+                break
+            size = out.tell()
+            out.seek(0)
+            parts.append((size, server_bot.parse_server_file(out.read(), filename)))
+
+    assert len(parts) > 1
+    assert all(size < 1000 + 200 for size, _ in parts)
+    assert all(errors == [] for _, (_, errors) in parts)
+    ips = [row["server_ip"] for _, (imported, _) in parts for row in imported]
+    assert sorted(ips) == sorted(f"10.0.0.{i}" for i in range(40))
+
+
+def test_empty_export_still_sends_one_part(server_bot, db):
+    with tempfile.TemporaryFile() as out:
+        assert server_bot.Messages.export_part(server_bot.Messages.server_csv, db.iter_servers(), out, first=True)
+        out.seek(0)
+        assert out.read().decode().startswith("id,provider,plan")
@@ -0,0 +1,47 @@
+"""StateStore / PersistentDict lookups must stay cheap on the event loop."""
+import threading
+
+import pytest
+
+
+@pytest.fixture(params=["embedded", "server"])
+def module(request):
+    fixture = "embedded_bot" if request.param == "embedded" else "server_bot"
+    return request.getfixturevalue(fixture)
+
+
+def test_missing_keys_are_read_once(module, tmp_path, monkeypatch):
+    store = module.StateStore(tmp_path / "state.db")
+    pdict = module.PersistentDict(store, "upload")
+    calls = []
+    real_get = store.get
+    monkeypatch.setattr(store, "get", lambda *args: calls.append(args) or real_get(*args))
+
+    for _ in range(5):
+        assert 42 not in pdict
+        assert pdict.get(42) is None
+    assert len(calls) == 1
+
+    pdict[42] = "photos"
+    store.flush()
+    assert pdict[42] == "photos"
+    del pdict[42]
+    store.flush()
+    assert 42 not in pdict
+    assert len(calls) == 1
+
+
+def test_reads_do_not_wait_for_the_writer_lock(module, tmp_path):
+    store = module.StateStore(tmp_path / "state.db")
+    pdict = module.PersistentDict(store, "upload")
+    pdict[1] = "docs"
+    store.flush()
+
+    reader = module.PersistentDict(store, "upload")
+    assert reader.get(2) is None  # opens the read connection (creating the table takes the lock once)
+    result = []
+    with store._lock:  # held by write() for a whole transaction
+        thread = threading.Thread(target=lambda: result.append(reader.get(1)))
+        thread.start()
+        thread.join(timeout=5)
+    assert result == ["docs"]